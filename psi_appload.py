@@ -0,0 +1,510 @@
+"""
+Concurrent-session load test for the Streamlit app (PSI_05_15.py).
+
+Every simulated session talks to a running app the way a browser tab does: it opens the
+app's websocket (/_stcore/stream), uploads the input and appendix through the upload
+endpoint, sends its widget changes as script reruns and fetches download buttons from the
+media endpoint. Each session runs the steps an analyst takes (SCENARIO):
+  open -> upload input -> upload appendix -> select PSIs -> score (until the job has
+  completed) -> filter by status -> sort -> look up an encounter -> download results
+An interaction is timed from the widget change until the script run it triggers, and any
+reruns that run requests (job status polling), has finished.
+
+Sessions are ramped in levels (--sessions 1,4,8,12): at each level that many sessions run
+the scenario at once while the server process and its job workers are sampled for CPU and
+resident memory. The report gives per level the latency percentiles of every interaction,
+the throughput (interactions per second, completed sessions per minute) and the server's
+CPU and memory, for capacity planning; with --p95-target-s it exits non-zero when an
+interaction's p95 is slower than the target, so it can be used as a regression check.
+
+Needs streamlit (its protocol messages, and its testing element tree to read the pages)
+and websockets, which streamlit installs.
+
+    python psi_appload.py --launch --input encounters.xlsx --appendix PSI_Appendix.xlsx --sessions 1,4,8,12
+    python psi_appload.py --url http://analyzer:8501 --server-pid 4242 --input encounters.xlsx \
+        --appendix PSI_Appendix.xlsx --sessions 12 --output interactions.csv
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import argparse
+import mimetypes
+import threading
+import contextlib
+import subprocess
+
+import pandas as pd
+
+import psi_engine
+from psi_engine import PSI_LIST
+from psi_loadgen import percentile
+
+try:
+    import requests
+    from websockets.sync.client import connect as websocket_connect
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+    from streamlit.proto.WidgetStates_pb2 import WidgetState
+    from streamlit.testing.v1.element_tree import parse_tree_from_messages
+except ImportError: # Optional dependencies, only needed to drive the app
+    websocket_connect = None
+
+try:
+    import psutil
+except ImportError: # /proc is read instead (Linux)
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+APP_SCRIPT = "PSI_05_15.py"
+XSRF_COOKIE = "_streamlit_xsrf"
+DEFAULT_TIMEOUT = 600.0 # Seconds one interaction (including a whole scoring job) may take
+DEFAULT_THINK_TIME = 1.0 # Mean pause between a session's interactions, in seconds
+SAMPLE_INTERVAL = 0.5 # Seconds between server CPU / memory samples
+SCENARIO = ["open", "upload_input", "upload_appendix", "select_psis", "score", "filter", "sort", "lookup", "download"]
+INTERACTION_COLUMNS = ["Level", "Session", "Step", "Seconds", "OK", "Error", "Bytes"]
+
+
+class AppError(Exception):
+    """The app raised an exception, or the page did not have the widget a step needs."""
+
+
+class AppSession:
+    """
+    One simulated browser session. Widget values are kept and sent with every rerun, as
+    the browser does; button clicks are sent with one rerun only.
+    """
+
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT):
+        if websocket_connect is None:
+            raise RuntimeError("Driving the app needs streamlit and websockets (pip install streamlit)")
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.states = {} # widget id -> WidgetState
+        self.tree = None # Elements of the last finished script run
+        self.session_id = None
+        self._stack = contextlib.ExitStack()
+        self._requests = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stack.close()
+        self.http.close()
+
+    def open(self):
+        """Connects and waits for the first script run."""
+        # The health check sets the XSRF cookie that the websocket and uploads are checked against
+        self.http.get(self.base_url + "/_stcore/health", timeout=self.timeout).raise_for_status()
+        xsrf = self.http.cookies.get(XSRF_COOKIE)
+        headers = {"Origin": self.base_url}
+        if self.http.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.http.cookies.items())
+        self.ws = self._stack.enter_context(websocket_connect(
+            "ws" + self.base_url[len("http"):] + "/_stcore/stream", subprotocols=["streamlit"] + ([xsrf] if xsrf else []),
+            additional_headers=headers, open_timeout=self.timeout, max_size=None))
+        return self.rerun()
+
+    def rerun(self):
+        """Sends the widget values and waits until the script run (and any reruns it requests) finished."""
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        message.rerun_script.widget_states.SetInParent()
+        message.rerun_script.widget_states.widgets.extend(self.states.values())
+        self.ws.send(message.SerializeToString())
+        self.states = {key: state for key, state in self.states.items() if not state.HasField("trigger_value")}
+        return self._wait_for_run()
+
+    def _receive(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise TimeoutError(f"No response from the app within {self.timeout:.0f}s")
+        message = ForwardMsg()
+        message.ParseFromString(self.ws.recv(timeout=remaining))
+        return message
+
+    def _wait_for_run(self):
+        deadline = time.perf_counter() + self.timeout
+        messages = []
+        while True:
+            message = self._receive(deadline)
+            kind = message.WhichOneof("type")
+            if kind == "new_session": # Every script run starts with one
+                messages = []
+                if message.new_session.HasField("initialize"):
+                    self.session_id = message.new_session.initialize.session_id
+            elif kind == "delta":
+                messages.append(message)
+            elif kind == "script_finished":
+                status = message.script_finished
+                if status == ForwardMsg.FINISHED_EARLY_FOR_RERUN: # st.rerun(), e.g. while a job is polled
+                    continue
+                if status == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise AppError("The app script failed to compile")
+                break
+        self.tree = parse_tree_from_messages(messages)
+        if len(self.tree.exception):
+            raise AppError(f"The app raised: {self.tree.exception[0].message}")
+        return self.tree
+
+    def widget(self, kind, label):
+        """The first `kind` widget (e.g. "selectbox") of the current page whose label contains `label`."""
+        for widget in getattr(self.tree, kind):
+            if label in widget.label:
+                return widget
+        raise AppError(f"No {kind} labelled '{label}' on the page")
+
+    def set_widget(self, kind, label, value=None):
+        """
+        Changes a widget as a user would and reruns: `value` is a selectbox option or the text
+        of a text input, a list of options for a multiselect, or a callable picking one from
+        the widget's options; a button is clicked. Options are sent as their display text,
+        as the browser does.
+        """
+        widget = self.widget(kind, label)
+        if widget.proto.disabled:
+            raise AppError(f"The {kind} '{widget.label}' is disabled")
+        if callable(value):
+            value = value(list(widget.proto.options))
+        state = WidgetState(id=widget.id)
+        if kind == "button":
+            state.trigger_value = True
+        elif kind == "multiselect":
+            state.string_array_value.data[:] = value
+        else:
+            state.string_value = value
+        self.states[widget.id] = state
+        return self.rerun()
+
+    def upload(self, label, path):
+        """Uploads a file into a file uploader, as the browser does, and reruns. Returns the bytes sent."""
+        widget = self.widget("file_uploader", label)
+        name = os.path.basename(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        self._requests += 1
+        message = BackMsg()
+        message.file_urls_request.request_id = str(self._requests)
+        message.file_urls_request.file_names.append(name)
+        message.file_urls_request.session_id = self.session_id or ""
+        self.ws.send(message.SerializeToString())
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            response = self._receive(deadline)
+            if response.WhichOneof("type") == "file_urls_response" and response.file_urls_response.response_id == str(self._requests):
+                break
+        if response.file_urls_response.error_msg:
+            raise AppError(f"Upload refused: {response.file_urls_response.error_msg}")
+        urls = response.file_urls_response.file_urls[0]
+        mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        upload_url = urls.upload_url if urls.upload_url.startswith("http") else self.base_url + urls.upload_url
+        # The connection is not reused after an upload: the next request on it can go unanswered
+        # (seen on the first upload to a newly started server)
+        self.http.put(upload_url, files={"file": (name, data, mime_type)}, timeout=self.timeout,
+                      headers={"X-Xsrftoken": self.http.cookies.get(XSRF_COOKIE) or "", "Connection": "close"}).raise_for_status()
+        state = WidgetState(id=widget.id)
+        info = state.file_uploader_state_value.uploaded_file_info.add(name=name, size=len(data), file_id=urls.file_id)
+        info.file_urls.CopyFrom(urls)
+        self.states[widget.id] = state
+        self.rerun()
+        return len(data)
+
+    def download(self, label):
+        """Fetches every download button whose label contains `label`. Returns the bytes received."""
+        received = 0
+        buttons = [b for b in self.tree.download_button if label in b.label]
+        if not buttons:
+            raise AppError(f"No download button labelled '{label}' on the page")
+        for button in buttons:
+            response = self.http.get(self.base_url + button.proto.url, timeout=self.timeout)
+            response.raise_for_status()
+            received += len(response.content)
+        return received
+
+
+def run_scenario(base_url, input_path, appendix_path, psis, encounter_ids, record, think_time=DEFAULT_THINK_TIME,
+                 timeout=DEFAULT_TIMEOUT, rng=None):
+    """
+    Runs the SCENARIO steps in one new session; `record(step, seconds, ok, error, bytes)` is
+    called after each (bytes uploaded or downloaded). A failed step ends the session.
+    Returns True if every step passed.
+    """
+    rng = rng or random.Random()
+    status = rng.choice(["Inclusion", "Exclusion"])
+    steps = {
+        "open": lambda s: s.open(),
+        "upload_input": lambda s: s.upload("Input", input_path),
+        "upload_appendix": lambda s: s.upload("Appendix", appendix_path),
+        "select_psis": lambda s: s.set_widget("multiselect", "Select PSIs", psis),
+        "score": lambda s: _completed(s.set_widget("button", "Score")),
+        "filter": lambda s: s.set_widget("selectbox", f"Filter by Status ({psis[0]})", status),
+        "sort": lambda s: s.set_widget("selectbox", f"Sort by ({psis[0]})",
+                                       lambda options: "Age" if "Age" in options else options[-1]),
+        "lookup": lambda s: s.set_widget("text_input", "EncounterID", rng.choice(encounter_ids)),
+        "download": lambda s: s.download(f"Download {psis[0]} Results"),
+    }
+    with AppSession(base_url, timeout) as session:
+        for step in SCENARIO:
+            if step != "open" and think_time:
+                time.sleep(rng.uniform(0.5, 1.5) * think_time)
+            started = time.perf_counter()
+            try:
+                size = steps[step](session)
+            except Exception as e: # Any failure is recorded against the step, and ends this session
+                record(step, time.perf_counter() - started, False, f"{type(e).__name__}: {e}", 0)
+                return False
+            record(step, time.perf_counter() - started, True, "", size if isinstance(size, int) else 0)
+    return True
+
+def _completed(tree):
+    """Checks that the scoring job the page shows has completed (the app stops polling once a job has finished)."""
+    statuses = [m.value for m in tree.metric if m.label == "Status"]
+    if not statuses:
+        raise AppError("No scoring job on the page")
+    if statuses[0] != "Completed":
+        raise AppError(f"Scoring job ended {statuses[0].lower()}")
+    return tree
+
+
+# --- Server metrics ---
+def _children(pid):
+    """Process ids of all descendants of `pid`, from /proc."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parents.setdefault(int(f.read().rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+            except (OSError, IndexError, ValueError): # Exited while listing
+                pass
+    found, pending = [], [pid]
+    while pending:
+        children = parents.get(pending.pop(), [])
+        found.extend(children)
+        pending.extend(children)
+    return found
+
+def process_usage(pid):
+    """(CPU seconds, resident bytes) of process `pid` and its descendants (job workers), or None."""
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return None
+        cpu = rss = 0
+        for p in processes:
+            try:
+                times = p.cpu_times()
+                cpu += times.user + times.system
+                rss += p.memory_info().rss
+            except psutil.Error: # A worker that exited in the meantime
+                pass
+        return cpu, rss
+    if not os.path.exists(f"/proc/{pid}"):
+        return None
+    cpu = rss = 0
+    ticks, page = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+    for p in [pid] + _children(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+            cpu += (int(fields[11]) + int(fields[12])) / ticks # utime + stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu, rss
+
+
+class ServerSampler(threading.Thread):
+    """Samples the server's CPU use (percent of one core) and resident memory until stopped."""
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = [] # (seconds since start, CPU percent, resident MB)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        started = previous_time = time.perf_counter()
+        previous = process_usage(self.pid)
+        while previous is not None and not self._stop_event.wait(self.interval):
+            now, usage = time.perf_counter(), process_usage(self.pid)
+            if usage is None:
+                break
+            cpu_percent = (usage[0] - previous[0]) / (now - previous_time) * 100
+            self.samples.append((now - started, cpu_percent, usage[1] / 1024 ** 2))
+            previous, previous_time = usage, now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.summary()
+
+    def summary(self):
+        if not self.samples:
+            return {"cpu_percent_mean": None, "cpu_percent_peak": None, "rss_mb_mean": None, "rss_mb_peak": None}
+        cpu = [s[1] for s in self.samples]
+        rss = [s[2] for s in self.samples]
+        return {"cpu_percent_mean": round(sum(cpu) / len(cpu), 1), "cpu_percent_peak": round(max(cpu), 1),
+                "rss_mb_mean": round(sum(rss) / len(rss), 1), "rss_mb_peak": round(max(rss), 1)}
+
+
+# --- Load levels ---
+def run_level(base_url, sessions, input_path, appendix_path, psis_per_session=3, think_time=DEFAULT_THINK_TIME,
+              timeout=DEFAULT_TIMEOUT, server_pid=None, seed=0):
+    """
+    Runs `sessions` concurrent sessions of the scenario (each with its own PSI selection).
+    Returns (interaction records, level summary).
+    """
+    encounter_ids = _encounter_ids(input_path)
+    records, lock = [], threading.Lock()
+
+    def session(number):
+        rng = random.Random(seed * 1000 + number)
+        psis = sorted(rng.sample(PSI_LIST, min(psis_per_session, len(PSI_LIST))), key=PSI_LIST.index)
+        time.sleep(rng.uniform(0, 1)) # Sessions do not all arrive in the same instant
+
+        def record(step, seconds, ok, error, size):
+            with lock:
+                records.append({"Level": sessions, "Session": number, "Step": step, "Seconds": round(seconds, 3),
+                                "OK": ok, "Error": error, "Bytes": size})
+            if not ok:
+                logger.warning("Session %d: %s failed after %.1fs: %s", number, step, seconds, error)
+
+        run_scenario(base_url, input_path, appendix_path, psis, encounter_ids, record, think_time, timeout, rng)
+
+    sampler = ServerSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(sessions)]
+    wall_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_seconds = time.perf_counter() - wall_start
+    server = sampler.stop() if sampler else {}
+
+    completed = len({r["Session"] for r in records if r["Step"] == SCENARIO[-1] and r["OK"]})
+    steps = {}
+    for step in SCENARIO:
+        latencies = sorted(r["Seconds"] for r in records if r["Step"] == step and r["OK"])
+        if latencies:
+            steps[step] = {"n": len(latencies), "p50_s": round(percentile(latencies, 50), 3),
+                           "p95_s": round(percentile(latencies, 95), 3), "max_s": round(latencies[-1], 3)}
+    summary = {
+        "sessions": sessions,
+        "completed_sessions": completed,
+        "errors": sum(not r["OK"] for r in records),
+        "wall_seconds": round(wall_seconds, 2),
+        "interactions_per_second": round(sum(r["OK"] for r in records) / wall_seconds, 2) if wall_seconds else None,
+        "sessions_per_minute": round(completed / wall_seconds * 60, 2) if wall_seconds else None,
+        "steps": steps,
+        **server,
+    }
+    logger.info("%d sessions: %d completed in %.1fs, %d errors", sessions, completed, wall_seconds, summary["errors"])
+    return records, summary
+
+def _encounter_ids(input_path):
+    df = psi_engine.read_input_file(input_path)
+    column = next((c for c in ["EncounterID", "Encounter_ID"] if c in df.columns), None)
+    ids = df[column].dropna().astype(str).tolist() if column else []
+    return ids or ["0"]
+
+
+# --- Launching the app ---
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def launch_app(port=None, startup_timeout=60.0):
+    """Starts the app headless on `port` (a free one if None). Returns (process, base URL)."""
+    port = port or _free_port()
+    command = [sys.executable, "-m", "streamlit", "run", APP_SCRIPT, "--server.headless", "true",
+               "--server.port", str(port), "--browser.gatherUsageStats", "false", "--server.fileWatcherType", "none"]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with code {process.returncode} while starting")
+        try:
+            if requests.get(base_url + "/_stcore/health", timeout=2).ok:
+                logger.info("App started at %s (pid %d)", base_url, process.pid)
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"The app did not start within {startup_timeout:.0f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the PSI 05-15 Streamlit app")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running app, e.g. http://127.0.0.1:8501")
+    target.add_argument("--launch", action="store_true", help="Start the app headless for the test and stop it afterwards")
+    parser.add_argument("--port", type=int, help="Port for --launch (default: a free one)")
+    parser.add_argument("--server-pid", type=int, help="Process id of the app server with --url, for CPU and memory")
+    parser.add_argument("--input", required=True, help="Encounter workbook each session uploads (.xlsx)")
+    parser.add_argument("--appendix", required=True, help="Appendix each session uploads (.xlsx or .json)")
+    parser.add_argument("--sessions", default="1,2,4,8", help="Concurrent sessions per level, comma-separated")
+    parser.add_argument("--psis-per-session", type=int, default=3, help="PSIs each session selects (at random)")
+    parser.add_argument("--think-time", type=float, default=DEFAULT_THINK_TIME, help="Mean seconds between interactions")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds one interaction may take")
+    parser.add_argument("--p95-target-s", type=float, help="Fail when any interaction's p95 exceeds this")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write every interaction (.csv)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if websocket_connect is None:
+        parser.error("Driving the app needs streamlit and websockets (pip install streamlit)")
+    levels = [int(n) for n in args.sessions.split(",") if n.strip()]
+    process = None
+    if args.launch:
+        process, base_url = launch_app(args.port)
+        server_pid = process.pid
+    else:
+        base_url, server_pid = args.url, args.server_pid
+    try:
+        records, summaries = [], []
+        for sessions in levels:
+            level_records, summary = run_level(base_url, sessions, args.input, args.appendix, args.psis_per_session,
+                                               args.think_time, args.timeout, server_pid, args.seed)
+            records.extend(level_records)
+            summaries.append(summary)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if args.output:
+        pd.DataFrame(records, columns=INTERACTION_COLUMNS).to_csv(args.output, index=False)
+
+    report = {"url": base_url, "levels": summaries}
+    failed = any(s["errors"] for s in summaries)
+    if args.p95_target_s is not None:
+        slow = sorted({step for s in summaries for step, stats in s["steps"].items() if stats["p95_s"] > args.p95_target_s})
+        report["p95_target_s"] = args.p95_target_s
+        report["steps_over_target"] = slow
+        failed = failed or bool(slow)
+    print(json.dumps(report, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
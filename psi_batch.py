@@ -0,0 +1,234 @@
+"""
+Batch mode: scores many input files (one workbook per facility and quarter) in
+parallel and merges the results.
+
+Files come from a directory or from a manifest (CSV or JSON with a `path`
+column and an optional `facility` column; relative paths are resolved against
+the manifest's directory). Each file is scored in a worker process that
+compiles the appendix once at startup. Files are queued largest first, so the
+longest jobs start early and the small ones fill in around them.
+
+    python psi_batch.py --input-dir quarterly/ --appendix PSI_Code_Sets.xlsx --output-dir batch_results/ --workers 4
+
+Outputs in --output-dir:
+- <PSI>.parquet (or .csv): the results of every file, tagged with Facility and Source_File
+- facility_rates.csv: encounters, inclusions and rate per 1000 per facility and PSI (plus ALL)
+- batch_summary.json: per-file rows, timings and errors
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+INPUT_EXTENSIONS = (".xlsx", ".xls", ".csv", ".parquet")
+ALL_FACILITIES = "ALL"
+TAG_COLUMNS = ["Facility", "Source_File"]
+
+
+# --- Inputs ---
+class BatchFile:
+    """One input file of a batch and the facility its results are tagged with."""
+
+    def __init__(self, path, facility=None):
+        self.path = path
+        self.facility = facility or os.path.splitext(os.path.basename(path))[0]
+        self.size = os.path.getsize(path)
+
+def files_from_directory(directory, recursive=False):
+    """Every encounter file (.xlsx/.xls/.csv/.parquet) in `directory`; the facility is the file name."""
+    paths = []
+    for root, dirs, names in os.walk(directory):
+        paths += [os.path.join(root, n) for n in names if n.lower().endswith(INPUT_EXTENSIONS) and not n.startswith("~$")]
+        if not recursive:
+            break
+    if not paths:
+        raise ValueError(f"No input files ({', '.join(INPUT_EXTENSIONS)}) found in {directory}")
+    return [BatchFile(p) for p in sorted(paths)]
+
+def files_from_manifest(manifest_path):
+    """Reads a CSV/JSON manifest with `path` and optional `facility` columns."""
+    if manifest_path.lower().endswith(".json"):
+        with open(manifest_path) as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries.get("files", [])
+    else:
+        entries = pd.read_csv(manifest_path, dtype=str).fillna("").to_dict("records")
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    files = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        if not entry.get("path"):
+            raise ValueError(f"Manifest {manifest_path}: every entry needs a 'path'")
+        path = entry["path"] if os.path.isabs(entry["path"]) else os.path.join(base_dir, entry["path"])
+        if not os.path.isfile(path):
+            raise ValueError(f"Manifest {manifest_path}: input file not found: {path}")
+        files.append(BatchFile(path, entry.get("facility") or None))
+    return files
+
+def schedule_largest_first(files):
+    """Submission order: largest file first (ties keep manifest order)."""
+    return sorted(range(len(files)), key=lambda i: -files[i].size)
+
+
+# --- Worker process state (the compiled appendix is shared by every file a worker scores) ---
+_worker_state = {}
+
+def init_worker(code_sets):
+    _worker_state["code_sets"] = psi_engine.compile_code_sets(code_sets)
+
+def score_file(path, facility, psis, validate_timing, backend, details="text"):
+    """Scores one file in a worker. Returns (results {psi: DataFrame}, rows, seconds)."""
+    started = time.time()
+    if backend == "pandas":
+        source = psi_engine.read_input_file(path)
+        rows = len(source)
+    else:
+        source, rows = path, None
+    results = psi_engine.score_with_backend(source, psis, _worker_state["code_sets"], validate_timing=validate_timing,
+                                            backend=backend, details=details)
+    for psi, df in results.items():
+        df.insert(0, "Source_File", os.path.basename(path))
+        df.insert(0, "Facility", facility)
+        if rows is None:
+            rows = len(df)
+    return results, rows, time.time() - started
+
+
+# --- Merged outputs ---
+def facility_rates(merged):
+    """Encounters, inclusions and rate per 1000 per facility and PSI, with an ALL row per PSI."""
+    rows = []
+    for psi, df in merged.items():
+        groups = [(facility, group) for facility, group in df.groupby("Facility", sort=True)] + [(ALL_FACILITIES, df)]
+        for facility, group in groups:
+            total_cases = len(group)
+            inclusions = int((group["Status"] == "Inclusion").sum())
+            rows.append({
+                "Facility": facility, "PSI": psi, "Encounters": total_cases, "Inclusions": inclusions,
+                "Exclusions": total_cases - inclusions,
+                "Rate_per_1000": round(inclusions / total_cases * 1000, 2) if total_cases > 0 else 0.0,
+            })
+    return pd.DataFrame(rows, columns=["Facility", "PSI", "Encounters", "Inclusions", "Exclusions", "Rate_per_1000"])
+
+def write_outputs(merged, rates, summary, output_dir, fmt="parquet"):
+    os.makedirs(output_dir, exist_ok=True)
+    for psi, df in merged.items():
+        path = os.path.join(output_dir, f"{psi}.{fmt}")
+        if fmt == "parquet":
+            # Pass-through columns can mix numbers and text across facilities; typed details keep their types
+            psi_engine.write_results_parquet(df, path, psi)
+        else:
+            psi_rules.text_details(psi, df).to_csv(path, index=False)
+    rates.to_csv(os.path.join(output_dir, "facility_rates.csv"), index=False)
+    with open(os.path.join(output_dir, "batch_summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+# --- Pipeline ---
+def score_batch(files, code_sets, psis=None, validate_timing=True, workers=None, backend="pandas", progress_callback=None,
+                details="text"):
+    """
+    Scores `files` (BatchFile list) in a process pool, largest first. Returns
+    (merged {psi: DataFrame in file order}, facility rates DataFrame, summary dict).
+    A file that fails is reported in the summary and left out of the merged results.
+    With details="typed" the Detail_ columns follow the fixed typed schema.
+    """
+    psis = list(psis or PSI_LIST)
+    workers = workers or os.cpu_count()
+    started = time.time()
+    per_file = {}
+    file_summaries = [{"path": f.path, "facility": f.facility, "bytes": f.size} for f in files]
+
+    # Not forked: DuckDB/Polars threads of the caller could hold locks a forked child would inherit
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method),
+                             initializer=init_worker, initargs=(code_sets,)) as pool:
+        futures = {
+            pool.submit(score_file, files[i].path, files[i].facility, psis, validate_timing, backend, details): i
+            for i in schedule_largest_first(files)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                results, rows, seconds = future.result()
+            except Exception as e:
+                logger.error("Scoring %s failed: %s", files[i].path, e)
+                file_summaries[i]["error"] = f"{type(e).__name__}: {e}"
+            else:
+                per_file[i] = results
+                file_summaries[i].update(rows=rows, seconds=round(seconds, 2))
+                logger.info("Scored %s (%s rows) in %.1fs", files[i].path, rows, seconds)
+            if progress_callback:
+                progress_callback(done, len(files))
+
+    merged = {
+        psi: psi_engine.order_result_columns(
+            pd.concat([per_file[i][psi] for i in sorted(per_file)], ignore_index=True), psi
+        ) if per_file else pd.DataFrame(columns=TAG_COLUMNS + psi_engine.RESULT_COLUMNS)
+        for psi in psis
+    }
+    # Tags first, then the usual result columns
+    merged = {psi: df[TAG_COLUMNS + [c for c in df.columns if c not in TAG_COLUMNS]] for psi, df in merged.items()}
+    if details == "typed":
+        # Categories differ between files, so the merged frames are re-typed
+        merged = {psi: psi_rules.apply_detail_dtypes(psi, df.copy()) for psi, df in merged.items()}
+    elapsed = time.time() - started
+    summary = {
+        "files": file_summaries,
+        "failed": sum(1 for s in file_summaries if "error" in s),
+        "encounters": sum(s.get("rows") or 0 for s in file_summaries),
+        "workers": workers,
+        "backend": backend,
+        "seconds": round(elapsed, 2),
+    }
+    return merged, facility_rates(merged), summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score many PSI input files in parallel and merge the results")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-dir", help="Directory of .xlsx/.csv/.parquet files (facility = file name)")
+    source.add_argument("--manifest", help="CSV or JSON manifest with path and optional facility columns")
+    parser.add_argument("--recursive", action="store_true", help="Also read files in subdirectories of --input-dir")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--backend", choices=psi_engine.BACKENDS, default="pandas")
+    parser.add_argument("--details", choices=psi_rules.DETAIL_FORMATS, default="text",
+                        help="Detail_ columns as text, or typed (bool, categorical, list and struct columns in Parquet)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+
+    files = files_from_manifest(args.manifest) if args.manifest else files_from_directory(args.input_dir, args.recursive)
+    code_sets = psi_engine.load_code_sets(args.appendix)
+    merged, rates, summary = score_batch(files, code_sets, psis, validate_timing=not args.no_timing_validation,
+                                         workers=args.workers, backend=args.backend, details=args.details)
+    write_outputs(merged, rates, summary, args.output_dir, args.format)
+    print(json.dumps({k: v for k, v in summary.items() if k != "files"}, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""
+SQL database source and sink for PSI scoring.
+
+Streams encounters from a warehouse query with a server-side cursor, scores
+them chunk by chunk and bulk-inserts the per-PSI results into result tables, so
+a nightly run over millions of rows never holds more than a few chunks in
+memory. Every connection comes from one pooled SQLAlchemy engine; any database
+with a SQLAlchemy dialect works, and a local SQLite file stands in for the
+warehouse during development:
+
+    python psi_db.py --db-url sqlite:///warehouse.db --table encounters \
+        --appendix PSI_Code_Sets.xlsx --column-map warehouse_columns.json
+
+Warehouse column names are mapped onto the input schema the engine reads
+(DX1..DX30 / POA1..POA30, Proc1..Proc20 with Proc<n>_Date/Proc<n>_Time,
+admission_date, discharge_date, MS-DRG, ...) with a JSON object
+{"warehouse_column": "input_column", ...}.
+
+Results go to one table per PSI, `<prefix>_<psi>` (e.g. psi_results_psi_05),
+with the standard result columns, the PSI details as JSON and a run ID.
+"""
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import psi_engine
+import psi_jobs
+import psi_rules
+from psi_engine import PSI_LIST
+
+try:
+    import sqlalchemy as sa
+except ImportError: # Optional dependency, only needed for database runs
+    sa = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FETCH_SIZE = 5000 # Rows fetched from the server-side cursor per chunk
+DEFAULT_COMMIT_ROWS = 100000 # Result rows written per transaction
+DEFAULT_RESULT_PREFIX = "psi_results"
+# Admission/discharge dates come back from many drivers as strings; they are parsed
+# once per encounter here instead of once per PSI inside evaluate_psi_comprehensive
+ENCOUNTER_DATE_FIELDS = ["admission_date", "Admission_Date", "discharge_date", "Discharge_Date"]
+# Fixed result columns (the PSI-specific Detail_* values go into the Details JSON column)
+RESULT_COLUMNS = ["EncounterID", "PSI", "Status", "Rationale", "Age", "MS_DRG", "PrincipalDX", "ATYPE", "Length_of_Stay"]
+
+
+def _require_sqlalchemy():
+    if sa is None:
+        raise ImportError("Database mode requires SQLAlchemy: pip install sqlalchemy (plus the driver for your database)")
+
+def create_db_engine(db_url, pool_size=4):
+    """Creates the pooled engine shared by the encounter reader and the result writer."""
+    _require_sqlalchemy()
+    if db_url.startswith("sqlite"):
+        engine = sa.create_engine(db_url)
+
+        # WAL lets the result writer commit while the reader's cursor is still open
+        @sa.event.listens_for(engine, "connect")
+        def _sqlite_wal(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.close()
+        return engine
+    return sa.create_engine(db_url, pool_size=pool_size, max_overflow=2, pool_pre_ping=True)
+
+def load_column_map(path):
+    """Reads a {"warehouse_column": "input_column"} JSON mapping."""
+    if not path:
+        return {}
+    with open(path) as f:
+        column_map = json.load(f)
+    if not isinstance(column_map, dict):
+        raise ValueError(f"Column map {path} must be a JSON object of warehouse_column: input_column")
+    return column_map
+
+
+# --- Source ---
+def stream_encounters(engine, query, column_map=None, fetch_size=DEFAULT_FETCH_SIZE, params=None):
+    """
+    Runs `query` with a server-side cursor and yields DataFrame chunks of at most
+    `fetch_size` encounters, with columns renamed to the input schema. The index
+    continues across chunks so fallback IDs (Row_<n>) stay unique.
+    """
+    _require_sqlalchemy()
+    column_map = column_map or {}
+    offset = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(sa.text(query), params or {})
+        columns = [column_map.get(c, c) for c in result.keys()]
+        for rows in result.partitions(fetch_size):
+            chunk = pd.DataFrame.from_records(rows, columns=columns)
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            for field in ENCOUNTER_DATE_FIELDS:
+                if field in chunk.columns and not pd.api.types.is_datetime64_any_dtype(chunk[field]):
+                    chunk[field] = chunk[field].map(psi_engine.parse_date_safe)
+            yield chunk
+
+
+# --- Sink ---
+def _to_db_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is pd.NaT:
+        return None
+    return str(value)
+
+def result_table_name(prefix, psi):
+    return f"{prefix}_{psi.lower()}"
+
+class ResultWriter:
+    """Buffers per-PSI result records and bulk-inserts them in large transactions."""
+
+    def __init__(self, engine, psis, prefix=DEFAULT_RESULT_PREFIX, run_id=None, commit_rows=DEFAULT_COMMIT_ROWS,
+                 replace=False):
+        _require_sqlalchemy()
+        self.engine = engine
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.commit_rows = commit_rows
+        self.rows_written = 0
+        metadata = sa.MetaData()
+        self.tables = {
+            psi: sa.Table(
+                result_table_name(prefix, psi), metadata,
+                sa.Column("Run_ID", sa.String(32), index=True),
+                *[sa.Column(name, sa.Text) for name in RESULT_COLUMNS],
+                sa.Column("Details", sa.Text),
+                sa.Column("Scored_At", sa.Float),
+            )
+            for psi in psis
+        }
+        if replace:
+            metadata.drop_all(engine)
+        metadata.create_all(engine)
+        self._buffers = {psi: [] for psi in psis}
+        self._buffered = 0
+
+    def add(self, results):
+        """
+        Adds one chunk of score_dataframe() output ({psi: [records]}). Records carry the
+        reason code; the Rationale text is rendered here, once per chunk and PSI.
+        """
+        scored_at = time.time()
+        for psi, records in results.items():
+            buffer = self._buffers[psi]
+            rationales = psi_rules.render_rationale(psi, psi_rules.apply_reason_dtypes(psi, pd.DataFrame(records))) if records else []
+            for record, rationale in zip(records, rationales):
+                details = {k[len("Detail_"):]: _to_db_value(v) for k, v in record.items() if k.startswith("Detail_")}
+                row = {name: _to_db_value(record.get(name)) for name in RESULT_COLUMNS}
+                row["Rationale"] = rationale
+                row.update(Run_ID=self.run_id, Details=json.dumps(details) if details else None, Scored_At=scored_at)
+                buffer.append(row)
+            self._buffered += len(records)
+        if self._buffered >= self.commit_rows:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows in one transaction (executemany per PSI table)."""
+        if not self._buffered:
+            return
+        with self.engine.begin() as conn:
+            for psi, buffer in self._buffers.items():
+                if buffer:
+                    conn.execute(self.tables[psi].insert(), buffer)
+        self.rows_written += self._buffered
+        self._buffers = {psi: [] for psi in self._buffers}
+        self._buffered = 0
+
+
+# --- Pipeline ---
+def score_database(engine, query, code_sets, psis=None, column_map=None, validate_timing=True, workers=1,
+                   fetch_size=DEFAULT_FETCH_SIZE, commit_rows=DEFAULT_COMMIT_ROWS, prefix=DEFAULT_RESULT_PREFIX,
+                   replace=False, progress_callback=None):
+    """
+    Streams encounters from `query`, scores them and writes results to the
+    per-PSI result tables. With `workers` > 1 chunks are scored in a process pool
+    (at most 2 chunks per worker in flight). Returns a run summary dict.
+    """
+    psis = list(psis or PSI_LIST)
+    code_sets = psi_engine.compile_code_sets(code_sets)
+    writer = ResultWriter(engine, psis, prefix=prefix, commit_rows=commit_rows, replace=replace)
+    started = time.time()
+    encounters = 0
+    chunks = stream_encounters(engine, query, column_map, fetch_size)
+
+    def record(results, n_rows):
+        nonlocal encounters
+        writer.add(results)
+        encounters += n_rows
+        if progress_callback:
+            progress_callback(encounters)
+
+    if workers <= 1:
+        for chunk in chunks:
+            record(psi_engine.score_dataframe(chunk, psis, code_sets, validate_timing=validate_timing), len(chunk))
+    else:
+        # Not forked: the driver's threads (connection pool) could hold locks a forked child would inherit
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+            in_flight = deque()
+            for chunk in chunks:
+                in_flight.append((pool.submit(psi_jobs.score_chunk, chunk, psis, code_sets, validate_timing), len(chunk)))
+                if len(in_flight) >= workers * 2:
+                    future, n_rows = in_flight.popleft()
+                    record(future.result(), n_rows)
+            while in_flight:
+                future, n_rows = in_flight.popleft()
+                record(future.result(), n_rows)
+    writer.flush()
+
+    elapsed = time.time() - started
+    return {
+        "run_id": writer.run_id,
+        "encounters": encounters,
+        "result_rows": writer.rows_written,
+        "tables": [table.name for table in writer.tables.values()],
+        "seconds": round(elapsed, 2),
+        "encounters_per_second": round(encounters / elapsed, 1) if elapsed else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score encounters from a SQL database into per-PSI result tables")
+    parser.add_argument("--db-url", required=True, help="SQLAlchemy URL, e.g. sqlite:///warehouse.db or postgresql://...")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--query", help="SELECT returning one row per encounter")
+    source.add_argument("--table", help="Encounter table (shorthand for SELECT * FROM <table>)")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--column-map", help="JSON file mapping warehouse columns to input columns")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--result-prefix", default=DEFAULT_RESULT_PREFIX)
+    parser.add_argument("--replace", action="store_true", help="Drop and recreate the result tables first")
+    parser.add_argument("--fetch-size", type=int, default=DEFAULT_FETCH_SIZE)
+    parser.add_argument("--commit-rows", type=int, default=DEFAULT_COMMIT_ROWS)
+    parser.add_argument("--workers", type=int, default=1, help="Scoring processes (1 = in-process)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+
+    code_sets = psi_engine.load_code_sets(args.appendix)
+    engine = create_db_engine(args.db_url, pool_size=max(2, args.workers))
+    query = args.query or f"SELECT * FROM {args.table}"
+    summary = score_database(
+        engine, query, code_sets, psis=psis, column_map=load_column_map(args.column_map),
+        validate_timing=not args.no_timing_validation, workers=args.workers, fetch_size=args.fetch_size,
+        commit_rows=args.commit_rows, prefix=args.result_prefix, replace=args.replace,
+        progress_callback=lambda n: logger.info("Scored %d encounters", n) if n % (args.fetch_size * 10) == 0 else None
+    )
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
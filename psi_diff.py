@@ -0,0 +1,367 @@
+"""
+Differential testing: the per-row reference engine (evaluate_psi_comprehensive)
+against the accelerated engines, over the same real or synthetic encounters.
+
+Every chunk of encounters is scored by the reference and each candidate engine
+in a worker process; Status, Reason (with its parameters) and every Detail_
+value are compared per encounter and PSI. Mismatches are written with the
+encounter's row, and for each distinct kind of mismatch the first encounter is
+shrunk to a minimal reproducing row: diagnosis and procedure slots are blanked
+one at a time as long as the mismatch persists.
+
+    python psi_diff.py --input encounters.parquet --appendix PSI_Code_Sets.xlsx --engines duckdb,polars --output-dir diff/
+    python psi_diff.py --synthetic 1000000 --appendix PSI_Code_Sets.xlsx --workers 16 --output-dir diff/
+
+Synthetic encounters draw diagnoses, procedures and MS-DRGs from the appendix's
+code sets, so the rules of every PSI fire. Outputs in --output-dir:
+- summary.json: rows, timings and mismatch counts per engine, PSI and field
+- mismatches.csv: the first --max-mismatches differing values (Row, EncounterID, PSI, Field, Reference, Candidate)
+- repros.csv: one minimal input row per kind of mismatch, with _Engine/_PSI/_Field/_Reference/_Candidate columns
+The exit code is 1 if any engine disagrees with the reference.
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+REFERENCE = "pandas"
+CANDIDATE_ENGINES = [b for b in psi_engine.BACKENDS if b != REFERENCE]
+DEFAULT_CHUNK_SIZE = 5000
+MAX_SYNTHETIC_DX = 12
+MAX_SYNTHETIC_PROCS = 8
+
+
+# --- Synthetic encounters ---
+def synthetic_pools(code_sets):
+    """(diagnosis codes, procedure codes, OR procedure codes, surgical/medical MS-DRGs) from the appendix."""
+    sets = psi_rules.build_rule_code_sets(code_sets)
+    dx_scopes, _, proc_sets, drg_sets = psi_rules.required_code_set_features(psi_rules.referenced_features(PSI_LIST))
+    pool = lambda names: sorted({str(c) for name in names for c in sets.get(name, ())})
+    # A few codes outside every set keep most encounters from matching everything
+    fillers = ["Z0000", "I10", "E119"]
+    drgs = [int(d) for d in pool(drg_sets) if str(d).isdigit()] or list(range(1, 999))
+    return pool(dx_scopes) + fillers, pool(proc_sets) + ["0000000"], pool(["ORPROC"]) or pool(proc_sets), drgs
+
+def synthesize(code_sets, rows, seed=0, start=0, pools=None):
+    """
+    `rows` synthetic encounters (EncounterIDs from S<start>) in the DX/POA/Proc layout
+    the app documents, with invalid POAs, missing fields, DRG 999 and minors mixed in.
+    """
+    rng = np.random.default_rng([seed, start])
+    dx_pool, proc_pool, or_pool, drgs = pools or synthetic_pools(code_sets)
+    admit = pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 700, rows), unit="D")
+    los = rng.integers(0, 31, rows)
+
+    def pick(values, mask=None):
+        out = np.asarray(values, dtype=object)[rng.integers(0, len(values), rows)]
+        if mask is not None:
+            out[~mask] = None
+        return out
+
+    df = pd.DataFrame({
+        "EncounterID": [f"S{i:09d}" for i in range(start, start + rows)],
+        "Age": np.where(rng.random(rows) < 0.9, rng.integers(18, 96, rows), rng.integers(0, 18, rows)),
+        "SEX": pick(["M", "F"], rng.random(rows) > 0.01),
+        "ATYPE": pick([1, 2, 3, 3]),
+        "DQTR": rng.integers(1, 5, rows),
+        "YEAR": rng.integers(2024, 2026, rows),
+        "MS-DRG": np.where(rng.random(rows) < 0.01, 999,
+                           np.where(rng.random(rows) < 0.8, pick(drgs).astype(int), rng.integers(1, 999, rows))),
+        "MDC": rng.integers(1, 26, rows),
+        "admission_date": admit,
+        "discharge_date": admit + pd.to_timedelta(los, unit="D"),
+        "length_of_stay": los,
+    })
+    dx_count = rng.integers(1, MAX_SYNTHETIC_DX + 1, rows)
+    for j in range(1, MAX_SYNTHETIC_DX + 1):
+        present = dx_count >= j
+        df[f"DX{j}"] = pick(dx_pool, present)
+        df[f"POA{j}"] = pick(["Y", "N", "N", "U", "W", "X", None] if j > 1 else ["Y", "N"], present)
+    proc_count = rng.integers(0, MAX_SYNTHETIC_PROCS + 1, rows)
+    for j in range(1, MAX_SYNTHETIC_PROCS + 1):
+        present = proc_count >= j
+        codes = pick(proc_pool, present)
+        if j == 1:
+            codes = np.where(present & (rng.random(rows) < 0.7), pick(or_pool), codes)
+        dated = present & (rng.random(rows) < 0.9)
+        offsets = pd.to_timedelta(rng.integers(0, 13 if j == 1 else 26, rows), unit="D")
+        df[f"Proc{j}"] = codes
+        df[f"Proc{j}_Date"] = np.where(dated, (admit + offsets).strftime("%Y-%m-%d"), None)
+        df[f"Proc{j}_Time"] = pick(["0830", "143000", "23:15:00"], dated & (rng.random(rows) < 0.5))
+    return df
+
+
+def synthesize_chunks(code_sets, rows, seed=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The same encounters run_diff synthesizes chunk by chunk in its workers."""
+    pools = synthetic_pools(code_sets)
+    return pd.concat([synthesize(code_sets, min(chunk_size, rows - s), seed, s, pools) for s in range(0, rows, chunk_size)],
+                     ignore_index=True)
+
+
+# --- Comparison ---
+def _comparable(value):
+    """Hashable, engine-independent form of a result value (typed details, categoricals, NA)."""
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, dict):
+        return tuple(sorted((k, _comparable(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_comparable(v) for v in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def compared_columns(psi):
+    """Result columns compared per encounter: EncounterID, Status, the reason columns and every Detail_."""
+    return ["EncounterID", "Status"] + psi_rules.reason_columns(psi) + list(psi_rules.detail_kinds(psi))
+
+def score_for_comparison(df, psis, code_sets, validate_timing, engine):
+    """Results in the compact, typed form, so text formatting differences cannot hide or fake a mismatch."""
+    return psi_engine.score_with_backend(df, psis, code_sets, validate_timing=validate_timing, backend=engine,
+                                         reasons="codes", details="typed")
+
+def compare_results(reference, candidate, psi):
+    """[(position, field, reference value, candidate value)] where one PSI's results differ."""
+    if len(reference) != len(candidate):
+        return [(-1, "row_count", len(reference), len(candidate))]
+    differences = []
+    for column in compared_columns(psi):
+        ref_values = [_comparable(v) for v in reference[column].astype(object)] if column in reference else [None] * len(reference)
+        cand_values = [_comparable(v) for v in candidate[column].astype(object)] if column in candidate else [None] * len(candidate)
+        differences += [(i, column, r, c) for i, (r, c) in enumerate(zip(ref_values, cand_values)) if r != c]
+    return differences
+
+
+# --- Minimal reproducing rows ---
+def slot_groups(columns):
+    """Columns that make up one diagnosis (code + POA) or procedure (code + date + time) slot."""
+    groups = {}
+    for column in columns:
+        for family, pattern in (("sdx", r"(?:POA_)?Sdx(\d+)"), ("dx", r"(?:DX|POA)(\d+)"), ("proc", r"Proc(\d+)(?:_Date|_Time)?"),
+                                ("pdx", r"Pdx()")):
+            m = re.fullmatch(pattern, str(column), re.IGNORECASE)
+            if m:
+                groups.setdefault((family, m.group(1)), []).append(column)
+                break
+    return list(groups.values())
+
+def reproduces(row_df, psi, code_sets, validate_timing, engine, field):
+    reference = score_for_comparison(row_df, [psi], code_sets, validate_timing, REFERENCE)[psi]
+    candidate = score_for_comparison(row_df, [psi], code_sets, validate_timing, engine)[psi]
+    return any(f in (field, "row_count") for _, f, _, _ in compare_results(reference, candidate, psi))
+
+def minimize_row(row, psi, code_sets, validate_timing, engine, field):
+    """
+    Blanks diagnosis/procedure slots of a mismatching encounter while the mismatch
+    on `field` persists (repeated until no slot can go). Returns the reduced row
+    without empty columns.
+    """
+    current = pd.DataFrame([row]).reset_index(drop=True)
+    changed = True
+    while changed:
+        changed = False
+        for group in slot_groups(current.columns):
+            if current[group].isna().all().all():
+                continue
+            trial = current.copy()
+            trial[group] = None
+            if reproduces(trial, psi, code_sets, validate_timing, engine, field):
+                current, changed = trial, True
+    return current.dropna(axis=1, how="all").iloc[0]
+
+
+# --- Worker processes ---
+_worker_state = {}
+
+def init_worker(code_sets, synthetic_seed):
+    _worker_state["code_sets"] = psi_engine.compile_code_sets(code_sets)
+    _worker_state["seed"] = synthetic_seed
+    if synthetic_seed is not None:
+        _worker_state["pools"] = synthetic_pools(code_sets)
+
+def diff_chunk(chunk, start, psis, validate_timing, engines, max_mismatches):
+    """
+    Scores one chunk with the reference and every candidate engine. `chunk` is a
+    DataFrame, or a row count to synthesize. Returns (rows, per-engine counts,
+    mismatch records, first mismatching input row per signature, seconds).
+    """
+    started = time.time()
+    code_sets = _worker_state["code_sets"]
+    if not isinstance(chunk, pd.DataFrame):
+        chunk = synthesize(code_sets, chunk, _worker_state["seed"], start, _worker_state["pools"])
+    chunk = chunk.reset_index(drop=True) # Row_<n> fallback IDs are positions in the chunk for every engine
+    reference = score_for_comparison(chunk, psis, code_sets, validate_timing, REFERENCE)
+    counts, mismatches, examples = {}, [], {}
+    for engine in engines:
+        candidate = score_for_comparison(chunk, psis, code_sets, validate_timing, engine)
+        for psi in psis:
+            differences = compare_results(reference[psi], candidate[psi], psi)
+            fields = counts.setdefault(engine, {}).setdefault(psi, {"rows": 0, "fields": {}})
+            fields["rows"] += len({i for i, _, _, _ in differences})
+            for i, field, ref_value, cand_value in differences:
+                fields["fields"][field] = fields["fields"].get(field, 0) + 1
+                encounter_id = reference[psi]["EncounterID"].iloc[i] if i >= 0 else ""
+                if len(mismatches) < max_mismatches:
+                    mismatches.append({"Engine": engine, "Row": start + i, "EncounterID": encounter_id, "PSI": psi,
+                                       "Field": field, "Reference": ref_value, "Candidate": cand_value})
+                # One example per kind of mismatch: engine, PSI, field and the reasons on both sides
+                signature = (engine, psi, field, str(reference[psi]["Reason"].iloc[i]) if i >= 0 else "",
+                             str(candidate[psi]["Reason"].iloc[i]) if i >= 0 else "")
+                if i >= 0 and signature not in examples:
+                    examples[signature] = (chunk.iloc[i].to_dict(), ref_value, cand_value)
+    return len(chunk), counts, mismatches, examples, time.time() - started
+
+def minimize_example(row, psi, validate_timing, engine, field):
+    return minimize_row(pd.Series(row), psi, _worker_state["code_sets"], validate_timing, engine, field)
+
+
+# --- Driver ---
+def worker_context():
+    """
+    Multiprocessing context for the workers. The caller may already have run the DuckDB or
+    Polars engine, whose threads can hold locks a forked child would inherit, so workers are
+    forked from a fork server that has only imported this module (spawned where there is none).
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+def _merge_counts(total, counts):
+    for engine, per_psi in counts.items():
+        for psi, c in per_psi.items():
+            t = total.setdefault(engine, {}).setdefault(psi, {"rows": 0, "fields": {}})
+            t["rows"] += c["rows"]
+            for field, n in c["fields"].items():
+                t["fields"][field] = t["fields"].get(field, 0) + n
+
+def run_diff(code_sets, source=None, synthetic_rows=None, seed=0, psis=None, engines=None, validate_timing=True,
+             workers=None, chunk_size=DEFAULT_CHUNK_SIZE, max_mismatches=1000, max_repros=10, progress_callback=None):
+    """
+    Compares `engines` with the reference over a DataFrame `source` or `synthetic_rows`
+    synthetic encounters. Returns (summary dict, mismatches DataFrame, repros DataFrame).
+    """
+    psis = list(psis or PSI_LIST)
+    engines = list(engines or [e for e in CANDIDATE_ENGINES if e in psi_engine.available_backends()])
+    workers = workers or os.cpu_count()
+    started = time.time()
+    if source is not None:
+        chunks = [(source.iloc[s:s + chunk_size], s) for s in range(0, len(source), chunk_size)]
+    else:
+        chunks = [(min(chunk_size, synthetic_rows - s), s) for s in range(0, synthetic_rows, chunk_size)]
+
+    rows, counts, mismatches, examples = 0, {}, [], {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context(),
+                             initializer=init_worker, initargs=(code_sets, seed if source is None else None)) as pool:
+        futures = [pool.submit(diff_chunk, chunk, start, psis, validate_timing, engines, max_mismatches)
+                   for chunk, start in chunks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            chunk_rows, chunk_counts, chunk_mismatches, chunk_examples, seconds = future.result()
+            rows += chunk_rows
+            _merge_counts(counts, chunk_counts)
+            mismatches += chunk_mismatches[:max(0, max_mismatches - len(mismatches))]
+            for signature, example in chunk_examples.items():
+                examples.setdefault(signature, example)
+            if progress_callback:
+                progress_callback(done, len(chunks))
+        compared_seconds = time.time() - started
+
+        # Minimal reproducing rows, shrunk in parallel
+        selected = sorted(examples.items())[:max_repros]
+        repro_futures = [pool.submit(minimize_example, row, psi, validate_timing, engine, field)
+                         for (engine, psi, field, _, _), (row, _, _) in selected]
+        repros = []
+        for ((engine, psi, field, _, _), (_, ref_value, cand_value)), future in zip(selected, repro_futures):
+            repro = future.result().to_dict()
+            repro.update(_Engine=engine, _PSI=psi, _Field=field, _Reference=ref_value, _Candidate=cand_value)
+            repros.append(repro)
+
+    mismatched = sum(c["rows"] for per_psi in counts.values() for c in per_psi.values())
+    summary = {
+        "rows": rows,
+        "psis": psis,
+        "engines": engines,
+        "validate_timing": validate_timing,
+        "workers": workers,
+        "mismatched_results": mismatched,
+        "mismatch_kinds": len(examples),
+        "counts": counts,
+        "compare_seconds": round(compared_seconds, 2),
+        "rows_per_second": round(rows / compared_seconds, 1) if compared_seconds else None,
+        "seconds": round(time.time() - started, 2),
+    }
+    mismatch_columns = ["Engine", "Row", "EncounterID", "PSI", "Field", "Reference", "Candidate"]
+    return summary, pd.DataFrame(mismatches, columns=mismatch_columns), pd.DataFrame(repros)
+
+def write_report(summary, mismatches, repros, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    mismatches.to_csv(os.path.join(output_dir, "mismatches.csv"), index=False)
+    if not repros.empty:
+        # Metadata columns first; the rest can be fed back to any engine as an input file
+        meta = [c for c in repros.columns if c.startswith("_")]
+        repros[meta + [c for c in repros.columns if c not in meta]].to_csv(os.path.join(output_dir, "repros.csv"), index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the reference PSI engine with the accelerated engines")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="Encounters (.xlsx, .csv or .parquet)")
+    source.add_argument("--synthetic", type=int, help="Number of synthetic encounters to generate from the appendix")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for --synthetic")
+    parser.add_argument("--save-input", help="Also write the synthetic encounters to this .parquet/.csv file")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--engines", default=",".join(CANDIDATE_ENGINES), help="Comma-separated candidate engines")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Encounters per worker task")
+    parser.add_argument("--max-mismatches", type=int, default=1000, help="Mismatching values kept in mismatches.csv")
+    parser.add_argument("--max-repros", type=int, default=10, help="Kinds of mismatch shrunk to a minimal row")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    engines = [e.strip().lower() for e in args.engines.split(",") if e.strip()]
+    unknown = [p for p in psis if p not in PSI_LIST] + [e for e in engines if e not in CANDIDATE_ENGINES]
+    if unknown:
+        parser.error(f"Unknown PSI(s)/engine(s): {', '.join(unknown)}")
+    missing = [e for e in engines if e not in psi_engine.available_backends()]
+    if missing:
+        parser.error(f"Engine(s) not installed: {', '.join(missing)}")
+
+    code_sets = psi_engine.load_code_sets(args.appendix)
+    df = psi_engine.read_input_file(args.input) if args.input else None
+    if args.synthetic and args.save_input:
+        generated = synthesize_chunks(code_sets, args.synthetic, args.seed, args.chunk_size)
+        generated.to_parquet(args.save_input, index=False) if args.save_input.endswith(".parquet") else generated.to_csv(args.save_input, index=False)
+    summary, mismatches, repros = run_diff(
+        code_sets, source=df, synthetic_rows=args.synthetic, seed=args.seed, psis=psis, engines=engines,
+        validate_timing=not args.no_timing_validation, workers=args.workers, chunk_size=args.chunk_size,
+        max_mismatches=args.max_mismatches, max_repros=args.max_repros,
+        progress_callback=lambda done, total: logger.info("Compared %d/%d chunks", done, total),
+    )
+    write_report(summary, mismatches, repros, args.output_dir)
+    print(json.dumps({k: v for k, v in summary.items() if k != "counts"}, indent=2))
+    return 1 if summary["mismatched_results"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
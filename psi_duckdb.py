@@ -0,0 +1,642 @@
+"""
+In-process DuckDB backend for PSI scoring.
+
+Registers the input (Excel is converted to Parquet once and cached; CSV and
+Parquet are scanned directly) and the compiled appendix as DuckDB tables,
+unpivots DX1..DX30/POA and Proc1..Proc20 into long dx/proc tables and
+evaluates the PSI rules of psi_rules.py as SQL, so no encounter is processed
+row by row in Python. DuckDB runs every query on all cores with its vectorized
+executor.
+
+Results match psi_engine.score_dataframe on the same data (one DataFrame per
+PSI with the same columns). One difference in input handling: procedure and
+admission dates stored as text are parsed with the formats in DATE_FORMATS
+instead of pandas' format inference.
+
+    python psi_duckdb.py --input encounters.parquet --appendix PSI_Code_Sets.xlsx --output-dir results/
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+
+import pandas as pd
+
+import psi_rules
+from psi_engine import PSI_LIST, MINUTES_PER_DAY, read_input_file, make_parquet_safe, load_code_sets
+
+try:
+    import duckdb
+except ImportError: # Optional dependency, only needed for the DuckDB backend
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "psi_duckdb_cache")
+# Text date formats tried in order (pandas infers the format per value; DuckDB needs them listed)
+DATE_FORMATS = [
+    "%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+    "%m/%d/%Y", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M", "%Y%m%d",
+]
+MAX_DX = 30
+MAX_PROC = 20
+
+# Python's str.strip() whitespace, and floor division (DuckDB's // truncates toward zero)
+MACROS = """
+CREATE OR REPLACE MACRO py_strip(s) AS trim(s, chr(32) || chr(9) || chr(10) || chr(11) || chr(12) || chr(13));
+CREATE OR REPLACE MACRO floor_div(a, b) AS (a - ((a % b) + b) % b) // b;
+"""
+
+
+def _require_duckdb():
+    if duckdb is None:
+        raise ImportError("The DuckDB backend requires DuckDB: pip install duckdb")
+
+def connect(threads=None):
+    """Opens an in-memory DuckDB connection with the PSI macros."""
+    _require_duckdb()
+    con = duckdb.connect()
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    con.execute(MACROS)
+    return con
+
+
+# --- Input ---
+def excel_to_parquet(path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Converts an Excel workbook to Parquet once; later calls reuse the cached file
+    until the workbook changes (keyed on path, size and modification time).
+    """
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    cached = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}-{key}.parquet")
+    if not os.path.exists(cached):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cached + ".tmp"
+        make_parquet_safe(read_input_file(path)).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cached)
+        logger.info("Converted %s to %s", path, cached)
+    return cached
+
+def register_input(con, source, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads the encounters into the `encounters` table (with a row_idx column, the
+    pandas row position). `source` is a DataFrame or a .xlsx/.xls, .csv or .parquet path.
+    """
+    if isinstance(source, pd.DataFrame):
+        con.register("input_df", make_parquet_safe(source))
+        scan = "input_df"
+    else:
+        ext = os.path.splitext(source)[1].lower()
+        if ext in (".xlsx", ".xls"):
+            source = excel_to_parquet(source, cache_dir)
+            ext = ".parquet"
+        escaped = source.replace("'", "''")
+        if ext == ".parquet":
+            scan = f"read_parquet('{escaped}')"
+        elif ext == ".csv":
+            scan = f"read_csv_auto('{escaped}')"
+        else:
+            raise ValueError(f"Unsupported input type: {source} (expected .xlsx, .csv or .parquet)")
+    con.execute(f"CREATE OR REPLACE TABLE encounters AS SELECT row_number() OVER () - 1 AS row_idx, * FROM {scan}")
+    if isinstance(source, pd.DataFrame):
+        con.unregister("input_df")
+    return {name: dtype for name, dtype in con.execute("SELECT column_name, column_type FROM (DESCRIBE encounters)").fetchall()}
+
+def register_code_sets(con, code_sets, set_names):
+    """Loads the compiled appendix (plus psi_rules.DERIVED_SETS) as code_sets(set_name, code)."""
+    rule_sets = psi_rules.build_rule_code_sets(code_sets)
+    pairs = sorted({(name, code) for name in set_names for code in rule_sets.get(name, ())})
+    con.register("code_sets_df", pd.DataFrame(pairs, columns=["set_name", "code"], dtype=str))
+    con.execute("CREATE OR REPLACE TABLE code_sets AS SELECT set_name, code FROM code_sets_df")
+    con.unregister("code_sets_df")
+
+def register_membership(con, code_sets, layout, table):
+    """Loads the membership words of a psi_rules.MembershipLayout as `table`(code, M_0, ...)."""
+    words = layout.code_table(psi_rules.build_rule_code_sets(code_sets))
+    con.register("membership_df", words)
+    con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT CAST(code AS VARCHAR) AS code, "
+                f"{', '.join(f'CAST({c} AS BIGINT) AS {c}' for c in layout.word_columns())} FROM membership_df")
+    con.unregister("membership_df")
+
+
+# --- SQL building blocks mirroring the pandas extraction ---
+def _q(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class Columns:
+    """Expressions over the encounters table that reproduce Python's view of a row value."""
+
+    def __init__(self, types):
+        self.types = types
+
+    def has(self, name):
+        return name in self.types
+
+    def pystr(self, name):
+        """str(value) for a non-null value (NULL if the value or the column is missing)."""
+        if not self.has(name):
+            return "NULL"
+        if self.types[name] == "BOOLEAN":
+            return f"CASE WHEN {_q(name)} THEN 'True' WHEN NOT {_q(name)} THEN 'False' END"
+        return f"CAST({_q(name)} AS VARCHAR)"
+
+    def is_numeric(self, name):
+        t = self.types.get(name, "")
+        return t in ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT", "UINTEGER",
+                     "UBIGINT", "FLOAT", "DOUBLE") or t.startswith("DECIMAL")
+
+    def blank(self, name):
+        """pd.isna(value) or not str(value).strip()"""
+        if not self.has(name):
+            return "TRUE"
+        return f"({_q(name)} IS NULL OR py_strip({self.pystr(name)}) = '')"
+
+    def falsy(self, name):
+        """A present value that Python treats as false ('' or 0); NULL/NaN is truthy there."""
+        if self.types[name] == "BOOLEAN":
+            return f"COALESCE(NOT {_q(name)}, FALSE)"
+        if self.is_numeric(name):
+            return f"COALESCE({_q(name)} = 0, FALSE)"
+        return f"COALESCE({self.pystr(name)} = '', FALSE)"
+
+    def python_or(self, names, fallback="NULL", as_text=True):
+        """`row.get(a) or row.get(b) or fallback` for columns that may be missing."""
+        expr = fallback
+        for name in reversed(names):
+            if not self.has(name):
+                continue
+            value = self.pystr(name) if as_text else _q(name)
+            expr = f"CASE WHEN {self.falsy(name)} THEN {expr} ELSE {value} END"
+        return expr
+
+    def timestamp(self, name):
+        """Parses a date column into a TIMESTAMP (NULL when missing or unparseable)."""
+        if not self.has(name):
+            return "NULL"
+        t = self.types[name]
+        if t.startswith("TIMESTAMP") or t == "DATE":
+            return f"CAST({_q(name)} AS TIMESTAMP)"
+        if t == "VARCHAR":
+            formats = "[" + ", ".join(psi_rules.sql_str(f) for f in DATE_FORMATS) + "]"
+            return f"try_strptime(py_strip({_q(name)}), {formats})"
+        return "NULL"
+
+    def time_of_day(self, name):
+        """Procedure time as TIME, accepting HH:MM:SS, HHMMSS and HHMM like extract_proc_info_enhanced."""
+        raw = f"py_strip({self.pystr(name)})"
+        return (f"TRY_CAST(CASE WHEN NOT contains({raw}, ':') AND length({raw}) = 6 "
+                f"THEN substr({raw}, 1, 2) || ':' || substr({raw}, 3, 2) || ':' || substr({raw}, 5, 2) "
+                f"WHEN NOT contains({raw}, ':') AND length({raw}) = 4 "
+                f"THEN substr({raw}, 1, 2) || ':' || substr({raw}, 3, 2) || ':00' ELSE {raw} END AS TIME)")
+
+def minute_of(timestamp_expr):
+    """int64 epoch minutes of a timestamp (floor, like psi_engine.to_epoch_minute)."""
+    return f"floor_div(epoch_us({timestamp_expr}), 60000000)"
+
+def _norm_code(expr):
+    return f"py_strip(upper(replace({expr}, '.', '')))"
+
+def _norm_poa(cols, name):
+    if not cols.has(name):
+        return "''"
+    poa = f"py_strip(upper({cols.pystr(name)}))"
+    return f"CASE WHEN {poa} IN ('Y', 'N', 'U', 'W') THEN {poa} ELSE '' END"
+
+def build_dx_long(con, cols):
+    """dx_long(row_idx, seq, code, poa): one row per diagnosis, seq 1 = principal (extract_dx_codes_enhanced)."""
+    selects = []
+    for seq in range(1, MAX_DX + 1):
+        if seq == 1:
+            std, std_poa, alt, alt_poa = "DX1", "POA1", "Pdx", "POA1"
+        else:
+            std, std_poa, alt, alt_poa = f"DX{seq}", f"POA{seq}", f"Sdx{seq - 1}", f"POA_Sdx{seq - 1}"
+        if not cols.has(std) and not cols.has(alt):
+            continue
+        use_alt = cols.blank(std)
+        dx = f"CASE WHEN {use_alt} THEN {cols.pystr(alt)} ELSE {cols.pystr(std)} END"
+        poa = f"CASE WHEN {use_alt} THEN {_norm_poa(cols, alt_poa)} ELSE {_norm_poa(cols, std_poa)} END"
+        selects.append(f"SELECT row_idx, {seq} AS seq, {dx} AS raw, {poa} AS poa FROM encounters")
+    if not selects:
+        selects.append("SELECT row_idx, 1 AS seq, NULL::VARCHAR AS raw, '' AS poa FROM encounters WHERE FALSE")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE dx_long AS
+        SELECT row_idx, seq, {_norm_code('raw')} AS code, poa
+        FROM ({' UNION ALL '.join(selects)})
+        WHERE raw IS NOT NULL AND py_strip(raw) <> ''
+    """)
+
+def build_proc_long(con, cols):
+    """proc_long(row_idx, seq, code, minute): one row per procedure (extract_proc_info_enhanced)."""
+    selects = []
+    for seq in range(1, MAX_PROC + 1):
+        code_col, date_col, time_col = f"Proc{seq}", f"Proc{seq}_Date", f"Proc{seq}_Time"
+        if not cols.has(code_col):
+            continue
+        ts = cols.timestamp(date_col)
+        if cols.has(time_col) and ts != "NULL":
+            # A time column replaces the time of day of the date value
+            ts = f"CASE WHEN {cols.blank(time_col)} THEN {ts} ELSE CAST({ts} AS DATE) + {cols.time_of_day(time_col)} END"
+        selects.append(f"SELECT row_idx, {seq} AS seq, {cols.pystr(code_col)} AS raw, {minute_of(ts) if ts != 'NULL' else 'NULL::BIGINT'} AS minute "
+                       f"FROM encounters")
+    if not selects:
+        selects.append("SELECT row_idx, 1 AS seq, NULL::VARCHAR AS raw, NULL::BIGINT AS minute FROM encounters WHERE FALSE")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE proc_long AS
+        SELECT row_idx, seq, {_norm_code('raw')} AS code, minute
+        FROM ({' UNION ALL '.join(selects)})
+        WHERE raw IS NOT NULL AND py_strip(raw) <> ''
+    """)
+
+
+# --- Feature table ---
+DX_SCOPES = {
+    "P": "d.seq = 1", "S": "d.seq > 1", "SY": "d.seq > 1 AND d.poa = 'Y'", "SN": "d.seq > 1 AND d.poa = 'N'",
+    "A": "TRUE", "AY": "d.poa = 'Y'", "AN": "d.poa = 'N'",
+}
+DX_PLANES = {
+    "P": "d.seq = 1", "PY": "d.seq = 1 AND d.poa = 'Y'", "PN": "d.seq = 1 AND d.poa = 'N'",
+    "S": "d.seq > 1", "SY": "d.seq > 1 AND d.poa = 'Y'", "SN": "d.seq > 1 AND d.poa = 'N'",
+}
+assert list(DX_PLANES) == psi_rules.DX_PLANES and set(DX_SCOPES) == set(psi_rules.SCOPE_PLANES)
+
+def _base_features(cols):
+    """Encounter-level features and result pass-through columns (evaluate_psi_comprehensive / build_result_record)."""
+    age = _q("Age") if cols.has("Age") else "NULL"
+    # length_of_stay or Length_of_stay: 0 falls through, NaN does not
+    los = cols.python_or(["length_of_stay", "Length_of_stay"], as_text=False) if any(
+        cols.is_numeric(c) for c in ("length_of_stay", "Length_of_stay")) else "NULL"
+
+    drg_sources = []
+    for name in ("DRG", "MS-DRG"):
+        if not cols.has(name):
+            drg_sources.append((name, "NULL"))
+        elif cols.is_numeric(name):
+            drg_sources.append((name, f"CAST(trunc({_q(name)}) AS BIGINT)"))
+        else:
+            text = f"py_strip({cols.pystr(name)})"
+            drg_sources.append((name, f"CASE WHEN regexp_full_match({text}, '[+-]?[0-9]+') THEN TRY_CAST({text} AS BIGINT) END"))
+    drg_value = f"CASE WHEN {cols.blank('DRG')} THEN {drg_sources[1][1]} ELSE {drg_sources[0][1]} END"
+
+    # Required fields: SEX, AGE, DQTR, YEAR and DX1 (row.get("DX1") or row.get("Pdx"))
+    if cols.has("DX1") and cols.has("Pdx"):
+        dx1_blank = f"CASE WHEN {cols.falsy('DX1')} THEN {cols.blank('Pdx')} ELSE {cols.blank('DX1')} END"
+    else:
+        dx1_blank = cols.blank("DX1") if cols.has("DX1") else cols.blank("Pdx")
+    missing = [f"CASE WHEN {cols.blank(c)} THEN '{label}' END" for label, c in
+               (("SEX", "SEX"), ("AGE", "Age"), ("DQTR", "DQTR"), ("YEAR", "YEAR"))]
+    missing.append(f"CASE WHEN {dx1_blank} THEN 'DX1' END")
+
+    # admission_date or Admission_Date
+    if cols.has("admission_date") and cols.has("Admission_Date"):
+        admit_ts = f"CASE WHEN {cols.falsy('admission_date')} THEN {cols.timestamp('Admission_Date')} ELSE {cols.timestamp('admission_date')} END"
+    else:
+        admit_ts = cols.timestamp("admission_date" if cols.has("admission_date") else "Admission_Date")
+
+    def passthrough(name):
+        return _q(name) if cols.has(name) else "''"
+
+    return {
+        "AGE": age,
+        "AGE_STR": cols.pystr("Age"),
+        "LOS": los,
+        "LOS_STR": f"CAST(LOS AS VARCHAR)",
+        "ATYPE_3": f"COALESCE({_q('ATYPE')} = 3, FALSE)" if cols.is_numeric("ATYPE") else "FALSE",
+        "MDC_4": f"COALESCE({_q('MDC')} = 4, FALSE)" if cols.is_numeric("MDC") else "FALSE",
+        "DRG_VALUE": drg_value,
+        "MS_DRG_STR": f"py_strip({cols.pystr('MS-DRG')})" if cols.has("MS-DRG") else "''",
+        "MISSING_FIELDS": f"NULLIF(concat_ws(', ', {', '.join(missing)}), '')",
+        "ADMIT_MINUTE": minute_of(admit_ts) if admit_ts != "NULL" else "NULL::BIGINT",
+        "HAS_ADMIT_DATE": "ADMIT_MINUTE IS NOT NULL",
+        "OUT_EncounterID": cols.python_or(["EncounterID", "Encounter_ID"], fallback="'Row_' || CAST(e.row_idx AS VARCHAR)"),
+        "OUT_Age": passthrough("Age"),
+        "OUT_MS_DRG": passthrough("MS-DRG"),
+        "OUT_PrincipalDX": cols.python_or(["DX1", "Pdx"], fallback="''"),
+        "OUT_ATYPE": passthrough("ATYPE"),
+        "OUT_Length_of_Stay": los if los != "NULL" else passthrough("Length_of_stay"),
+    }
+
+def _has_bit(layout, set_name, word_column):
+    """SQL test of one code set's bit; word_column is a format string taking the word index."""
+    word, mask = layout.mask(set_name)
+    return f"({word_column.format(word)} & {mask}) <> 0"
+
+def build_feature_table(con, cols, validate_timing=True, psis=PSI_LIST):
+    """
+    Creates the `features` table: one row per encounter with every feature the rules of `psis` read.
+    Diagnoses and procedures are joined once to their membership words (dx_bits / proc_bits,
+    see prepare_code_sets()); the per-encounter bit planes are kept as BITS_<plane>_<word> columns.
+    """
+    features = psi_rules.referenced_features(psis, validate_timing)
+    dx_scopes, dx_values, proc_sets, drg_sets = psi_rules.required_code_set_features(features)
+    dx_layout, proc_layout = psi_rules.membership_layouts(dx_scopes, proc_sets)
+
+    dx_exprs, dx_outer = [], []
+    for plane, condition in DX_PLANES.items():
+        for w, column in enumerate(dx_layout.plane_columns(plane)):
+            dx_exprs.append(f"bit_or(m.M_{w}) FILTER (WHERE {condition}) AS {column}")
+            dx_outer.append(f"COALESCE(dx.{column}, 0) AS {column}")
+    for set_name, scopes in sorted(dx_scopes.items()):
+        for scope in sorted(scopes):
+            col = f"DX_{set_name}_{scope}"
+            planes = [_has_bit(dx_layout, set_name, f"COALESCE(dx.BITS_{plane}_{{}}, 0)") for plane in psi_rules.SCOPE_PLANES[scope]]
+            dx_outer.append(f"({' OR '.join(planes)}) AS {col}")
+            wanted = dx_values.get((set_name, scope), set())
+            match = f"{_has_bit(dx_layout, set_name, 'm.M_{}')} AND {DX_SCOPES[scope]}"
+            if "FIRST" in wanted:
+                dx_exprs.append(f"arg_min(d.code, d.seq) FILTER (WHERE {match}) AS {col}_FIRST")
+                dx_outer.append(f"dx.{col}_FIRST")
+            if "LIST" in wanted:
+                # An unordered list() sorted per encounter afterwards; list(... ORDER BY) sorts
+                # inside the aggregate and is several times slower
+                dx_exprs.append(f"list({{'seq': d.seq, 'code': d.code}}) FILTER (WHERE {match}) AS {col}_PAIRS")
+                dx_outer.append(f"list_transform(list_sort(dx.{col}_PAIRS), x -> x.code) AS {col}_LIST")
+
+    proc_exprs, proc_outer = [], []
+    for w, column in enumerate(proc_layout.plane_columns(psi_rules.PROC_PLANE)):
+        proc_exprs.append(f"bit_or(m.M_{w}) AS {column}")
+        proc_outer.append(f"COALESCE(pr.{column}, 0) AS {column}")
+    for set_name in sorted(proc_sets):
+        match = _has_bit(proc_layout, set_name, "m.M_{}")
+        proc_exprs += [f"count(*) FILTER (WHERE {match}) AS PR_{set_name}_COUNT",
+                       f"min(p.minute) FILTER (WHERE {match}) AS PR_{set_name}_FIRST",
+                       f"max(p.minute) FILTER (WHERE {match}) AS PR_{set_name}_LAST"]
+        proc_outer += [f"{_has_bit(proc_layout, set_name, 'COALESCE(pr.BITS_' + psi_rules.PROC_PLANE + '_{}, 0)')} AS PR_{set_name}",
+                       f"COALESCE(pr.PR_{set_name}_COUNT, 0) AS PR_{set_name}_COUNT",
+                       f"pr.PR_{set_name}_FIRST", f"pr.PR_{set_name}_LAST",
+                       f"floor_div(pr.PR_{set_name}_FIRST, {MINUTES_PER_DAY}) AS PR_{set_name}_FIRST_DAY",
+                       f"floor_div(pr.PR_{set_name}_LAST, {MINUTES_PER_DAY}) AS PR_{set_name}_LAST_DAY"]
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE dx_features AS
+        SELECT d.row_idx, {', '.join(dx_exprs)}
+        FROM dx_long d JOIN dx_bits m ON m.code = d.code
+        GROUP BY d.row_idx
+    """)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE proc_features AS
+        SELECT p.row_idx, {', '.join(proc_exprs)}
+        FROM proc_long p JOIN proc_bits m ON m.code = p.code
+        GROUP BY p.row_idx
+    """)
+
+    # Procedure-window and same-day counts relative to an anchor set's first procedure
+    timing_exprs, timing_outer = [], []
+    for name, (proc_set, anchor, low, high) in psi_rules.WINDOW_FEATURES.items():
+        timing_exprs.append(f"bool_or({_has_bit(proc_layout, proc_set, 'm.M_{}')} AND floor_div(p.minute - f.PR_{anchor}_FIRST, {MINUTES_PER_DAY}) "
+                            f"BETWEEN {low} AND {high}) AS {name}")
+        timing_outer.append(f"COALESCE(w.{name}, FALSE) AS {name}")
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE window_features AS
+        SELECT p.row_idx, {', '.join(timing_exprs)}
+        FROM proc_long p JOIN proc_bits m ON m.code = p.code
+        JOIN proc_features f ON f.row_idx = p.row_idx
+        WHERE p.minute IS NOT NULL
+        GROUP BY p.row_idx
+    """)
+    count_exprs = [f"count(*) FILTER (WHERE floor_div(p.minute, {MINUTES_PER_DAY}) = floor_div(f.PR_{anchor}_FIRST, {MINUTES_PER_DAY})) AS {name}"
+                   for name, anchor in psi_rules.DAY_COUNT_FEATURES.items()]
+    timing_outer += [f"COALESCE(dc.{name}, 0) AS {name}" for name in psi_rules.DAY_COUNT_FEATURES]
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE day_count_features AS
+        SELECT p.row_idx, {', '.join(count_exprs)}
+        FROM proc_long p JOIN proc_features f ON f.row_idx = p.row_idx
+        WHERE p.minute IS NOT NULL
+        GROUP BY p.row_idx
+    """)
+
+    base = _base_features(cols)
+    drg_exprs = [f"COALESCE(MS_DRG_STR IN (SELECT code FROM code_sets WHERE set_name = '{s}'), FALSE) AS MSDRG_{s}"
+                 for s in sorted(drg_sets)]
+    derived = [f"{expr} AS {name}" for name, expr in psi_rules.compile_derived_features(validate_timing)]
+    derived += psi15_organ_features()
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE features AS
+        SELECT *,
+            CASE WHEN HAS_ADMIT_DATE AND PR_ORPROC_FIRST IS NOT NULL
+                 THEN floor_div(PR_ORPROC_FIRST - ADMIT_MINUTE, {MINUTES_PER_DAY}) END AS ADMIT_TO_FIRST_OR_DAYS,
+            {', '.join(drg_exprs) + ',' if drg_exprs else ''}
+            {', '.join(derived)}
+        FROM (
+            SELECT e.row_idx,
+                {', '.join(f'{expr} AS {name}' for name, expr in base.items())},
+                {', '.join(dx_outer + proc_outer + timing_outer)}
+            FROM encounters e
+            LEFT JOIN dx_features dx ON dx.row_idx = e.row_idx
+            LEFT JOIN proc_features pr ON pr.row_idx = e.row_idx
+            LEFT JOIN window_features w ON w.row_idx = e.row_idx
+            LEFT JOIN day_count_features dc ON dc.row_idx = e.row_idx
+        )
+    """)
+
+
+def psi15_organ_features():
+    """PSI15_QUALIFYING_LIST (LIST) and PSI15_ORGAN_ANALYSIS (LIST of STRUCT), see psi_rules.PSI15_ORGAN_FEATURES."""
+    qualifying = [f"CASE WHEN {qualifies} THEN {psi_rules.sql_str(organ)} END" for organ, qualifies, _ in psi_rules.PSI15_ORGAN_FEATURES]
+    analysis = [f"struct_pack(organ := {psi_rules.sql_str(organ)}, {', '.join(f'{field} := {expr}' for field, expr in flags.items())})"
+                for organ, _, flags in psi_rules.PSI15_ORGAN_FEATURES]
+    return [f"list_filter([{', '.join(qualifying)}], x -> x IS NOT NULL) AS PSI15_QUALIFYING_LIST",
+            f"[{', '.join(analysis)}] AS PSI15_ORGAN_ANALYSIS"]
+
+
+# --- Scoring ---
+def psi_query(psi, validate_timing=True):
+    """SELECT producing the result table of one PSI (Reason and typed Param_ columns) from the feature table."""
+    compiled = psi_rules.compile_psi(psi, validate_timing)
+    outputs = [f"OUT_EncounterID AS EncounterID", f"'{psi}' AS PSI", f"{compiled['Status']} AS Status"]
+    outputs += [f"{compiled[c]} AS {c}" if c in compiled else f"CAST(NULL AS VARCHAR) AS {c}" for c in psi_rules.reason_columns(psi)]
+    outputs += ["OUT_Age AS Age", "OUT_MS_DRG AS MS_DRG",
+               "OUT_PrincipalDX AS PrincipalDX", "OUT_ATYPE AS ATYPE", "OUT_Length_of_Stay AS Length_of_Stay"]
+    outputs += [f"{expr} AS {name}" for name, expr in compiled.items() if name.startswith("Detail_")]
+    return f"SELECT {', '.join(outputs)} FROM features ORDER BY row_idx"
+
+def funnel_query(psi, dimensions, cols, validate_timing=True):
+    """
+    Encounters per Reason of one PSI (and per value of the `dimensions` input columns):
+    a GROUP BY on the Reason CASE alone, without the result's other columns.
+    """
+    reason = psi_rules.compile_psi(psi, validate_timing)["Reason"]
+    outputs = [f"e.{_q(d)} AS dim_{i}" if cols.has(d) else f"NULL AS dim_{i}" for i, d in enumerate(dimensions)]
+    outputs += ["f.Reason", "count(*) AS Encounters"]
+    join = " JOIN encounters e USING (row_idx)" if dimensions else ""
+    return f"SELECT {', '.join(outputs)} FROM (SELECT row_idx, {reason} AS Reason FROM features) f{join} GROUP BY ALL"
+
+def text_query(con, psi, query):
+    """
+    SELECT of `query`'s results in text form. The result is materialized once; the Rationale
+    of each distinct reason and parameters is rendered (psi_rules.render_rationale) and joined
+    back after Reason, in place of the Param_ columns.
+    """
+    columns = psi_rules.reason_columns(psi)
+    con.execute(f"CREATE OR REPLACE TEMP TABLE psi_results AS {query}")
+    con.execute(f"CREATE OR REPLACE TEMP TABLE psi_reasons AS "
+                f"SELECT row_number() OVER () AS reason_key, * FROM (SELECT DISTINCT {', '.join(columns)} FROM psi_results)")
+    reasons = con.execute("SELECT * FROM psi_reasons").df()
+    rendered = psi_rules.render_rationale(psi, psi_rules.apply_reason_dtypes(psi, reasons.drop(columns="reason_key")))
+    con.register("psi_rationales", pd.DataFrame({"reason_key": reasons["reason_key"], "Rationale": rendered}))
+    outputs = []
+    for (name,) in con.execute("SELECT column_name FROM (DESCRIBE psi_results)").fetchall():
+        if name not in columns[1:]:
+            outputs.append(f"r.{name}")
+        if name == "Reason":
+            outputs.append("t.Rationale")
+    matches = " AND ".join(f"r.{c} IS NOT DISTINCT FROM k.{c}" for c in columns)
+    return (f"SELECT {', '.join(outputs)} FROM psi_results r JOIN psi_reasons k ON {matches} "
+            f"JOIN psi_rationales t ON t.reason_key = k.reason_key ORDER BY r.rowid")
+
+def text_details_query(psi, query):
+    """
+    SELECT of `query`'s results with the list Detail_ columns rendered as text the way
+    str() renders the pandas engine's values (CSV output, which has no list type).
+    """
+    flags = " || ', ' || ".join(f"'''{field}'': ' || CASE WHEN o.{field} THEN 'True' ELSE 'False' END"
+                                for field in psi_rules.ORGAN_ANALYSIS_FIELDS)
+    rendered = {
+        "codes": "'[' || array_to_string(list_transform({0}, c -> '''' || c || ''''), ', ') || ']'",
+        "organs": "'{{' || array_to_string(list_transform({0}, o -> '''' || o.organ || ''': {{' || " + flags + " || '}}'), ', ') || '}}'",
+    }
+    replaced = [f"{rendered[kind].format(column)} AS {column}" for column, kind in psi_rules.detail_kinds(psi).items()
+                if kind in rendered]
+    return f"SELECT * REPLACE ({', '.join(replaced)}) FROM ({query})" if replaced else query
+
+def _finish(df):
+    """Drops Detail_ columns no encounter has a value for (the pandas engine never creates them)."""
+    empty = [c for c in df.columns if c.startswith("Detail_") and df[c].isna().all()]
+    return df.drop(columns=empty)
+
+def prepare_input(con, source, cache_dir=DEFAULT_CACHE_DIR):
+    """Registers the input and builds the long dx/proc tables, which do not depend on the appendix. Returns its Columns."""
+    cols = Columns(register_input(con, source, cache_dir))
+    build_dx_long(con, cols)
+    build_proc_long(con, cols)
+    return cols
+
+def prepare_code_sets(con, cols, code_sets, psis, validate_timing=True):
+    """Registers one appendix (code sets and membership words) and builds the feature table from the long tables."""
+    dx_scopes, _, proc_sets, drg_sets = psi_rules.required_code_set_features(psi_rules.referenced_features(psis, validate_timing))
+    register_code_sets(con, code_sets, drg_sets)
+    dx_layout, proc_layout = psi_rules.membership_layouts(dx_scopes, proc_sets)
+    register_membership(con, code_sets, dx_layout, "dx_bits")
+    register_membership(con, code_sets, proc_layout, "proc_bits")
+    build_feature_table(con, cols, validate_timing, psis)
+
+def prepare(con, source, code_sets, psis=None, validate_timing=True, cache_dir=DEFAULT_CACHE_DIR):
+    """Registers the input and appendix and builds the long and feature tables. Returns the number of encounters."""
+    psis = list(psis or PSI_LIST)
+    cols = prepare_input(con, source, cache_dir)
+    prepare_code_sets(con, cols, code_sets, psis, validate_timing)
+    return con.execute("SELECT count(*) FROM encounters").fetchone()[0]
+
+def _query_results(con, psis, validate_timing, reasons, details, progress, cols=None, funnel=None):
+    """
+    {psi: DataFrame} from the current feature table; progress() is called after each PSI.
+    The native Detail_ values become the typed or the text form (psi_rules.type_details /
+    text_details). `funnel` (a psi_funnel.FunnelCounter) gets each PSI's funnel_query() counts.
+    """
+    results = {}
+    for psi in psis:
+        if funnel is not None:
+            funnel.add_grouped(psi, con.execute(funnel_query(psi, funnel.dimensions, cols, validate_timing)).df())
+        frame = _finish(con.execute(psi_query(psi, validate_timing)).df())
+        frame = psi_rules.type_details(psi, frame) if details == "typed" else psi_rules.text_details(psi, frame)
+        results[psi] = psi_rules.apply_reason_dtypes(psi, frame)
+        if reasons == "text":
+            results[psi] = psi_rules.decode_reasons(psi, results[psi])
+        progress()
+    return results
+
+def score(source, code_sets, psis=None, validate_timing=True, threads=None, cache_dir=DEFAULT_CACHE_DIR,
+          progress_callback=None, reasons="text", details="text"):
+    """
+    Scores a DataFrame or input file with DuckDB.
+    Returns {psi: DataFrame} with the columns of psi_engine.score_dataframe's records
+    (with reasons="codes", the compact Param_ columns instead of Rationale; with
+    details="typed", the typed Detail_ columns).
+    `progress_callback(done, total)` is called after each PSI if given.
+    """
+    return score_versions(source, {None: code_sets}, psis, validate_timing, threads, cache_dir, progress_callback, reasons,
+                          details)[None]
+
+def score_versions(source, versions, psis=None, validate_timing=True, threads=None, cache_dir=DEFAULT_CACHE_DIR,
+                   progress_callback=None, reasons="text", details="text", funnels=None):
+    """
+    score() against several appendix versions ({label: code_sets}). The input is read and
+    unpivoted into the long tables once; only the code set tables, feature table and rule
+    queries are rebuilt per version. Returns {label: {psi: DataFrame}}. `funnels`
+    ({label: psi_funnel.FunnelCounter}) are counted from each version's feature table.
+    """
+    psis = list(psis or PSI_LIST)
+    con = connect(threads)
+    done, total = 0, len(psis) * len(versions)
+
+    def progress():
+        nonlocal done
+        done += 1
+        if progress_callback:
+            progress_callback(done, total)
+
+    try:
+        cols = prepare_input(con, source, cache_dir)
+        results = {}
+        for label, code_sets in versions.items():
+            prepare_code_sets(con, cols, code_sets, psis, validate_timing)
+            results[label] = _query_results(con, psis, validate_timing, reasons, details, progress, cols,
+                                            (funnels or {}).get(label))
+        return results
+    finally:
+        con.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score PSI 05-15 with the in-process DuckDB backend")
+    parser.add_argument("--input", required=True, help="Encounters (.xlsx, .csv or .parquet)")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--output-dir", required=True, help="Directory for <PSI>.parquet (or .csv) result files")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--threads", type=int, help="DuckDB threads (default: all cores)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Where converted Excel inputs are cached")
+    parser.add_argument("--reasons", choices=psi_rules.REASON_FORMATS, default="text",
+                        help="Reason codes with the Rationale text, or with typed parameters (compact)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    validate_timing = not args.no_timing_validation
+
+    started = time.time()
+    code_sets = load_code_sets(args.appendix)
+    con = connect(args.threads)
+    encounters = prepare(con, args.input, code_sets, psis, validate_timing, args.cache_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary = {"encounters": encounters, "psis": {}}
+    for psi in psis:
+        path = os.path.join(args.output_dir, f"{psi}.{args.format}").replace("'", "''")
+        options = "FORMAT PARQUET" if args.format == "parquet" else "FORMAT CSV, HEADER"
+        # Written straight from DuckDB; empty Detail_ columns are kept so every file of a PSI has the same schema.
+        # Parquet keeps the native list/struct details; CSV gets their text
+        query = psi_query(psi, validate_timing)
+        if args.format == "csv":
+            query = text_details_query(psi, query)
+        if args.reasons == "text":
+            query = text_query(con, psi, query)
+        con.execute(f"COPY ({query}) TO '{path}' ({options})")
+        scan = f"read_parquet('{path}')" if args.format == "parquet" else f"read_csv_auto('{path}')"
+        summary["psis"][psi] = dict(con.execute(f"SELECT Status, count(*) FROM {scan} GROUP BY Status").fetchall())
+    con.close()
+    summary["seconds"] = round(time.time() - started, 2)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
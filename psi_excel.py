@@ -0,0 +1,347 @@
+"""
+Fast reader for encounter and appendix workbooks (.xlsx).
+
+pd.read_excel() builds an openpyxl cell object for every cell of the sheet, converts each
+one in Python and then infers every column's type, so wide discharge extracts with many
+unrelated columns take tens of seconds. This reader:
+- projects: only the columns the scoring engines read (input_columns(): DX/POA, procedure
+  codes with their dates and times, demographics, DRG/MDC/ATYPE, YEAR/DQTR, dates and length
+  of stay) plus any extra columns asked for (e.g. Facility). The sheet XML is scanned with one
+  regular expression that only matches cells of those columns, so the others are skipped
+  without ever becoming Python objects;
+- types by plan (dtype_plan()): codes are text (a code stored as a number keeps its digits,
+  where pandas would make 4019 and a blank 4019.0), counts and categories are numeric where
+  every value is a number, and everything else is inferred as pd.read_excel() would;
+- reports the load time and rows per second (read_input_excel()).
+
+Numbers, dates (by cell style), shared and inline strings, booleans and errors are converted
+as openpyxl and pandas convert them, so apart from the text plan the frame is the one
+pd.read_excel() returns for those columns. Workbooks whose XML does not have the usual
+layout (and .xls files) are read with pd.read_excel(usecols=...) and the same plan.
+
+    python psi_excel.py --input encounters.xlsx            # load report (rows/s) for the input
+    python psi_excel.py --input encounters.xlsx --compare  # also time pd.read_excel() and check the frames match
+"""
+import io
+import re
+import sys
+import html
+import json
+import time
+import zipfile
+import logging
+import argparse
+import posixpath
+
+import pandas as pd
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.datetime import from_excel, CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900
+
+import psi_engine
+
+logger = logging.getLogger(__name__)
+
+TEXT, NUMBER, AUTO = "text", "number", "auto"
+# Strings pandas reads as missing by default (read_excel / read_csv na_values)
+NA_STRINGS = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                        "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+
+# --- Column projection and dtype plan ---
+# Every PSI reads the same input fields (the common steps need the diagnoses, demographics and
+# DRG; the procedure features feed the OR, chemotherapy and radiation rules of all of them),
+# so the projection is the engines' field set rather than a per-PSI list.
+CODE_COLUMN = re.compile(r"DX\d+|POA\d+|Pdx|Sdx\d+|POA_Sdx\d+|Proc\d+")
+PROC_DETAIL_COLUMN = re.compile(r"Proc\d+_(Date|Time)")
+NUMBER_COLUMNS = {"Age", "DQTR", "YEAR", "MDC", "ATYPE", "DRG", "MS-DRG", "length_of_stay", "Length_of_stay"}
+FIELD_COLUMNS = ({alias for aliases, _ in psi_engine.FIELD_ALIASES.values() for alias in aliases}
+                 | NUMBER_COLUMNS | set(psi_engine.REQUIRED_FIELDS.values()) - {"PrincipalDX"})
+
+def input_columns(header, extra=()):
+    """The columns of `header` the scoring engines read, plus `extra` ones present, in file order."""
+    extra = set(extra)
+    return [c for c in header if isinstance(c, str) and (
+        c in FIELD_COLUMNS or c in extra or CODE_COLUMN.fullmatch(c) or PROC_DETAIL_COLUMN.fullmatch(c))]
+
+def dtype_plan(columns):
+    """
+    {column: TEXT | NUMBER | AUTO}: codes as text (the engines compare them as strings, and a
+    numeric code column with blanks would otherwise read 4019 as 4019.0), counts and
+    categories numeric, the rest inferred.
+    """
+    plan = {}
+    for column in columns:
+        if isinstance(column, str) and CODE_COLUMN.fullmatch(column):
+            plan[column] = TEXT
+        elif column in NUMBER_COLUMNS:
+            plan[column] = NUMBER
+        else:
+            plan[column] = AUTO
+    return plan
+
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+def _typed_column(values, kind):
+    """A column from the cell values, converted by `kind` (see dtype_plan)."""
+    values = [None if v is None or (isinstance(v, str) and v in NA_STRINGS) else v for v in values]
+    if kind == TEXT:
+        return pd.Series([_as_text(v) for v in values]) if any(v is not None for v in values) else pd.Series(values, dtype=float)
+    if any(v is not None for v in values) and all(
+            v is None or (isinstance(v, (int, float, str)) and not isinstance(v, bool)) for v in values):
+        try:
+            # pd.read_excel() turns a column of numbers (and numeric text) into int64, or float64 with blanks
+            return pd.to_numeric(pd.Series(values, dtype=object))
+        except (ValueError, TypeError):
+            pass
+    if not any(v is not None for v in values):
+        return pd.Series(values, dtype=float)
+    return pd.Series(values)
+
+def apply_plan(df, plan):
+    """Converts the columns of a frame read as plain cell values by `plan` (a {column: kind} dict or one kind for all)."""
+    kinds = plan if isinstance(plan, dict) else dict.fromkeys(df.columns, plan)
+    return pd.DataFrame({c: _typed_column(df[c].tolist(), kinds.get(c, AUTO)) for c in df.columns}, index=df.index)
+
+
+# --- Workbook parts ---
+_NUMBER_VALUE = re.compile(rb"<v>(.*?)</v>", re.S)
+_TEXT_RUN = re.compile(rb"<t(?:\s[^>]*)?>(.*?)</t>", re.S)
+_PHONETIC = re.compile(rb"<rPh\b.*?</rPh>", re.S)
+
+def _text(raw):
+    text = raw.decode("utf-8")
+    return html.unescape(text) if "&" in text else text
+
+def _string_item(raw):
+    """Plain text of a shared or inline string (rich text runs joined, phonetic hints dropped)."""
+    if b"<rPh" in raw:
+        raw = _PHONETIC.sub(b"", raw)
+    return "".join(_text(t) for t in _TEXT_RUN.findall(raw))
+
+def _shared_strings(book, names):
+    if "xl/sharedStrings.xml" not in names:
+        return []
+    return [_string_item(item) for item in re.findall(rb"<si>(.*?)</si>|<si/>", book.read("xl/sharedStrings.xml"), re.S)]
+
+def _date_styles(book, names):
+    """(style indexes formatted as dates, style indexes formatted as durations) from styles.xml."""
+    if "xl/styles.xml" not in names:
+        return set(), set()
+    styles = book.read("xl/styles.xml")
+    formats = dict(BUILTIN_FORMATS)
+    for number, code in re.findall(rb'<numFmt\s[^>]*?numFmtId="(\d+)"[^>]*?formatCode="([^"]*)"', styles):
+        formats[int(number)] = html.unescape(code.decode("utf-8"))
+    cell_xfs = re.search(rb"<cellXfs\b[^>]*>(.*?)</cellXfs>", styles, re.S)
+    dates, durations = set(), set()
+    for index, xf in enumerate(re.findall(rb"<xf\b([^>]*)", cell_xfs.group(1)) if cell_xfs else []):
+        number = re.search(rb'numFmtId="(\d+)"', xf)
+        code = formats.get(int(number.group(1))) if number else None
+        if code and is_date_format(code):
+            dates.add(index)
+            if is_timedelta_format(code):
+                durations.add(index)
+    return dates, durations
+
+def _first_sheet(book, names):
+    """(sheet XML path, epoch) of the workbook's first sheet."""
+    workbook = book.read("xl/workbook.xml")
+    epoch = CALENDAR_MAC_1904 if re.search(rb'date1904="(1|true)"', workbook) else CALENDAR_WINDOWS_1900
+    sheet = re.search(rb"<sheet\b[^>]*?\br:id=\"([^\"]+)\"", workbook) or re.search(rb"<sheet\b[^>]*?\bid=\"([^\"]+)\"", workbook)
+    rels = book.read("xl/_rels/workbook.xml.rels")
+    for rel in re.findall(rb"<Relationship\b[^>]*>", rels):
+        if sheet and re.search(rb'\bId="' + re.escape(sheet.group(1)) + rb'"', rel):
+            target = re.search(rb'Target="([^"]+)"', rel).group(1).decode("utf-8")
+            path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            if path in names:
+                return path, epoch
+    return None, epoch
+
+
+class _Unsupported(Exception):
+    """The sheet XML does not have the layout the scanner expects (read with pandas instead)."""
+
+
+class _SheetScanner:
+    """Cell values of the projected columns of one sheet, scanned from its XML."""
+
+    def __init__(self, book, names):
+        self.path, self.epoch = _first_sheet(book, names)
+        if self.path is None:
+            raise _Unsupported("first sheet not found")
+        self.xml = book.read(self.path)
+        start, end = self.xml.find(b"<sheetData"), self.xml.rfind(b"</sheetData>")
+        if start < 0:
+            raise _Unsupported("no sheetData (prefixed or empty sheet)")
+        self.data = self.xml[start:end if end > 0 else len(self.xml)]
+        # Every cell and row must carry its reference first: the scan matches on it
+        if self.data.count(b"<c ") != self.data.count(b'<c r="') or self.data.count(b"<row ") != self.data.count(b'<row r="'):
+            raise _Unsupported("cells without references")
+        self.shared = _shared_strings(book, names)
+        self.dates, self.durations = _date_styles(book, names)
+
+    def _value(self, kind, style, inner):
+        """A cell's value as openpyxl (data_only) and pandas convert it; None when empty."""
+        if kind == b"inlineStr":
+            return _string_item(inner) if inner else None
+        if not inner:
+            return None
+        raw = inner[3:-4] if inner.startswith(b"<v>") and inner.endswith(b"</v>") else (
+            (_NUMBER_VALUE.search(inner) or [None, None])[1])
+        if not raw:
+            return None
+        if kind is None or kind == b"n":
+            number = float(raw) if (b"." in raw or b"E" in raw or b"e" in raw) else int(raw)
+            if style in self.dates:
+                try:
+                    return from_excel(number, self.epoch, timedelta=style in self.durations)
+                except (OverflowError, ValueError):
+                    return None
+            return int(number) if number == int(number) else number
+        if kind == b"s":
+            return self.shared[int(raw)]
+        if kind == b"str":
+            return _text(raw)
+        if kind == b"b":
+            return bool(int(raw))
+        if kind == b"e":
+            return None # pandas reads error cells as NaN
+        if kind == b"d":
+            return pd.Timestamp(_text(raw)).to_pydatetime()
+        return _text(raw)
+
+    def header(self):
+        """{column letters: name} of the first row."""
+        first = re.search(rb'<row r="1"[^>]*>(.*?)</row>', self.data, re.S)
+        if not first:
+            raise _Unsupported("no header row")
+        names = {}
+        for letters, _, attrs, inner in re.findall(rb'<c r="([A-Z]+)(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', first.group(1), re.S):
+            value = self._value(*self._attrs(attrs), inner)
+            if value is not None:
+                names[letters.decode()] = value
+        return names
+
+    @staticmethod
+    def _attrs(attrs):
+        kind = re.search(rb'\bt="(\w+)"', attrs) if b"t=" in attrs else None
+        style = re.search(rb'\bs="(\d+)"', attrs) if b"s=" in attrs else None
+        return (kind.group(1) if kind else None), (int(style.group(1)) if style else 0)
+
+    def last_row(self):
+        """Number of the last row holding a value (pandas drops the empty rows after it)."""
+        last = max(self.data.rfind(b"<v>"), self.data.rfind(b"<is>"))
+        if last < 0:
+            return 1
+        row = self.data.rfind(b'<row r="', 0, last)
+        return int(re.match(rb'<row r="(\d+)"', self.data[row:row + 30]).group(1))
+
+    def columns(self, letters):
+        """{column letters: [value per data row]} for the given columns (rows 2 to last_row())."""
+        rows = self.last_row() - 1
+        values = {column: [None] * rows for column in letters}
+        if not letters or rows <= 0:
+            return values
+        # Longest letters first, so AB is not matched as A; the row number must follow directly
+        alternatives = b"|".join(l.encode() for l in sorted(letters, key=len, reverse=True))
+        cell = re.compile(rb'<c r="(' + alternatives + rb')(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+        # Codes, flags and dates repeat down a column: each distinct cell markup is converted once
+        converted = {}
+        columns = {letter.encode(): values[letter] for letter in letters}
+        for letter, row, attrs, inner in cell.findall(self.data):
+            index = int(row) - 2
+            if inner and 0 <= index < rows:
+                key = (attrs, inner)
+                if key not in converted:
+                    converted[key] = self._value(*self._attrs(attrs), inner)
+                columns[letter][index] = converted[key]
+        return values
+
+
+# --- Reading ---
+def read_excel(source, columns=None, plan=None, return_engine=False):
+    """
+    Reads the first sheet of an .xlsx workbook (a path, bytes or a binary file). `columns`
+    is a list of column names or a callable taking the header and returning one (all
+    columns if None); `plan` maps columns to TEXT / NUMBER / AUTO (default dtype_plan()).
+    Columns that are not in the workbook are left out.
+    """
+    data = source if isinstance(source, bytes) else source.read() if hasattr(source, "read") else None
+    if data is None:
+        with open(source, "rb") as f:
+            data = f.read()
+    engine = "scan"
+    try:
+        if not zipfile.is_zipfile(io.BytesIO(data)):
+            raise _Unsupported("not an .xlsx workbook")
+        with zipfile.ZipFile(io.BytesIO(data)) as book:
+            scanner = _SheetScanner(book, set(book.namelist()))
+            names = scanner.header()
+            header = list(dict.fromkeys(names.values())) # pandas renames later duplicates (X.1), which are not read
+            selected = header if columns is None else columns(header) if callable(columns) else [c for c in columns if c in header]
+            letters = {}
+            for letter, name in sorted(names.items(), key=lambda item: column_index_from_string(item[0])):
+                if name in selected and name not in letters.values():
+                    letters[letter] = name
+            values = scanner.columns(list(letters))
+            frame = pd.DataFrame({name: values[letter] for letter, name in letters.items()}, dtype=object)
+            frame = frame[[c for c in selected if c in frame.columns]]
+    except (_Unsupported, KeyError, zipfile.BadZipFile) as e:
+        logger.info("Reading the workbook with pandas (%s)", e)
+        engine = "pandas"
+        header = list(pd.read_excel(io.BytesIO(data), nrows=0).columns)
+        selected = header if columns is None else columns(header) if callable(columns) else [c for c in columns if c in header]
+        frame = pd.read_excel(io.BytesIO(data), usecols=selected, dtype=object)[selected]
+        frame = frame.astype(object).where(frame.notna(), None)
+    plan = dtype_plan(frame.columns) if plan is None else plan
+    frame = apply_plan(frame, plan)
+    return (frame, engine) if return_engine else frame
+
+def read_input_excel(source, extra_columns=()):
+    """
+    Reads the encounter columns the engines use (input_columns(), plus `extra_columns` such
+    as a facility column) from an input workbook. Returns (DataFrame, load report dict).
+    """
+    started = time.perf_counter()
+    header = []
+    def project(columns):
+        header.extend(columns)
+        return input_columns(columns, extra_columns)
+    df, engine = read_excel(source, project, return_engine=True)
+    seconds = time.perf_counter() - started
+    report = {"engine": engine, "rows": len(df), "columns_read": len(df.columns), "columns_in_file": len(header),
+              "seconds": round(seconds, 3), "rows_per_second": round(len(df) / seconds) if seconds > 0 else None}
+    logger.info("Loaded %d encounters (%d of %d columns) in %.2f s (%s rows/s)", report["rows"], report["columns_read"],
+                report["columns_in_file"], seconds, report["rows_per_second"])
+    return df, report
+
+def read_appendix_excel(source):
+    """An appendix workbook, every column read as code text (a code list column of numbers keeps its digits)."""
+    return read_excel(source, plan=TEXT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load an encounter workbook with the fast Excel reader")
+    parser.add_argument("--input", required=True, help="Encounter workbook (.xlsx)")
+    parser.add_argument("--extra-columns", default="", help="Comma-separated columns to read besides the engine's (e.g. Facility)")
+    parser.add_argument("--compare", action="store_true", help="Also time pd.read_excel() and compare the frames")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    df, report = read_input_excel(args.input, [c.strip() for c in args.extra_columns.split(",") if c.strip()])
+    if args.compare:
+        started = time.perf_counter()
+        reference = pd.read_excel(args.input)
+        report["pandas_seconds"] = round(time.perf_counter() - started, 3)
+        reference = reference[list(df.columns)]
+        differing = [c for c in df.columns if not df[c].equals(reference[c])]
+        report["speedup"] = round(report["pandas_seconds"] / report["seconds"], 1) if report["seconds"] else None
+        report["columns_differing"] = differing # Expected only for codes stored as numbers (read as text here)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+Exclusion funnel: how many encounters each PSI loses at each of its named steps.
+
+Every PSI decides an encounter at the first step of its rule table (psi_rules) that
+applies: the common data quality, MDC 14/15 and age steps, then its population and
+PSI-specific exclusions, then the numerator outcomes. The deciding step is the result's
+Reason code, so the funnel is a count per Reason, taken while the engines score: the
+pandas engine increments the counter as each encounter is decided, and the DuckDB and
+Polars backends GROUP BY their Reason expression.
+
+FunnelCounter holds those counts, optionally per facility or discharge quarter; counters
+of separate chunks merge (JobManager's workers return one per chunk, and the job's funnel
+grows as they finish). funnel_table() lays them out in rule order with the encounters
+remaining after each step.
+
+    python psi_funnel.py --input encounters.xlsx --appendix PSI_Appendix.xlsx --by YEAR,DQTR --output funnel.csv
+"""
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+STAGE_COMMON = "Common"
+STAGE_EXCLUSION = "Exclusion"
+STAGE_DENOMINATOR = "Denominator"
+STAGE_OUTCOME = "Outcome"
+DENOMINATOR_STEP = "DENOMINATOR" # Encounters left after every exclusion step
+FUNNEL_COLUMNS = ["PSI", "Order", "Stage", "Step", "Description", "Status", "Encounters", "Remaining", "Percent_Remaining"]
+FUNNEL_BY = {"quarter": ["YEAR", "DQTR"], "year": ["YEAR"], "facility": ["Facility"]} # Shorthands for --by
+
+
+def funnel_steps(psi):
+    """[(stage, code, message, status)] of `psi` in decision order: steps, then numerator outcomes."""
+    rules = psi_rules.PSI_RULES[psi]
+    fill = psi_rules.fill_parameters
+    return ([(STAGE_COMMON, s.code, fill(s.message), "Exclusion") for s in psi_rules.COMMON_STEPS]
+            + [(STAGE_EXCLUSION, s.code, fill(s.message), "Exclusion") for s in rules.steps]
+            + [(STAGE_OUTCOME, o.code, fill(o.message), o.status) for o in rules.outcomes])
+
+def _label(value):
+    # Numeric columns read from Excel come back as floats (2024.0); the label keeps the integer
+    return "" if pd.isna(value) else re.sub(r"\.0$", "", str(value))
+
+def group_codes(df, dimensions):
+    """
+    (group number per encounter, [group value tuples]) for the `dimensions` columns of `df`,
+    as text ('' where missing or the column is absent). Columns are factorized, so only
+    their distinct values are formatted.
+    """
+    codes = np.zeros(len(df), dtype=np.int64)
+    labels = [()]
+    for column in dimensions:
+        if column in df.columns:
+            column_codes, uniques = pd.factorize(df[column], use_na_sentinel=False)
+            column_labels = [_label(v) for v in uniques]
+        else:
+            column_codes, column_labels = np.zeros(len(df), dtype=np.int64), [""]
+        codes = codes * len(column_labels) + column_codes
+        labels = [group + (label,) for group in labels for label in column_labels]
+    return codes, labels
+
+
+class FunnelCounter:
+    """
+    Encounter counts per PSI, group (values of `dimensions`, e.g. YEAR and DQTR) and
+    deciding Reason code. Counts add up, so chunks can be counted in any order.
+    """
+
+    def __init__(self, dimensions=()):
+        self.dimensions = list(dimensions)
+        self.counts = {} # (psi, *group values, reason code) -> encounters
+
+    def row_groups(self, df):
+        """The group (tuple of dimension labels) of every row of `df`, in row order."""
+        if not self.dimensions:
+            return [()] * len(df)
+        codes, labels = group_codes(df, self.dimensions)
+        return [labels[code] for code in codes]
+
+    def count(self, psi, reason, group=()):
+        """Counts one encounter of `group` (see row_groups) that `psi` decided with `reason`."""
+        key = (psi,) + group + (reason,)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def add_grouped(self, psi, grouped):
+        """
+        Adds counts an engine grouped itself: each row of `grouped` holds the dimension
+        values (in order), the Reason code and the number of encounters.
+        """
+        for values in grouped.itertuples(index=False):
+            key = (psi,) + tuple(_label(v) for v in values[:-2]) + (str(values[-2]),)
+            self.counts[key] = self.counts.get(key, 0) + int(values[-1])
+
+    def merge(self, other):
+        """Adds the counts of another counter with the same dimensions."""
+        if other.dimensions != self.dimensions:
+            raise ValueError(f"Cannot merge funnels by {other.dimensions} into funnels by {self.dimensions}")
+        for key, n in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+        return self
+
+    def to_records(self):
+        """JSON-serializable counts (e.g. for a job status)."""
+        names = ["PSI"] + self.dimensions + ["Reason"]
+        return [dict(zip(names, key), Encounters=n) for key, n in sorted(self.counts.items())]
+
+    @classmethod
+    def from_records(cls, records, dimensions=()):
+        counter = cls(dimensions)
+        names = ["PSI"] + counter.dimensions + ["Reason"]
+        for record in records:
+            key = tuple(record[name] for name in names)
+            counter.counts[key] = counter.counts.get(key, 0) + record["Encounters"]
+        return counter
+
+    def table(self, psis=None):
+        """The funnel of every PSI (and group) counted, see funnel_table()."""
+        return funnel_table(self, psis)
+
+
+def funnel_table(counter, psis=None):
+    """
+    One row per PSI, group and step in decision order (FUNNEL_COLUMNS plus the grouping
+    columns). Exclusion steps show the encounters they removed and the encounters left;
+    the DENOMINATOR row is what reaches the numerator stage, which the outcome rows split
+    (Remaining then counts down to zero).
+    """
+    by_group = {}
+    for key, n in counter.counts.items():
+        psi, group, reason = key[0], key[1:-1], key[-1]
+        by_group.setdefault((psi, group), {})[reason] = n
+    order = {psi: i for i, psi in enumerate(PSI_LIST)}
+    rows = []
+    for (psi, group), counts in sorted(by_group.items(), key=lambda item: (order.get(item[0][0], len(order)), item[0])):
+        if psis and psi not in psis:
+            continue
+        total = sum(counts.values())
+        remaining = total
+        labels = dict(zip(counter.dimensions, group))
+
+        def row(position, stage, code, message, status, encounters):
+            return {"PSI": psi, **labels, "Order": position, "Stage": stage, "Step": code, "Description": message,
+                    "Status": status, "Encounters": encounters, "Remaining": remaining,
+                    "Percent_Remaining": round(remaining / total * 100, 2) if total else 0.0}
+
+        position = 0
+        for stage, code, message, status in funnel_steps(psi):
+            position += 1
+            if stage == STAGE_OUTCOME and rows[-1]["Stage"] != STAGE_OUTCOME:
+                rows.append(row(position, STAGE_DENOMINATOR, DENOMINATOR_STEP, "Encounters reaching the numerator stage", "", remaining))
+                position += 1
+            encounters = counts.get(code, 0)
+            remaining -= encounters
+            rows.append(row(position, stage, code, message, status, encounters))
+    columns = FUNNEL_COLUMNS[:1] + counter.dimensions + FUNNEL_COLUMNS[1:]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count the encounters each PSI 05-15 step excludes")
+    parser.add_argument("--input", required=True, help="Encounter file (.xlsx, .csv or .parquet)")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--backend", choices=psi_engine.BACKENDS, default="pandas")
+    parser.add_argument("--by", default="", help=f"Grouping columns, comma-separated, or one of {', '.join(FUNNEL_BY)}")
+    parser.add_argument("--output", help="Write the funnel table (.csv)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    dimensions = FUNNEL_BY.get(args.by) or [c.strip() for c in args.by.split(",") if c.strip()]
+
+    df = psi_engine.read_input_file(args.input)
+    code_sets = psi_engine.load_code_sets(args.appendix)
+    started = time.time()
+    counter = FunnelCounter(dimensions)
+    psi_engine.score_with_backend(df, psis, code_sets, validate_timing=not args.no_timing_validation,
+                                  backend=args.backend, reasons="codes", funnel=counter)
+    table = counter.table()
+    if args.output:
+        table.to_csv(args.output, index=False)
+    logger.info("Counted the funnel of %d PSIs over %d encounters", len(psis), len(df))
+    denominators = table[table["Step"] == DENOMINATOR_STEP].groupby("PSI")["Encounters"].sum()
+    print(json.dumps({"encounters": len(df), "seconds": round(time.time() - started, 2),
+                      "denominator": {psi: int(n) for psi, n in denominators.items()}}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+"""
+Historical result store: scoring runs append their results and aggregates to a local
+dataset partitioned by discharge year, quarter, PSI and appendix version, so rates can
+be followed across quarters without stitching downloads together.
+
+Layout under the history directory (Hive-style partition directories):
+    results/YEAR=<y>/DQTR=<q>/PSI=<psi>/VERSION=<v>/run-<run id>.parquet      encounter-level results
+    aggregates/YEAR=<y>/DQTR=<q>/PSI=<psi>/VERSION=<v>/run-<run id>.parquet   counts per facility
+    runs.jsonl                                                               one line per appended run
+
+The trend queries (trend(), facility_series()) only read the aggregate files of the
+partitions that match their filters; partition directories are pruned by name before
+anything is opened, and encounter-level data is never read.
+
+    python psi_history.py append --history-dir history/ --input 2024Q3.xlsx --appendix PSI_Appendix_v2024.xlsx \
+        --version v2024 --facility "General Hospital"
+    python psi_history.py trend --history-dir history/ --psis PSI_12,PSI_13 --from-year 2022
+    python psi_history.py facilities --history-dir history/ --psis PSI_12 --version v2024
+
+Each period's data should be appended once; drop_run() (or `drop --run-id`) removes a
+run so it can be appended again.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = "results"
+AGGREGATES_DIR = "aggregates"
+RUNS_FILE = "runs.jsonl"
+PARTITION_KEYS = ["YEAR", "DQTR", "PSI", "VERSION"]
+DEFAULT_FACILITY_COLUMN = "Facility"
+UNKNOWN_PARTITION = "unknown" # Partition value for a missing YEAR / DQTR / facility
+AGGREGATE_COLUMNS = ["Facility", "Encounters", "Denominator", "Numerator", "Run_ID"]
+TREND_COLUMNS = ["Encounters", "Denominator", "Numerator", "Rate_per_1000", "Observed_Rate"]
+
+
+# --- Partitions ---
+def partition_value(value):
+    """Directory-safe partition value: '2024.0' -> '2024', blanks -> UNKNOWN_PARTITION."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return UNKNOWN_PARTITION
+    text = re.sub(r"\.0$", "", str(value).strip())
+    text = re.sub(r"[^A-Za-z0-9._-]+", "_", text).strip("._")
+    return text or UNKNOWN_PARTITION
+
+def _column_values(df, column):
+    if column not in df.columns:
+        return pd.Series(UNKNOWN_PARTITION, index=df.index)
+    return df[column].map(partition_value)
+
+def _partition_dirs(base, filters):
+    """
+    Partition directories under `base` matching `filters` ({key: set of values or None}),
+    walking PARTITION_KEYS level by level so pruned directories are never listed.
+    """
+    dirs = [(base, {})]
+    for key in PARTITION_KEYS:
+        wanted = filters.get(key)
+        next_dirs = []
+        for path, values in dirs:
+            try:
+                entries = os.scandir(path)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    name, sep, value = entry.name.partition("=")
+                    if entry.is_dir() and sep and name == key and (not wanted or value in wanted):
+                        next_dirs.append((entry.path, dict(values, **{key: value})))
+        dirs = next_dirs
+    return dirs
+
+def _facility_values(df, facility_column, facility):
+    """Facility per encounter: the input's facility column, else `facility` (names are kept as text)."""
+    if facility_column in df.columns:
+        return df[facility_column].map(lambda v: UNKNOWN_PARTITION if pd.isna(v) or not str(v).strip() else str(v).strip())
+    return pd.Series(str(facility).strip() if facility else UNKNOWN_PARTITION, index=df.index)
+
+def _as_filter(values):
+    if values is None:
+        return None
+    if isinstance(values, (str, int)):
+        values = [values]
+    return {partition_value(v) for v in values}
+
+
+# --- Appending runs ---
+def _write_parquet(table_or_df, path, psi=None):
+    """Writes via a temporary file and a rename, so a query never reads half a partition file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    if psi is not None:
+        psi_engine.write_results_parquet(table_or_df, tmp_path, psi)
+    else:
+        table_or_df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def append_run(history_dir, df, results, version, run_id=None, facility=None,
+               facility_column=DEFAULT_FACILITY_COLUMN, source=None, store_results=True):
+    """
+    Appends one scoring run: `df` is the scored input and `results` {psi: results DataFrame
+    in df order}. Rows are partitioned by the input's YEAR and DQTR; the facility is the
+    input's `facility_column`, else `facility`. Returns the run's catalog entry.
+    """
+    os.makedirs(history_dir, exist_ok=True)
+    version = partition_value(version)
+    run_id = partition_value(run_id or f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}")
+    if run_id in {run["run_id"] for run in list_runs(history_dir)}:
+        raise ValueError(f"Run {run_id} is already in {history_dir}")
+    keys = pd.DataFrame({
+        "YEAR": _column_values(df, "YEAR").to_numpy(),
+        "DQTR": _column_values(df, "DQTR").to_numpy(),
+        "Facility": _facility_values(df, facility_column, facility).to_numpy(),
+    })
+    periods = set()
+    for psi, res in results.items():
+        if len(res) != len(df):
+            raise ValueError(f"{psi}: {len(res)} results for {len(df)} encounters")
+        frame = keys.assign(Numerator=res["Status"].eq("Inclusion").to_numpy(),
+                            Denominator=res["Reason"].astype(str).isin(set(psi_rules.outcome_codes(psi))).to_numpy())
+        for (year, quarter), rows in frame.groupby(["YEAR", "DQTR"]).indices.items():
+            periods.add((year, quarter))
+            partition = os.path.join(f"YEAR={year}", f"DQTR={quarter}", f"PSI={psi}", f"VERSION={version}")
+            if store_results:
+                part = res.iloc[rows].reset_index(drop=True)
+                part.insert(0, "Facility", frame["Facility"].iloc[rows].to_numpy())
+                _write_parquet(part, os.path.join(history_dir, RESULTS_DIR, partition, f"run-{run_id}.parquet"), psi)
+            counts = frame.iloc[rows].groupby("Facility", sort=True).agg(
+                Encounters=("Numerator", "size"), Denominator=("Denominator", "sum"), Numerator=("Numerator", "sum"))
+            counts = counts.reset_index().astype({"Encounters": "int64", "Denominator": "int64", "Numerator": "int64"})
+            counts["Run_ID"] = run_id
+            _write_parquet(counts[AGGREGATE_COLUMNS], os.path.join(history_dir, AGGREGATES_DIR, partition, f"run-{run_id}.parquet"))
+    run = {
+        "run_id": run_id, "version": version, "source": source, "encounters": len(df), "psis": list(results),
+        "periods": [f"{year} Q{quarter}" for year, quarter in sorted(periods)], "appended_at": time.time(),
+    }
+    with open(os.path.join(history_dir, RUNS_FILE), "a") as f:
+        f.write(json.dumps(run) + "\n")
+    return run
+
+def list_runs(history_dir):
+    """Catalog entries of the appended runs, oldest first."""
+    try:
+        with open(os.path.join(history_dir, RUNS_FILE)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def drop_run(history_dir, run_id):
+    """Removes every partition file of a run and its catalog entry. Returns the number of files removed."""
+    removed = 0
+    for base in (RESULTS_DIR, AGGREGATES_DIR):
+        for path, _ in _partition_dirs(os.path.join(history_dir, base), {}):
+            file_path = os.path.join(path, f"run-{run_id}.parquet")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                removed += 1
+    runs = [run for run in list_runs(history_dir) if run["run_id"] != run_id]
+    tmp_path = os.path.join(history_dir, RUNS_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.writelines(json.dumps(run) + "\n" for run in runs)
+    os.replace(tmp_path, os.path.join(history_dir, RUNS_FILE))
+    return removed
+
+
+# --- Trend queries ---
+def read_aggregates(history_dir, psis=None, versions=None, years=None, quarters=None, facilities=None):
+    """
+    Aggregate rows (AGGREGATE_COLUMNS plus the partition keys) of the partitions matching the
+    filters. Only the matching partitions' aggregate files are opened.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    filters = {"YEAR": _as_filter(years), "DQTR": _as_filter(quarters), "PSI": _as_filter(psis), "VERSION": _as_filter(versions)}
+    tables = []
+    for path, values in _partition_dirs(os.path.join(history_dir, AGGREGATES_DIR), filters):
+        for entry in os.scandir(path):
+            if entry.name.endswith(".parquet"):
+                # ParquetFile skips the dataset discovery of read_table(), which dominates for files this small
+                table = pq.ParquetFile(entry.path).read()
+                for key in PARTITION_KEYS:
+                    table = table.append_column(key, pa.array([values[key]] * table.num_rows, type=pa.string()))
+                tables.append(table)
+    if not tables:
+        return pd.DataFrame(columns=PARTITION_KEYS + AGGREGATE_COLUMNS)
+    df = pa.concat_tables(tables).to_pandas()
+    if facilities is not None:
+        df = df[df["Facility"].isin([facilities] if isinstance(facilities, str) else list(facilities))]
+    return df
+
+def _period_order(df, by):
+    """Sorts periods numerically where the partition values are numbers (2024 Q10 after Q9)."""
+    keys = ["YEAR"] + (["DQTR"] if by == "quarter" else [])
+    return df.sort_values([c for c in df.columns if c in ("PSI", "VERSION", "Facility")] + keys,
+                          key=lambda s: pd.to_numeric(s, errors="coerce").fillna(float("inf")) if s.name in keys else s,
+                          kind="stable").reset_index(drop=True)
+
+def _rates(df, group):
+    out = df.groupby(group, sort=False)[["Encounters", "Denominator", "Numerator"]].sum().reset_index()
+    out["Rate_per_1000"] = (out["Numerator"] / out["Encounters"].where(out["Encounters"] > 0) * 1000).round(2).fillna(0.0)
+    out["Observed_Rate"] = (out["Numerator"] / out["Denominator"].where(out["Denominator"] > 0)).round(6).fillna(0.0)
+    return out
+
+def trend(history_dir, psis=None, versions=None, years=None, quarters=None, facilities=None, by="quarter"):
+    """
+    Rates per period (by="quarter": YEAR and DQTR, by="year": YEAR), PSI and appendix version,
+    summed over every appended run and facility (or only `facilities`).
+    """
+    if by not in ("quarter", "year"):
+        raise ValueError(f"Unknown trend period: {by} (expected quarter or year)")
+    df = read_aggregates(history_dir, psis, versions, years, quarters, facilities)
+    group = ["PSI", "VERSION", "YEAR"] + (["DQTR"] if by == "quarter" else [])
+    if df.empty:
+        return pd.DataFrame(columns=group + TREND_COLUMNS)
+    return _period_order(_rates(df, group), by)[group + TREND_COLUMNS]
+
+def facility_series(history_dir, psis=None, versions=None, years=None, quarters=None, facilities=None, by="quarter"):
+    """trend() per facility: one rate series per facility, PSI and appendix version."""
+    if by not in ("quarter", "year"):
+        raise ValueError(f"Unknown trend period: {by} (expected quarter or year)")
+    df = read_aggregates(history_dir, psis, versions, years, quarters, facilities)
+    group = ["Facility", "PSI", "VERSION", "YEAR"] + (["DQTR"] if by == "quarter" else [])
+    if df.empty:
+        return pd.DataFrame(columns=group + TREND_COLUMNS)
+    return _period_order(_rates(df, group), by)[group + TREND_COLUMNS]
+
+def read_results(history_dir, psi, versions=None, years=None, quarters=None):
+    """Encounter-level results of one PSI from the matching partitions (every run), with the partition keys."""
+    filters = {"YEAR": _as_filter(years), "DQTR": _as_filter(quarters), "PSI": {psi}, "VERSION": _as_filter(versions)}
+    frames = []
+    for path, values in _partition_dirs(os.path.join(history_dir, RESULTS_DIR), filters):
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.name.endswith(".parquet"):
+                frames.append(pd.read_parquet(entry.path).assign(YEAR=values["YEAR"], DQTR=values["DQTR"],
+                                                                 VERSION=values["VERSION"]))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _years(args):
+    if args.from_year is None and args.to_year is None:
+        return None
+    return [str(y) for y in range(args.from_year or 1900, (args.to_year or 2100) + 1)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Append PSI runs to a partitioned history and query rate trends")
+    parser.add_argument("command", choices=["append", "trend", "facilities", "runs", "drop"])
+    parser.add_argument("--history-dir", required=True)
+    # append
+    parser.add_argument("--input", help="Encounter file (.xlsx, .csv or .parquet) to score and append")
+    parser.add_argument("--appendix", help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--version", help="Appendix version label (append) or filter (trend, facilities)")
+    parser.add_argument("--facility", help="Facility of every encounter when the input has no facility column")
+    parser.add_argument("--facility-column", default=DEFAULT_FACILITY_COLUMN)
+    parser.add_argument("--backend", choices=psi_engine.BACKENDS, default="pandas")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    parser.add_argument("--aggregates-only", action="store_true", help="Do not keep encounter-level results")
+    parser.add_argument("--run-id", help="Run ID (append: default timestamp-based; drop: the run to remove)")
+    # trend / facilities
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--from-year", type=int)
+    parser.add_argument("--to-year", type=int)
+    parser.add_argument("--facilities", default="", help="Comma-separated facilities (default: all)")
+    parser.add_argument("--by", choices=["quarter", "year"], default="quarter")
+    parser.add_argument("--output", help="Write the trend table (.csv)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or None
+    unknown = [p for p in psis or [] if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+
+    if args.command == "append":
+        if not (args.input and args.appendix and args.version):
+            parser.error("append needs --input, --appendix and --version")
+        started = time.time()
+        df = psi_engine.read_input_file(args.input)
+        results = psi_engine.score_with_backend(df, psis or PSI_LIST, psi_engine.load_code_sets(args.appendix),
+                                                validate_timing=not args.no_timing_validation, backend=args.backend,
+                                                reasons="codes", details="typed")
+        run = append_run(args.history_dir, df, results, args.version, args.run_id, args.facility, args.facility_column,
+                         source=os.path.basename(args.input), store_results=not args.aggregates_only)
+        run["seconds"] = round(time.time() - started, 2)
+        print(json.dumps(run, indent=2))
+    elif args.command in ("trend", "facilities"):
+        query = trend if args.command == "trend" else facility_series
+        facilities = [f.strip() for f in args.facilities.split(",") if f.strip()] or None
+        started = time.perf_counter()
+        table = query(args.history_dir, psis, args.version, _years(args), facilities=facilities, by=args.by)
+        logger.info("Queried %d rows in %.1f ms", len(table), (time.perf_counter() - started) * 1000)
+        if args.output:
+            table.to_csv(args.output, index=False)
+        print(table.to_string(index=False))
+    elif args.command == "runs":
+        for run in list_runs(args.history_dir):
+            print(json.dumps(run))
+    else:
+        if not args.run_id:
+            parser.error("drop needs --run-id")
+        print(json.dumps({"run_id": args.run_id, "files_removed": drop_run(args.history_dir, args.run_id)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Indexes over one job's results, for looking up encounters and paging through large result
+sets without handing every row to the browser.
+
+For each PSI (built the first time that PSI is used):
+- a hash index on EncounterID (pandas Index, so a lookup is a hash probe, not a scan);
+- posting lists on Status and the reason code: the sorted row positions per value, so a
+  filter is an intersection of position arrays instead of a pass over the frame;
+- sort orders per column, computed once and reused by every page of that column.
+The PSI itself is the first level, so lookup() finds one encounter's results across all PSIs.
+
+page() sorts and slices on the server and returns only the rows of one page, with the
+Rationale text rendered for just those rows.
+
+    index = ResultIndex(lambda psi: job_manager.get_results(job_id, [psi])[psi], psis)
+    index.lookup("ENC-000123")                                    # one encounter, every PSI
+    rows = index.select("PSI_12", status="Inclusion", reasons=["EXCL_POA_DVT_PE"])
+    frame, pages = index.page("PSI_12", rows, page=0, page_size=100, sort_by="Age", ascending=False)
+"""
+import math
+import threading
+
+import numpy as np
+import pandas as pd
+
+import psi_engine
+import psi_rules
+
+DEFAULT_PAGE_SIZE = 100
+KEY_COLUMN = "EncounterID"
+POSTING_COLUMNS = ["Status", "Reason"]
+
+
+def _missing(value):
+    return value is None or value is pd.NA or (isinstance(value, float) and value != value)
+
+def _sort_text(value):
+    """Text sort key for columns whose values do not compare with each other."""
+    return "" if _missing(value) else str(value)
+
+
+class _PsiIndex:
+    """Indexes of one PSI's results (positions are row numbers of the results frame)."""
+
+    def __init__(self, frame):
+        self.rows = len(frame)
+        self.keys = pd.Index(frame[KEY_COLUMN].astype(str).to_numpy()) if KEY_COLUMN in frame.columns else pd.Index([])
+        self.keys.get_indexer_for([]) # Builds the hash table now rather than on the first lookup
+        self.postings = {}
+        for column in POSTING_COLUMNS:
+            if column in frame.columns:
+                groups = frame[column].reset_index(drop=True).groupby(frame[column].to_numpy(), observed=True, sort=True).indices
+                self.postings[column] = {value: np.asarray(positions, dtype=np.int64) for value, positions in groups.items()}
+        self.orders = {} # (column, ascending) -> row positions in sort order
+
+    def positions(self, encounter_id):
+        positions = self.keys.get_indexer_for([str(encounter_id)])
+        return positions[positions >= 0] # -1 where the encounter is not in the results
+
+
+class ResultIndex:
+    """
+    Indexes over the results of one job. `load(psi)` returns a PSI's results frame; with
+    `keep_frames` every frame is held (results in memory), otherwise only the indexes and
+    the most recently used PSI's frame are (results spilled to disk).
+    Safe to share between sessions: each PSI is indexed once under a lock.
+    """
+
+    def __init__(self, load, psis, keep_frames=True):
+        self.load = load
+        self.psis = list(psis)
+        self.keep_frames = keep_frames
+        self._frames = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def frame(self, psi):
+        if psi in self._frames:
+            return self._frames[psi]
+        frame = self.load(psi).reset_index(drop=True)
+        if not self.keep_frames:
+            self._frames.clear() # Only the PSI in use is held, as when results are read one PSI at a time
+        self._frames[psi] = frame
+        return frame
+
+    def index(self, psi):
+        if psi not in self._indexes:
+            with self._lock:
+                if psi not in self._indexes:
+                    self._indexes[psi] = _PsiIndex(self.frame(psi))
+        return self._indexes[psi]
+
+    def values(self, psi, column):
+        """Indexed values of `column` (Status or Reason) with their row counts."""
+        postings = self.index(psi).postings.get(column, {})
+        return {value: len(positions) for value, positions in postings.items()}
+
+    def lookup(self, encounter_id, psis=None):
+        """
+        One encounter's results in every PSI (RESULT_COLUMNS, one row per PSI it was found
+        in), with the Rationale rendered for just those rows.
+        """
+        found = []
+        for psi in psis or self.psis:
+            positions = self.index(psi).positions(encounter_id)
+            if not len(positions):
+                continue
+            for record in psi_rules.decode_reasons(psi, self.frame(psi).iloc[positions]).to_dict("records"):
+                found.append({**{c: record.get(c) for c in psi_engine.RESULT_COLUMNS}, "PSI": psi})
+        return pd.DataFrame(found, columns=psi_engine.RESULT_COLUMNS)
+
+    def select(self, psi, status=None, reasons=None, flags=()):
+        """
+        Sorted row positions of `psi` matching a Status, any of the reason codes and every
+        boolean detail flag in `flags`. None means no filter.
+        """
+        index = self.index(psi)
+        selected = np.arange(index.rows, dtype=np.int64)
+        for column, wanted in (("Status", None if status is None else [status]), ("Reason", reasons)):
+            if wanted is None:
+                continue
+            postings = index.postings.get(column, {})
+            matching = [postings[value] for value in wanted if value in postings]
+            matching = np.unique(np.concatenate(matching)) if matching else np.array([], dtype=np.int64)
+            selected = np.intersect1d(selected, matching, assume_unique=True)
+        if flags:
+            frame = self.frame(psi)
+            for flag in flags:
+                values = frame[flag].fillna(False).astype(bool).to_numpy()
+                selected = selected[values[selected]]
+        return selected
+
+    def sort_order(self, psi, column, ascending=True):
+        """All row positions of `psi` sorted by `column` (stable, blanks last), computed once."""
+        index = self.index(psi)
+        key = (column, ascending)
+        if key not in index.orders:
+            values = self.frame(psi)[column].reset_index(drop=True)
+            try:
+                order = values.sort_values(ascending=ascending, kind="stable", na_position="last").index
+            except TypeError: # Mixed numbers and text (e.g. Length_of_Stay with blanks), or lists
+                order = values.map(_sort_text).sort_values(ascending=ascending, kind="stable").index
+            index.orders[key] = np.asarray(order, dtype=np.int64)
+        return index.orders[key]
+
+    def page(self, psi, positions=None, page=0, page_size=DEFAULT_PAGE_SIZE, sort_by=None, ascending=True, columns=None):
+        """
+        (one page of the selected rows in text form, number of pages). `positions` are row
+        positions from select() (all rows if None); only the page's rows are decoded.
+        """
+        index = self.index(psi)
+        if positions is None:
+            positions = np.arange(index.rows, dtype=np.int64)
+        pages = max(1, math.ceil(len(positions) / page_size))
+        page = min(max(page, 0), pages - 1)
+        if sort_by:
+            order = self.sort_order(psi, sort_by, ascending)
+            if len(positions) < index.rows:
+                selected = np.zeros(index.rows, dtype=bool)
+                selected[positions] = True
+                order = order[selected[order]]
+        else:
+            order = positions
+        rows = self.frame(psi).iloc[order[page * page_size:(page + 1) * page_size]]
+        rows = psi_rules.text_details(psi, psi_rules.decode_reasons(psi, rows))
+        if columns:
+            rows = rows[[c for c in columns if c in rows.columns]]
+        return rows, pages
+
+    def rows(self, psi, positions):
+        """The selected rows (compact form, for exports) in result order."""
+        return self.frame(psi).iloc[positions]
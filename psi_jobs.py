@@ -0,0 +1,429 @@
+"""
+Background job execution for PSI scoring.
+
+Scoring runs are submitted as jobs to a worker process pool shared by every
+Streamlit session of the server. Each job has a job ID; its status, progress
+and results are persisted under a jobs directory so that any session can poll,
+cancel or reconnect to a job and retrieve finished results without holding a
+script run open.
+
+With a memory budget (PSI_MEMORY_BUDGET, e.g. "4G") jobs are scored in chunks sized to
+the remaining headroom, and their results are spilled to Parquet partitions in the
+job directory once memory use nears the budget (psi_memory.py).
+
+Workers count the exclusion funnel (psi_funnel.py) of their chunk while they score it;
+the job's funnel merges those counts as chunks finish, and the status carries it as it grows.
+
+Several servers (or replicas) can share a jobs directory: every job records the manager
+that runs it, and each manager renews a lease file while it is alive. A queued or running
+job is only marked failed once its owner's lease has expired (or, on the same host, its
+process is gone), not because another server started.
+"""
+import os
+import json
+import uuid
+import time
+import socket
+import logging
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+import psi_engine
+import psi_rules
+import psi_memory
+import psi_funnel
+
+logger = logging.getLogger(__name__)
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+DEFAULT_JOBS_DIR = os.path.join(tempfile.gettempdir(), "psi_jobs")
+DEFAULT_CHUNK_SIZE = 2000 # Encounters per worker task
+DEFAULT_MEMORY_BUDGET = os.environ.get("PSI_MEMORY_BUDGET") # e.g. "4G"; None = unlimited
+RESULTS_DIR = "results" # Spilled result partitions inside a job's directory
+OWNERS_DIR = ".owners" # One lease file per live JobManager
+LEASE_INTERVAL = 10.0 # Seconds between lease renewals
+LEASE_TIMEOUT = 60.0 # A lease not renewed for this long belongs to a manager that is gone
+
+
+def score_chunk(df_chunk, psis, code_sets, validate_timing):
+    """Worker entry point: scores one chunk of encounters in a pool process."""
+    return psi_engine.score_dataframe(df_chunk, psis, code_sets, validate_timing=validate_timing)
+
+def score_with_backend(df, psis, code_sets, validate_timing, backend, reasons="text", details="text", funnel_by=()):
+    """
+    Worker entry point returning ({psi: DataFrame}, psi_funnel.FunnelCounter) for a whole input
+    (columnar backends) or a chunk: its results and its funnel, counted while it was scored.
+    """
+    funnel = psi_funnel.FunnelCounter(funnel_by)
+    results = psi_engine.score_with_backend(df, psis, code_sets, validate_timing=validate_timing, backend=backend,
+                                            reasons=reasons, details=details, funnel=funnel)
+    return results, funnel
+
+
+def worker_context():
+    """
+    Multiprocessing context for the pool. The server is multi-threaded, so workers are not
+    forked from it (a child could inherit a lock held by another thread): they are forked from
+    a fork server that has only imported this module. Where there is no fork server (Windows)
+    they are spawned. Either way a worker imports the parent's main script as __mp_main__,
+    so the Streamlit app only draws its page under `if __name__ == "__main__"`.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+class JobManager:
+    """
+    Queues scoring jobs onto a shared worker process pool.
+    At most `max_concurrent_jobs` jobs run at once; further jobs wait in the queue.
+    Each running job splits its input into chunks of `chunk_size` encounters that
+    are scored in parallel by the pool. With a `memory_budget` (bytes or a size such
+    as "4G") chunks shrink and results spill to disk as the budget fills up.
+    """
+
+    def __init__(self, jobs_dir=DEFAULT_JOBS_DIR, max_workers=None, max_concurrent_jobs=2, chunk_size=DEFAULT_CHUNK_SIZE,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.jobs_dir = jobs_dir
+        self.chunk_size = chunk_size
+        self.memory_budget = psi_memory.parse_size(memory_budget)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        os.makedirs(os.path.join(self.jobs_dir, OWNERS_DIR), exist_ok=True)
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=worker_context())
+        self._coordinators = ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix="psi-job")
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+        self.owner = {"id": uuid.uuid4().hex[:12], "host": socket.gethostname(), "pid": os.getpid()}
+        self._closed = threading.Event()
+        self._renew_lease()
+        threading.Thread(target=self._keep_lease, name="psi-job-lease", daemon=True).start()
+        self._mark_interrupted_jobs()
+
+    # --- Persistence helpers ---
+    def _job_path(self, job_id, filename):
+        return os.path.join(self.jobs_dir, job_id, filename)
+
+    def _write_status(self, job_id, updates):
+        """Merges `updates` into the job's status file (atomic replace)."""
+        with self._lock:
+            status = self._read_status(job_id) or {}
+            status.update(updates)
+            tmp_path = self._job_path(job_id, "status.json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(status, f)
+            os.replace(tmp_path, self._job_path(job_id, "status.json"))
+            return status
+
+    def _read_status(self, job_id):
+        try:
+            with open(self._job_path(job_id, "status.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # --- Ownership (lease) ---
+    def _lease_path(self, owner_id):
+        return os.path.join(self.jobs_dir, OWNERS_DIR, f"{owner_id}.json")
+
+    def _renew_lease(self):
+        tmp_path = self._lease_path(self.owner["id"]) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(self.owner, renewed_at=time.time()), f)
+        os.replace(tmp_path, self._lease_path(self.owner["id"]))
+
+    def _keep_lease(self):
+        while not self._closed.wait(LEASE_INTERVAL):
+            try:
+                self._renew_lease()
+            except OSError: # Jobs directory briefly unavailable; the next renewal retries
+                logger.warning("Could not renew the job lease of %s", self.owner["id"])
+
+    def _owner_alive(self, owner):
+        """Whether the manager that owns a job (its status "owner") is still running."""
+        if not owner:
+            return False # Jobs from before owners were recorded
+        if owner.get("id") == self.owner["id"]:
+            return True
+        if os.name == "posix" and owner.get("host") == self.owner["host"] and owner.get("pid"): # os.kill(pid, 0) terminates on Windows
+            try:
+                os.kill(owner["pid"], 0)
+            except ProcessLookupError:
+                return False # Same host and its process has exited: no need to wait for the lease
+            except PermissionError: # Exists, run by another user
+                pass
+        try:
+            with open(self._lease_path(owner["id"])) as f:
+                renewed_at = json.load(f).get("renewed_at") or 0
+        except (OSError, ValueError):
+            return False
+        return time.time() - renewed_at < LEASE_TIMEOUT
+
+    def _fail_if_orphaned(self, status):
+        """Marks a queued/running job failed when its owner is gone (it can never finish). Returns the status."""
+        if status and status["status"] not in FINISHED_STATES and not self._owner_alive(status.get("owner")):
+            status = self._write_status(status["job_id"], dict(status=JOB_FAILED, finished_at=time.time(),
+                                                               error="Interrupted: the server running the job stopped before it finished"))
+        return status
+
+    def _mark_interrupted_jobs(self):
+        """Fails the queued/running jobs whose server stopped; jobs of live servers sharing the directory are left alone."""
+        for job in self.list_jobs():
+            self._fail_if_orphaned(job)
+
+    # --- Public API ---
+    def submit(self, df, psis, code_sets, validate_timing=True, metadata=None, backend="pandas", reasons="text",
+               details="text", funnel_by=()):
+        """
+        Queues a scoring job and returns its job ID. `backend` is one of psi_engine.BACKENDS:
+        pandas jobs are split into chunks across the pool, duckdb/polars jobs run as one
+        task (those engines parallelize internally). With reasons="codes" the results are
+        stored in the compact form (psi_rules.decode_reasons renders the Rationale text);
+        with details="typed" the Detail_ columns are typed (psi_rules.type_details).
+        The exclusion funnel is counted per combination of the `funnel_by` input columns
+        (e.g. ["YEAR", "DQTR"]); get_funnel() returns it.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        os.makedirs(os.path.join(self.jobs_dir, job_id), exist_ok=True)
+        status = {
+            "job_id": job_id,
+            "status": JOB_QUEUED,
+            "psis": list(psis),
+            "validate_timing": validate_timing,
+            "backend": backend,
+            "reasons": reasons,
+            "details": details,
+            "total_rows": len(df),
+            "progress": 0.0,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "code_set_sizes": {name: len(codes) for name, codes in code_sets.items()},
+            "memory_budget": self.memory_budget,
+            "funnel_by": list(funnel_by),
+            "funnel": [],
+            "owner": self.owner,
+        }
+        status.update(metadata or {})
+        self._write_status(job_id, status)
+        cancel_event = threading.Event()
+        self._cancel_events[job_id] = cancel_event
+        self._coordinators.submit(self._run_job, job_id, df, list(psis), code_sets, validate_timing, backend, reasons,
+                                 details, cancel_event)
+        return job_id
+
+    def get_status(self, job_id):
+        """Returns the job's status dict, or None if the job ID is unknown."""
+        return self._fail_if_orphaned(self._read_status(job_id))
+
+    def list_jobs(self):
+        """Returns the status of every job in the jobs directory, most recent first."""
+        jobs = []
+        for job_id in os.listdir(self.jobs_dir):
+            if job_id == OWNERS_DIR:
+                continue
+            status = self._read_status(job_id)
+            if status:
+                jobs.append(status)
+        return sorted(jobs, key=lambda j: j.get("submitted_at") or 0, reverse=True)
+
+    def cancel(self, job_id):
+        """Requests cancellation of a queued or running job. Returns False if it cannot be cancelled."""
+        cancel_event = self._cancel_events.get(job_id)
+        status = self._read_status(job_id)
+        if cancel_event is None or status is None or status["status"] in FINISHED_STATES:
+            return False
+        cancel_event.set()
+        return True
+
+    def record_preview(self, job_id, estimates):
+        """
+        Stores approximate rates for a job (psi_preview's estimate table) in its status, so
+        every session polling the job can show them until the exact results are available.
+        """
+        return self._write_status(job_id, dict(preview=estimates.to_dict("records")))
+
+    def get_funnel(self, job_id):
+        """The job's exclusion funnel so far (psi_funnel.FunnelCounter), or None for an unknown job."""
+        status = self._read_status(job_id)
+        if not status:
+            return None
+        return psi_funnel.FunnelCounter.from_records(status.get("funnel", []), status.get("funnel_by", []))
+
+    def get_results(self, job_id, psis=None):
+        """
+        Returns {psi: results DataFrame} for a completed job (only `psis` if given), or None if
+        results are not available. Spilled results are read from disk per PSI, so loading one
+        PSI at a time keeps a single PSI's results in memory.
+        """
+        status = self._read_status(job_id)
+        if not status or status["status"] != JOB_COMPLETED:
+            return None
+        psis = psis or status["psis"]
+        if status.get("results_format") == "parquet":
+            return {psi: psi_memory.read_partitions(self._job_path(job_id, RESULTS_DIR), psi, status["details"] == "typed")
+                    for psi in psis}
+        results = pd.read_pickle(self._job_path(job_id, "results.pkl"))
+        return {psi: results[psi] for psi in psis}
+
+    def shutdown(self):
+        """Cancels outstanding jobs and stops the worker pool."""
+        for cancel_event in self._cancel_events.values():
+            cancel_event.set()
+        self._coordinators.shutdown(wait=False)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._closed.set()
+        try:
+            os.remove(self._lease_path(self.owner["id"]))
+        except OSError:
+            pass
+
+    # --- Job execution (coordinator thread) ---
+    def _run_job(self, job_id, df, psis, code_sets, validate_timing, backend, reasons, details, cancel_event):
+        try:
+            if cancel_event.is_set(): # Cancelled while queued
+                self._write_status(job_id, dict(status=JOB_CANCELLED, finished_at=time.time()))
+                return
+            self._write_status(job_id, dict(status=JOB_RUNNING, started_at=time.time()))
+            if self.memory_budget:
+                self._run_budgeted_job(job_id, df, psis, code_sets, validate_timing, backend, reasons, details, cancel_event)
+            else:
+                self._run_chunked_job(job_id, df, psis, code_sets, validate_timing, backend, reasons, details, cancel_event)
+        finally:
+            self._cancel_events.pop(job_id, None)
+
+    def _run_chunked_job(self, job_id, df, psis, code_sets, validate_timing, backend, reasons, details, cancel_event):
+        """Scores the job in fixed-size chunks (pandas) or one task (columnar backends) and stores the results."""
+        funnel = psi_funnel.FunnelCounter(self._read_status(job_id).get("funnel_by", []))
+        if backend == "pandas":
+            chunks = [df.iloc[start:start + self.chunk_size] for start in range(0, len(df), self.chunk_size)]
+            # Chunks are rendered/typed in the workers, so only their result frames cross process boundaries
+            futures = {
+                self._pool.submit(score_with_backend, chunk, psis, code_sets, validate_timing, backend, reasons, details,
+                                  funnel.dimensions): n
+                for n, chunk in enumerate(chunks)
+            }
+        else:
+            chunks = [df]
+            futures = {self._pool.submit(score_with_backend, df, psis, code_sets, validate_timing, backend, reasons, details,
+                                         funnel.dimensions): 0}
+        chunk_results = [None] * len(chunks)
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_results[futures[future]], chunk_funnel = future.result()
+                    funnel.merge(chunk_funnel)
+                if cancel_event.is_set():
+                    for future in pending:
+                        future.cancel()
+                    self._write_status(job_id, dict(status=JOB_CANCELLED, finished_at=time.time()))
+                    return
+                if done:
+                    self._write_status(job_id, dict(progress=(len(chunks) - len(pending)) / len(chunks),
+                                                    funnel=funnel.to_records()))
+
+            if backend == "pandas":
+                # Merge chunk results back into one DataFrame per PSI (chunks are in input order);
+                # chunk categories differ, so the merged frames are re-typed
+                results = {}
+                for psi in psis:
+                    merged = pd.concat([chunk_result[psi] for chunk_result in chunk_results], ignore_index=True)
+                    if reasons == "codes":
+                        psi_rules.apply_reason_dtypes(psi, merged)
+                    if details == "typed":
+                        psi_rules.apply_detail_dtypes(psi, merged)
+                    results[psi] = psi_engine.order_result_columns(merged, psi)
+            else:
+                results = chunk_results[0]
+            pd.to_pickle(results, self._job_path(job_id, "results.pkl"))
+            self._write_status(job_id, dict(status=JOB_COMPLETED, progress=1.0, finished_at=time.time()))
+        except Exception as e:
+            logger.exception("PSI scoring job %s failed", job_id)
+            for future in pending:
+                future.cancel()
+            self._write_status(job_id, dict(status=JOB_FAILED, finished_at=time.time(), error=str(e)))
+
+    def _run_budgeted_job(self, job_id, df, psis, code_sets, validate_timing, backend, reasons, details, cancel_event):
+        """
+        _run_job under the memory budget. Chunks are cut as the job goes, each as large as the
+        headroom allows for the chunks in flight (columnar backends start from the whole input),
+        and result partitions are spilled to the job's results directory near the limit.
+        """
+        budget = psi_memory.MemoryBudget(self.memory_budget)
+        store = psi_memory.SpillStore(self._job_path(job_id, RESULTS_DIR), budget, typed_details=details == "typed")
+        max_chunk = self.chunk_size if backend == "pandas" else max(len(df), 1)
+        max_in_flight = self.max_workers if backend == "pandas" else 1
+        # Memory per encounter in flight: the input rows plus one result row per PSI (refined from finished chunks)
+        input_bytes_per_row = psi_memory.frame_bytes(df) / max(len(df), 1)
+        bytes_per_row = input_bytes_per_row * (1 + len(psis))
+        position, chunk_number, rows_done, smallest_chunk = 0, 0, 0, max_chunk
+        funnel = psi_funnel.FunnelCounter(self._read_status(job_id).get("funnel_by", []))
+        futures = {}
+        try:
+            while position < len(df) or futures:
+                while position < len(df) and len(futures) < max_in_flight:
+                    size = budget.chunk_size(max_chunk, bytes_per_row, in_flight=len(futures) + 1)
+                    smallest_chunk = min(smallest_chunk, size)
+                    chunk = df.iloc[position:position + size]
+                    future = self._pool.submit(score_with_backend, chunk, psis, code_sets, validate_timing, backend, reasons, details,
+                                               funnel.dimensions)
+                    futures[future] = (chunk_number, chunk)
+                    position += len(chunk)
+                    chunk_number += 1
+                done, _ = wait(set(futures), timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    number, chunk = futures.pop(future)
+                    rows = len(chunk)
+                    chunk_results, chunk_funnel = future.result()
+                    funnel.merge(chunk_funnel)
+                    store.add(number, chunk_results)
+                    rows_done += rows
+                    result_bytes = sum(psi_memory.frame_bytes(frame) for frame in chunk_results.values())
+                    bytes_per_row = max(bytes_per_row, input_bytes_per_row + result_bytes / max(rows, 1))
+                if cancel_event.is_set():
+                    for future in futures:
+                        future.cancel()
+                    self._write_status(job_id, dict(status=JOB_CANCELLED, finished_at=time.time()))
+                    return
+                store.maybe_spill()
+                if done:
+                    self._write_status(job_id, dict(progress=rows_done / max(len(df), 1), funnel=funnel.to_records()))
+
+            if store.spilled:
+                store.spill() # The rest joins the partitions on disk, which are the job's results
+            memory = dict(peak_memory=budget.peak, smallest_chunk=smallest_chunk, chunks=chunk_number,
+                          spilled_rows=store.spilled_rows)
+            if store.spilled:
+                self._write_status(job_id, dict(status=JOB_COMPLETED, progress=1.0, finished_at=time.time(),
+                                                results_format="parquet", **memory))
+                return
+            results = {}
+            for psi in psis:
+                merged = store.frame(psi)
+                if reasons == "codes":
+                    psi_rules.apply_reason_dtypes(psi, merged)
+                if details == "typed":
+                    psi_rules.apply_detail_dtypes(psi, merged)
+                results[psi] = psi_engine.order_result_columns(merged, psi)
+            pd.to_pickle(results, self._job_path(job_id, "results.pkl"))
+            self._write_status(job_id, dict(status=JOB_COMPLETED, progress=1.0, finished_at=time.time(), **memory))
+        except Exception as e:
+            logger.exception("PSI scoring job %s failed", job_id)
+            for future in futures:
+                future.cancel()
+            self._write_status(job_id, dict(status=JOB_FAILED, finished_at=time.time(), error=str(e)))
@@ -0,0 +1,155 @@
+"""
+Load generator for the PSI HTTP scoring service (psi_service.py).
+
+Replays encounters from an input workbook (or JSON lines file) against a
+running service with a fixed number of concurrent clients and reports
+throughput and latency percentiles. Exits non-zero if the p50/p99 targets are
+missed, so it can be used as a regression check.
+
+Usage:
+    python psi_loadgen.py --url http://127.0.0.1:8080 --input encounters.xlsx \
+        --requests 5000 --concurrency 8
+    python psi_loadgen.py ... --batch-size 100      # exercise /score/batch instead
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import http.client
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+# Published latency targets for single-encounter scoring (see README)
+DEFAULT_P50_TARGET_MS = 10.0
+DEFAULT_P99_TARGET_MS = 50.0
+
+
+def load_encounters(path):
+    """Reads encounters from .xlsx/.csv/.jsonl into JSON-ready dicts (empty cells dropped)."""
+    if path.lower().endswith((".jsonl", ".json")):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    df = pd.read_csv(path) if path.lower().endswith(".csv") else pd.read_excel(path)
+    encounters = []
+    for record in df.to_dict("records"):
+        encounter = {}
+        for key, value in record.items():
+            if pd.isna(value):
+                continue
+            if isinstance(value, pd.Timestamp):
+                value = value.isoformat()
+            elif isinstance(value, np.generic):
+                value = value.item()
+            encounter[key] = value
+        encounters.append(encounter)
+    return encounters
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float("nan")
+    k = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+def run_load(url, encounters, total_requests, concurrency, batch_size=1, psis=None):
+    """
+    Sends `total_requests` requests from `concurrency` client threads (keep-alive
+    connections). Returns a stats dict with latencies in milliseconds.
+    """
+    target = urlparse(url)
+    path = "/score" if batch_size == 1 else "/score/batch"
+    if psis:
+        path += "?psis=" + ",".join(psis)
+    bodies = []
+    for i in range(min(len(encounters), 1000)):
+        if batch_size == 1:
+            bodies.append(json.dumps(encounters[i]).encode("utf-8"))
+        else:
+            batch = [encounters[(i + j) % len(encounters)] for j in range(batch_size)]
+            bodies.append(json.dumps({"encounters": batch}).encode("utf-8"))
+
+    latencies = []
+    status_counts = {}
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+
+    def client():
+        conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+        local_latencies = []
+        local_statuses = {}
+        for n in counter:
+            body = bodies[n % len(bodies)]
+            start = time.perf_counter()
+            try:
+                conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+                status = "connection_error"
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            if status == 200:
+                local_latencies.append(elapsed_ms)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                status_counts[status] = status_counts.get(status, 0) + count
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    wall_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_seconds = time.perf_counter() - wall_start
+
+    latencies.sort()
+    return {
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "status_counts": {str(k): v for k, v in status_counts.items()},
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(total_requests / wall_seconds, 1) if wall_seconds else None,
+        "encounters_per_second": round(len(latencies) * batch_size / wall_seconds, 1) if wall_seconds else None,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p90_ms": round(percentile(latencies, 90), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for psi_service.py")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--input", required=True, help="Encounters (.xlsx, .csv or .jsonl)")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1, help="1 = /score, >1 = /score/batch")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--warmup", type=int, default=100, help="Requests sent before measuring")
+    parser.add_argument("--p50-target-ms", type=float, default=DEFAULT_P50_TARGET_MS)
+    parser.add_argument("--p99-target-ms", type=float, default=DEFAULT_P99_TARGET_MS)
+    args = parser.parse_args(argv)
+
+    encounters = load_encounters(args.input)
+    if not encounters:
+        parser.error("No encounters found in --input")
+    psis = [p.strip() for p in args.psis.split(",") if p.strip()]
+    if args.warmup:
+        run_load(args.url, encounters, args.warmup, args.concurrency, args.batch_size, psis)
+    stats = run_load(args.url, encounters, args.requests, args.concurrency, args.batch_size, psis)
+    stats["p50_target_ms"] = args.p50_target_ms
+    stats["p99_target_ms"] = args.p99_target_ms
+    stats["targets_met"] = stats["p50_ms"] <= args.p50_target_ms and stats["p99_ms"] <= args.p99_target_ms
+    print(json.dumps(stats, indent=2))
+    return 0 if stats["targets_met"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+Memory budget for scoring runs on a shared server.
+
+A MemoryBudget tracks the resident memory of the server process and its worker
+processes against a configured limit. Background jobs (psi_jobs.JobManager) consult it
+while they run:
+- the number of encounters per chunk shrinks when the headroom gets small, so fewer
+  encounters are in flight in the workers at once;
+- finished result partitions are moved from memory to Parquet files (SpillStore) once
+  usage crosses the high-water mark, and read back one PSI at a time.
+A big upload then completes within the budget instead of getting the server OOM-killed.
+"""
+import os
+import gc
+import glob
+import logging
+import multiprocessing
+
+import pandas as pd
+
+import psi_engine
+import psi_rules
+
+try:
+    import psutil
+except ImportError: # /proc/<pid>/statm is read instead (Linux)
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HIGH_WATER = 0.8 # Fraction of the budget at which results are spilled and chunks shrink
+MIN_CHUNK_SIZE = 100 # Smallest chunk the budget shrinks to; below this per-chunk overhead dominates
+SPILL_ORDER_COLUMN = "Source_Chunk" # Chunk number stored with spilled rows, so input order can be restored
+_SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """Bytes from a size such as '4G', '512M' or 1073741824 (a plain number is bytes); None stays None."""
+    if value is None or isinstance(value, (int, float)):
+        return None if value is None else int(value)
+    text = str(value).strip().upper().removesuffix("B")
+    if not text:
+        return None
+    if text[-1] in _SIZE_UNITS:
+        return int(float(text[:-1]) * _SIZE_UNITS[text[-1]])
+    return int(float(text))
+
+def _rss(pid):
+    """Resident set size of one process from /proc, or None where that is not available."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def process_memory(include_children=True):
+    """
+    Resident memory of this process (and its worker processes) in bytes, or None if it
+    cannot be measured. Forked workers share pages with the parent, so this overcounts
+    rather than undercounts.
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        processes = [process] + (process.children(recursive=True) if include_children else [])
+        total = 0
+        for p in processes:
+            try:
+                total += p.memory_info().rss
+            except psutil.Error: # A worker that exited in the meantime
+                pass
+        return total
+    total = _rss(os.getpid())
+    if total is None:
+        return None
+    if include_children:
+        total += sum(_rss(child.pid) or 0 for child in multiprocessing.active_children())
+    return total
+
+
+class MemoryBudget:
+    """
+    A memory limit (bytes) for the process and its workers. Past `high_water` (a fraction
+    of the limit) results should be spilled and chunks shrunk. Where memory cannot be
+    measured, the bytes registered with track() are used instead.
+    """
+
+    def __init__(self, limit, high_water=DEFAULT_HIGH_WATER):
+        self.limit = parse_size(limit)
+        self.high_water = high_water
+        self.tracked = 0
+        self.peak = 0
+
+    def track(self, nbytes):
+        """Registers bytes held (positive) or released (negative) by the run."""
+        self.tracked = max(0, self.tracked + nbytes)
+
+    def usage(self):
+        measured = process_memory()
+        used = self.tracked if measured is None else measured
+        self.peak = max(self.peak, used)
+        return used
+
+    def headroom(self):
+        """Bytes left below the high-water mark (negative when above it)."""
+        return self.limit * self.high_water - self.usage()
+
+    def near_limit(self):
+        return self.headroom() <= 0
+
+    def chunk_size(self, chunk_size, bytes_per_row, in_flight=1):
+        """
+        The largest chunk (at most `chunk_size`, at least MIN_CHUNK_SIZE) such that `in_flight`
+        chunks of `bytes_per_row` each fit in the headroom.
+        """
+        if bytes_per_row <= 0:
+            return chunk_size
+        fits = int(self.headroom() / (bytes_per_row * max(in_flight, 1)))
+        return max(MIN_CHUNK_SIZE, min(chunk_size, fits))
+
+
+def frame_bytes(df):
+    """Memory held by a DataFrame, including its Python objects (strings, lists)."""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def read_partitions(directory, psi, typed_details=False):
+    """
+    Reads the spilled partitions of one PSI back into one results frame in input order,
+    with the dtypes of the in-memory form (categorical reasons, typed details if the run
+    produced them). Like every Parquet result file, columns that mixed numbers and text
+    (e.g. Length_of_Stay with blanks) come back as text.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, psi, "part-*.parquet")))
+    if not paths:
+        return pd.DataFrame()
+    merged = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+    merged = merged.sort_values(SPILL_ORDER_COLUMN, kind="stable").drop(columns=SPILL_ORDER_COLUMN).reset_index(drop=True)
+    if typed_details:
+        # Parquet lists come back as arrays
+        merged = psi_rules.type_details(psi, merged)
+    if "Reason" in merged.columns:
+        psi_rules.apply_reason_dtypes(psi, merged)
+    return psi_engine.order_result_columns(merged, psi)
+
+
+class SpillStore:
+    """
+    Result partitions ({psi: frame} per chunk) of one run. They are kept in memory and
+    written to `directory`/<PSI>/part-<n>.parquet when spill() is called, e.g. because
+    the budget is near its limit; frame() returns a PSI's results in chunk order either way.
+    """
+
+    def __init__(self, directory, budget=None, typed_details=False):
+        self.directory = directory
+        self.budget = budget
+        self.typed_details = typed_details
+        self._frames = {} # psi -> {chunk: frame}
+        self._spills = 0
+        self.spilled_rows = 0
+        self.spilled_bytes = 0
+
+    @property
+    def spilled(self):
+        return self._spills > 0
+
+    def add(self, chunk, results):
+        """Holds one chunk's {psi: frame}."""
+        for psi, frame in results.items():
+            self._frames.setdefault(psi, {})[chunk] = frame
+            if self.budget:
+                self.budget.track(frame_bytes(frame))
+
+    def maybe_spill(self):
+        """Spills the held partitions if the budget is near its limit. Returns True if it did."""
+        if self.budget and self._frames and self.budget.near_limit():
+            self.spill()
+            return True
+        return False
+
+    def spill(self):
+        """Writes every held partition to Parquet (one file per PSI and spill) and frees them."""
+        if not any(self._frames.values()):
+            return
+        for psi, chunks in self._frames.items():
+            if not chunks:
+                continue
+            parts = [frame.assign(**{SPILL_ORDER_COLUMN: chunk}) for chunk, frame in sorted(chunks.items())]
+            part = pd.concat(parts, ignore_index=True)
+            os.makedirs(os.path.join(self.directory, psi), exist_ok=True)
+            psi_engine.write_results_parquet(part, os.path.join(self.directory, psi, f"part-{self._spills:05d}.parquet"), psi)
+            freed = sum(frame_bytes(frame) for frame in chunks.values())
+            self.spilled_rows += len(part)
+            self.spilled_bytes += freed
+            if self.budget:
+                self.budget.track(-freed)
+            chunks.clear()
+        self._spills += 1
+        gc.collect()
+        logger.info("Spilled result partitions to %s (%d rows so far)", self.directory, self.spilled_rows)
+
+    def frame(self, psi):
+        """All results of one PSI in chunk order (spilled partitions are read back)."""
+        held = [frame for _, frame in sorted(self._frames.get(psi, {}).items())]
+        if not self.spilled:
+            return pd.concat(held, ignore_index=True) if held else pd.DataFrame()
+        self.spill() # Everything on disk, so the order column covers all rows
+        return read_partitions(self.directory, psi, self.typed_details)
@@ -0,0 +1,608 @@
+"""
+Polars lazy/streaming backend for PSI scoring.
+
+Scans CSV/Parquet input lazily (Excel is converted to Parquet once, as in the
+DuckDB backend), melts DX1..DX30/POA and Proc1..Proc20 into long dx/proc
+frames, joins them against the code-set table and aggregates the per-encounter
+features that the rules of psi_rules.py read. The rule conditions are the same
+SQL strings the DuckDB backend runs, evaluated here with `pl.sql_expr`.
+
+File inputs are normalized once into Arrow IPC files (load_normalized());
+rescoring the same file with another PSI selection, timing setting or
+appendix memory-maps those instead of re-reading it.
+
+Every plan is collected with Polars' streaming engine. For inputs larger than
+memory use score_to_files() (or the CLI): the feature table is streamed to a
+temporary Parquet file and each PSI's results are streamed from it into
+<PSI>.parquet, so no step holds the whole dataset in memory.
+
+    python psi_polars.py --input encounters.parquet --appendix PSI_Code_Sets.xlsx --output-dir results/
+"""
+import os
+import sys
+import json
+import time
+import logging
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+import psi_rules
+from psi_engine import PSI_LIST, MINUTES_PER_DAY, make_parquet_safe, load_code_sets
+from psi_duckdb import DATE_FORMATS, DEFAULT_CACHE_DIR, DX_SCOPES, MAX_DX, MAX_PROC, excel_to_parquet
+
+try:
+    import polars as pl
+except ImportError: # Optional dependency, only needed for the Polars backend
+    pl = None
+
+logger = logging.getLogger(__name__)
+
+PY_WHITESPACE = " \t\n\r\x0b\x0c" # Characters Python's str.strip() removes
+CSV_INFER_SCHEMA_ROWS = 10000
+# chrono spells fractional seconds %.f
+POLARS_DATE_FORMATS = [f.replace(".%f", "%.f") for f in DATE_FORMATS]
+TIME_FORMATS = ["%H:%M:%S", "%H:%M:%S%.f", "%H:%M"]
+# Bump when normalize() changes so stale normalized caches are not reused
+NORMALIZED_CACHE_VERSION = 1
+NORMALIZED_TABLES = ["encounters", "dx", "proc"]
+
+
+def _require_polars():
+    if pl is None:
+        raise ImportError("The Polars backend requires Polars: pip install polars")
+
+def scan_input(source, cache_dir=DEFAULT_CACHE_DIR):
+    """LazyFrame over a .parquet, .csv or .xlsx/.xls path (or a pandas/Polars DataFrame)."""
+    _require_polars()
+    if isinstance(source, pl.DataFrame):
+        return source.lazy()
+    if not isinstance(source, str):
+        # pandas DataFrame: object columns with mixed value types become text first
+        return pl.from_pandas(make_parquet_safe(source)).lazy()
+    ext = os.path.splitext(source)[1].lower()
+    if ext in (".xlsx", ".xls"):
+        source, ext = excel_to_parquet(source, cache_dir), ".parquet"
+    if ext == ".parquet":
+        return pl.scan_parquet(source)
+    if ext == ".csv":
+        return pl.scan_csv(source, infer_schema_length=CSV_INFER_SCHEMA_ROWS)
+    raise ValueError(f"Unsupported input type: {source} (expected .xlsx, .csv or .parquet)")
+
+
+# --- Expressions mirroring the pandas extraction (same semantics as psi_duckdb.Columns) ---
+class Columns:
+    """Expressions over the input frame that reproduce Python's view of a row value."""
+
+    def __init__(self, schema):
+        self.schema = dict(schema)
+
+    def has(self, name):
+        return name in self.schema
+
+    def pystr(self, name):
+        """str(value) for a non-null value (null if the value or the column is missing)."""
+        if not self.has(name):
+            return pl.lit(None, dtype=pl.Utf8)
+        if self.schema[name] == pl.Boolean:
+            return pl.when(pl.col(name)).then(pl.lit("True")).when(~pl.col(name)).then(pl.lit("False"))
+        return pl.col(name).cast(pl.Utf8)
+
+    def is_numeric(self, name):
+        return self.has(name) and self.schema[name].is_numeric()
+
+    def blank(self, name):
+        """pd.isna(value) or not str(value).strip()"""
+        if not self.has(name):
+            return pl.lit(True)
+        return pl.col(name).is_null() | (self.pystr(name).str.strip_chars(PY_WHITESPACE) == "")
+
+    def falsy(self, name):
+        """A present value that Python treats as false ('' or 0); null/NaN is truthy there."""
+        if self.schema[name] == pl.Boolean:
+            return (~pl.col(name)).fill_null(False)
+        if self.is_numeric(name):
+            return (pl.col(name) == 0).fill_null(False)
+        return (self.pystr(name) == "").fill_null(False)
+
+    def python_or(self, names, fallback=None, as_text=True):
+        """`row.get(a) or row.get(b) or fallback` for columns that may be missing."""
+        expr = fallback if fallback is not None else pl.lit(None)
+        for name in reversed(names):
+            if self.has(name):
+                expr = pl.when(self.falsy(name)).then(expr).otherwise(self.pystr(name) if as_text else pl.col(name))
+        return expr
+
+    def timestamp(self, name):
+        """Parses a date column into a Datetime (null when missing or unparseable)."""
+        if not self.has(name):
+            return pl.lit(None, dtype=pl.Datetime("us"))
+        dtype = self.schema[name]
+        if dtype.is_temporal() and dtype != pl.Time:
+            return pl.col(name).cast(pl.Datetime("us"))
+        if dtype == pl.Utf8:
+            text = pl.col(name).str.strip_chars(PY_WHITESPACE)
+            return pl.coalesce([text.str.strptime(pl.Datetime("us"), f, strict=False) for f in POLARS_DATE_FORMATS])
+        return pl.lit(None, dtype=pl.Datetime("us"))
+
+    def time_of_day(self, name):
+        """Procedure time as Time, accepting HH:MM:SS, HHMMSS and HHMM like extract_proc_info_enhanced."""
+        raw = self.pystr(name).str.strip_chars(PY_WHITESPACE)
+        no_colon = ~raw.str.contains(":", literal=True)
+        normalized = (pl.when(no_colon & (raw.str.len_chars() == 6))
+                      .then(raw.str.slice(0, 2) + ":" + raw.str.slice(2, 2) + ":" + raw.str.slice(4, 2))
+                      .when(no_colon & (raw.str.len_chars() == 4))
+                      .then(raw.str.slice(0, 2) + ":" + raw.str.slice(2, 2) + ":00")
+                      .otherwise(raw))
+        return pl.coalesce([normalized.str.strptime(pl.Time, f, strict=False) for f in TIME_FORMATS])
+
+def minute_of(timestamp_expr):
+    """int64 epoch minutes of a timestamp (floor, like psi_engine.to_epoch_minute)."""
+    return timestamp_expr.dt.epoch("us") // 60_000_000
+
+def _norm_code(expr):
+    return expr.str.replace_all(".", "", literal=True).str.to_uppercase().str.strip_chars(PY_WHITESPACE)
+
+def _norm_poa(cols, name):
+    if not cols.has(name):
+        return pl.lit("")
+    poa = cols.pystr(name).str.to_uppercase().str.strip_chars(PY_WHITESPACE)
+    return pl.when(poa.is_in(["Y", "N", "U", "W"])).then(poa).otherwise(pl.lit(""))
+
+def dx_long(lf, cols):
+    """(row_idx, seq, code, poa): one row per diagnosis, seq 1 = principal (extract_dx_codes_enhanced)."""
+    frames = []
+    for seq in range(1, MAX_DX + 1):
+        if seq == 1:
+            std, std_poa, alt, alt_poa = "DX1", "POA1", "Pdx", "POA1"
+        else:
+            std, std_poa, alt, alt_poa = f"DX{seq}", f"POA{seq}", f"Sdx{seq - 1}", f"POA_Sdx{seq - 1}"
+        if not cols.has(std) and not cols.has(alt):
+            continue
+        use_alt = cols.blank(std)
+        frames.append(lf.select(
+            pl.col("row_idx"), pl.lit(seq, dtype=pl.Int64).alias("seq"),
+            pl.when(use_alt).then(cols.pystr(alt)).otherwise(cols.pystr(std)).alias("raw"),
+            pl.when(use_alt).then(_norm_poa(cols, alt_poa)).otherwise(_norm_poa(cols, std_poa)).cast(pl.Utf8).alias("poa"),
+        ))
+    if not frames:
+        return pl.LazyFrame(schema={"row_idx": pl.UInt32, "seq": pl.Int64, "code": pl.Utf8, "poa": pl.Utf8})
+    return (pl.concat(frames, how="vertical")
+            .filter(pl.col("raw").is_not_null() & (pl.col("raw").str.strip_chars(PY_WHITESPACE) != ""))
+            .select("row_idx", "seq", _norm_code(pl.col("raw")).alias("code"), "poa"))
+
+def proc_long(lf, cols):
+    """(row_idx, seq, code, minute): one row per procedure (extract_proc_info_enhanced)."""
+    frames = []
+    for seq in range(1, MAX_PROC + 1):
+        code_col, date_col, time_col = f"Proc{seq}", f"Proc{seq}_Date", f"Proc{seq}_Time"
+        if not cols.has(code_col):
+            continue
+        ts = cols.timestamp(date_col)
+        if cols.has(time_col) and cols.has(date_col):
+            # A time column replaces the time of day of the date value
+            ts = pl.when(cols.blank(time_col)).then(ts).otherwise(ts.dt.date().dt.combine(cols.time_of_day(time_col), "us"))
+        frames.append(lf.select(
+            pl.col("row_idx"), pl.lit(seq, dtype=pl.Int64).alias("seq"),
+            cols.pystr(code_col).alias("raw"), minute_of(ts).cast(pl.Int64).alias("minute"),
+        ))
+    if not frames:
+        return pl.LazyFrame(schema={"row_idx": pl.UInt32, "seq": pl.Int64, "code": pl.Utf8, "minute": pl.Int64})
+    return (pl.concat(frames, how="vertical")
+            .filter(pl.col("raw").is_not_null() & (pl.col("raw").str.strip_chars(PY_WHITESPACE) != ""))
+            .select("row_idx", "seq", _norm_code(pl.col("raw")).alias("code"), "minute"))
+
+
+# --- Encounter features ---
+def _base_features(cols):
+    """Encounter-level features and result pass-through columns (evaluate_psi_comprehensive / build_result_record)."""
+    los_columns = ["length_of_stay", "Length_of_stay"]
+    # length_of_stay or Length_of_stay: 0 falls through, NaN does not
+    los = cols.python_or(los_columns, as_text=False) if any(cols.is_numeric(c) for c in los_columns) else pl.lit(None)
+
+    def drg_number(name):
+        if not cols.has(name):
+            return pl.lit(None, dtype=pl.Int64)
+        if cols.is_numeric(name):
+            return pl.col(name).cast(pl.Int64, strict=False)
+        text = cols.pystr(name).str.strip_chars(PY_WHITESPACE)
+        return pl.when(text.str.contains(r"^[+-]?[0-9]+$")).then(text.cast(pl.Int64, strict=False))
+    drg_value = pl.when(cols.blank("DRG")).then(drg_number("MS-DRG")).otherwise(drg_number("DRG"))
+
+    # Required fields: SEX, AGE, DQTR, YEAR and DX1 (row.get("DX1") or row.get("Pdx"))
+    if cols.has("DX1") and cols.has("Pdx"):
+        dx1_blank = pl.when(cols.falsy("DX1")).then(cols.blank("Pdx")).otherwise(cols.blank("DX1"))
+    else:
+        dx1_blank = cols.blank("DX1") if cols.has("DX1") else cols.blank("Pdx")
+    missing = [pl.when(cols.blank(c)).then(pl.lit(label)) for label, c in
+               (("SEX", "SEX"), ("AGE", "Age"), ("DQTR", "DQTR"), ("YEAR", "YEAR"))]
+    missing.append(pl.when(dx1_blank).then(pl.lit("DX1")))
+    missing_fields = pl.concat_str(missing, separator=", ", ignore_nulls=True)
+
+    # admission_date or Admission_Date
+    if cols.has("admission_date") and cols.has("Admission_Date"):
+        admit_ts = pl.when(cols.falsy("admission_date")).then(cols.timestamp("Admission_Date")).otherwise(cols.timestamp("admission_date"))
+    else:
+        admit_ts = cols.timestamp("admission_date" if cols.has("admission_date") else "Admission_Date")
+
+    def passthrough(name):
+        return pl.col(name) if cols.has(name) else pl.lit("")
+
+    return [
+        (pl.col("Age") if cols.has("Age") else pl.lit(None)).alias("AGE"),
+        cols.pystr("Age").alias("AGE_STR"),
+        los.alias("LOS"),
+        los.cast(pl.Utf8).alias("LOS_STR"),
+        ((pl.col("ATYPE") == 3).fill_null(False) if cols.is_numeric("ATYPE") else pl.lit(False)).alias("ATYPE_3"),
+        ((pl.col("MDC") == 4).fill_null(False) if cols.is_numeric("MDC") else pl.lit(False)).alias("MDC_4"),
+        drg_value.alias("DRG_VALUE"),
+        (cols.pystr("MS-DRG").str.strip_chars(PY_WHITESPACE) if cols.has("MS-DRG") else pl.lit("")).alias("MS_DRG_STR"),
+        pl.when(missing_fields != "").then(missing_fields).alias("MISSING_FIELDS"),
+        minute_of(admit_ts).cast(pl.Int64).alias("ADMIT_MINUTE"),
+        cols.python_or(["EncounterID", "Encounter_ID"],
+                       fallback=pl.lit("Row_") + pl.col("row_idx").cast(pl.Utf8)).alias("OUT_EncounterID"),
+        passthrough("Age").alias("OUT_Age"),
+        passthrough("MS-DRG").alias("OUT_MS_DRG"),
+        cols.python_or(["DX1", "Pdx"], fallback=pl.lit("")).alias("OUT_PrincipalDX"),
+        passthrough("ATYPE").alias("OUT_ATYPE"),
+        (los if any(cols.is_numeric(c) for c in los_columns) else passthrough("Length_of_stay")).alias("OUT_Length_of_Stay"),
+    ]
+
+def _non_empty(col):
+    """A list column with empty lists as null (DuckDB's list() aggregate of no rows)."""
+    return pl.when(pl.col(col).list.len() > 0).then(pl.col(col))
+
+# --- Normalized encounter cache ---
+def normalize(lf):
+    """
+    Splits raw input into the normalized tables every scoring run starts from:
+    encounters (row_idx + typed base features), dx (row_idx, seq, code, poa) and
+    proc (row_idx, seq, code, minute). None of them depend on the appendix, the
+    PSI selection or timing validation.
+    """
+    lf = lf.with_row_index("row_idx")
+    cols = Columns(lf.collect_schema())
+    return {
+        "encounters": lf.select([pl.col("row_idx")] + _base_features(cols)),
+        "dx": dx_long(lf, cols),
+        "proc": proc_long(lf, cols),
+    }
+
+def normalized_cache_path(path, cache_dir=DEFAULT_CACHE_DIR):
+    """Cache directory for an input file, keyed on path, size, modification time and cache version."""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{NORMALIZED_CACHE_VERSION}"
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}-{key}.normalized")
+
+def load_normalized(source, cache_dir=DEFAULT_CACHE_DIR, use_cache=True):
+    """
+    Normalized tables (see normalize()) for a DataFrame or input file. For a file
+    the first call writes them as uncompressed Arrow IPC files under `cache_dir`;
+    later calls scan those files memory-mapped, skipping the Excel/CSV read and
+    the code normalization entirely.
+    """
+    _require_polars()
+    if not use_cache or not isinstance(source, str):
+        return normalize(scan_input(source, cache_dir))
+    cached = normalized_cache_path(source, cache_dir)
+    if not all(os.path.exists(os.path.join(cached, f"{name}.arrow")) for name in NORMALIZED_TABLES):
+        os.makedirs(cache_dir, exist_ok=True)
+        started = time.time()
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".normalizing-")
+        try:
+            for name, frame in normalize(scan_input(source, cache_dir)).items():
+                frame.sink_ipc(os.path.join(tmp_dir, f"{name}.arrow"), compression="uncompressed", engine="streaming")
+            try:
+                os.replace(tmp_dir, cached)
+            except OSError: # Another process finished the same cache first
+                if not os.path.isdir(cached):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.info("Normalized %s into %s in %.2fs", source, cached, time.time() - started)
+    return {name: pl.scan_ipc(os.path.join(cached, f"{name}.arrow")) for name in NORMALIZED_TABLES}
+
+
+# --- Feature table ---
+def build_features(lf, code_sets, psis=PSI_LIST, validate_timing=True):
+    """LazyFrame with one row per encounter and every feature the rules of `psis` read."""
+    return features_from_normalized(normalize(lf), code_sets, psis, validate_timing)
+
+def features_from_normalized(tables, code_sets, psis=PSI_LIST, validate_timing=True):
+    """build_features() on the output of normalize() / load_normalized()."""
+    features = psi_rules.referenced_features(psis, validate_timing)
+    dx_scopes, dx_values, proc_sets, drg_sets = psi_rules.required_code_set_features(features)
+    rule_sets = psi_rules.build_rule_code_sets(code_sets)
+    dx_layout, proc_layout = psi_rules.membership_layouts(dx_scopes, proc_sets)
+
+    def membership(layout):
+        words = layout.code_table(rule_sets)
+        return pl.from_pandas(words, schema_overrides={"code": pl.Utf8}).lazy().cast({c: pl.Int64 for c in layout.word_columns()})
+
+    def has_bit(layout, set_name, prefix="M"):
+        word, mask = layout.mask(set_name)
+        return (pl.col(f"{prefix}_{word}") & mask) != 0
+
+    plane_exprs = {
+        "P": pl.col("seq") == 1, "PY": (pl.col("seq") == 1) & (pl.col("poa") == "Y"), "PN": (pl.col("seq") == 1) & (pl.col("poa") == "N"),
+        "S": pl.col("seq") > 1, "SY": (pl.col("seq") > 1) & (pl.col("poa") == "Y"), "SN": (pl.col("seq") > 1) & (pl.col("poa") == "N"),
+    }
+    scope_exprs = {
+        "P": pl.col("seq") == 1, "S": pl.col("seq") > 1,
+        "SY": (pl.col("seq") > 1) & (pl.col("poa") == "Y"), "SN": (pl.col("seq") > 1) & (pl.col("poa") == "N"),
+        "A": pl.lit(True), "AY": pl.col("poa") == "Y", "AN": pl.col("poa") == "N",
+    }
+    assert list(plane_exprs) == psi_rules.DX_PLANES and set(scope_exprs) == set(DX_SCOPES) == set(psi_rules.SCOPE_PLANES)
+    dx_aggs, plane_cols, list_cols = [], [], []
+    for plane, condition in plane_exprs.items():
+        for w, column in enumerate(dx_layout.plane_columns(plane)):
+            dx_aggs.append(pl.col(f"M_{w}").filter(condition).bitwise_or().alias(column))
+            plane_cols.append(column)
+    dx_bits = []
+    for set_name, scopes in sorted(dx_scopes.items()):
+        for scope in sorted(scopes):
+            col = f"DX_{set_name}_{scope}"
+            dx_bits.append(pl.any_horizontal([has_bit(dx_layout, set_name, f"BITS_{plane}")
+                                              for plane in psi_rules.SCOPE_PLANES[scope]]).alias(col))
+            wanted = dx_values.get((set_name, scope), set())
+            ordered_codes = pl.col("code").filter(has_bit(dx_layout, set_name) & scope_exprs[scope])
+            if "FIRST" in wanted:
+                dx_aggs.append(ordered_codes.first().alias(f"{col}_FIRST"))
+            if "LIST" in wanted:
+                dx_aggs.append(ordered_codes.alias(f"{col}_CODES"))
+                list_cols.append(col)
+    # Diagnoses are sorted once; the join keeps that order and group_by keeps it within each
+    # encounter, so FIRST and LIST need no sort per encounter and code set
+    dx = (tables["dx"].sort("row_idx", "seq").join(membership(dx_layout), on="code", maintain_order="left")
+          .group_by("row_idx").agg(dx_aggs))
+    dx = dx.with_columns([_non_empty(f"{c}_CODES").alias(f"{c}_LIST") for c in list_cols]).drop([f"{c}_CODES" for c in list_cols])
+
+    procs = tables["proc"].join(membership(proc_layout), on="code")
+    proc_planes = proc_layout.plane_columns(psi_rules.PROC_PLANE)
+    proc_aggs = [pl.col(f"M_{w}").bitwise_or().alias(column) for w, column in enumerate(proc_planes)]
+    for set_name in sorted(proc_sets):
+        match = has_bit(proc_layout, set_name)
+        proc_aggs += [match.sum().cast(pl.Int64).alias(f"PR_{set_name}_COUNT"),
+                      pl.col("minute").filter(match).min().alias(f"PR_{set_name}_FIRST"),
+                      pl.col("minute").filter(match).max().alias(f"PR_{set_name}_LAST")]
+    pr = procs.group_by("row_idx").agg(proc_aggs)
+
+    # Procedure-window and same-day counts relative to an anchor set's first procedure
+    anchors = sorted({anchor for _, anchor, _, _ in psi_rules.WINDOW_FEATURES.values()} | set(psi_rules.DAY_COUNT_FEATURES.values()))
+    anchor_firsts = pr.select(["row_idx"] + [f"PR_{a}_FIRST" for a in anchors])
+    window = procs.filter(pl.col("minute").is_not_null()).join(anchor_firsts, on="row_idx").group_by("row_idx").agg([
+        (has_bit(proc_layout, proc_set)
+         & ((pl.col("minute") - pl.col(f"PR_{anchor}_FIRST")) // MINUTES_PER_DAY).is_between(low, high)).any().alias(name)
+        for name, (proc_set, anchor, low, high) in psi_rules.WINDOW_FEATURES.items()
+    ])
+    # Same-day counts include procedures of any code
+    dated = tables["proc"].filter(pl.col("minute").is_not_null()).join(anchor_firsts, on="row_idx")
+    day_counts = dated.group_by("row_idx").agg([
+        (pl.col("minute") // MINUTES_PER_DAY == pl.col(f"PR_{anchor}_FIRST") // MINUTES_PER_DAY).sum().cast(pl.Int64).alias(name)
+        for name, anchor in psi_rules.DAY_COUNT_FEATURES.items()
+    ])
+
+    fills = [pl.col(c).fill_null(0) for c in plane_cols + proc_planes]
+    for set_name in proc_sets:
+        fills += [pl.col(f"PR_{set_name}_COUNT").fill_null(0)]
+    fills += [pl.col(name).fill_null(False) for name in psi_rules.WINDOW_FEATURES]
+    fills += [pl.col(name).fill_null(0) for name in psi_rules.DAY_COUNT_FEATURES]
+
+    out = (tables["encounters"]
+           .join(dx, on="row_idx", how="left")
+           .join(pr, on="row_idx", how="left")
+           .join(window, on="row_idx", how="left")
+           .join(day_counts, on="row_idx", how="left")
+           .with_columns(fills)
+           .with_columns(dx_bits))
+    day_features = []
+    for set_name in sorted(proc_sets):
+        day_features += [has_bit(proc_layout, set_name, f"BITS_{psi_rules.PROC_PLANE}").alias(f"PR_{set_name}"),
+                         (pl.col(f"PR_{set_name}_FIRST") // MINUTES_PER_DAY).alias(f"PR_{set_name}_FIRST_DAY"),
+                         (pl.col(f"PR_{set_name}_LAST") // MINUTES_PER_DAY).alias(f"PR_{set_name}_LAST_DAY")]
+    out = out.with_columns(
+        day_features
+        + [pl.col("ADMIT_MINUTE").is_not_null().alias("HAS_ADMIT_DATE"),
+           pl.when(pl.col("ADMIT_MINUTE").is_not_null() & pl.col("PR_ORPROC_FIRST").is_not_null())
+             .then((pl.col("PR_ORPROC_FIRST") - pl.col("ADMIT_MINUTE")) // MINUTES_PER_DAY).alias("ADMIT_TO_FIRST_OR_DAYS")]
+        + [pl.col("MS_DRG_STR").is_in(sorted(rule_sets.get(s, ()))).fill_null(False).alias(f"MSDRG_{s}") for s in sorted(drg_sets)]
+    )
+    # Derived features may read earlier ones, so each is added in its own step
+    for name, expr in psi_rules.compile_derived_features(validate_timing):
+        out = out.with_columns(pl.sql_expr(expr).alias(name))
+    return out.with_columns(psi15_organ_features()).sort("row_idx")
+
+def psi15_organ_features():
+    """PSI15_QUALIFYING_LIST (list) and PSI15_ORGAN_ANALYSIS (list of struct), see psi_rules.PSI15_ORGAN_FEATURES."""
+    organs = psi_rules.PSI15_ORGAN_FEATURES
+    return [
+        pl.concat_list([pl.when(pl.col(qualifies)).then(pl.lit(organ)) for organ, qualifies, _ in organs])
+          .list.drop_nulls().alias("PSI15_QUALIFYING_LIST"),
+        pl.concat_list([pl.struct([pl.lit(organ).alias("organ")] + [pl.col(expr).alias(field) for field, expr in flags.items()])
+                        for organ, _, flags in organs]).alias("PSI15_ORGAN_ANALYSIS"),
+    ]
+
+def text_detail_exprs(psi):
+    """
+    The list Detail_ columns of `psi` rendered as text the way str() renders the pandas
+    engine's values (CSV output, which has no list type).
+    """
+    exprs = []
+    for column, kind in psi_rules.detail_kinds(psi).items():
+        if kind == "codes":
+            exprs.append(pl.when(pl.col(column).list.len() == 0).then(pl.lit("[]"))
+                         .otherwise(pl.lit("['") + pl.col(column).list.join("', '") + pl.lit("']")).alias(column))
+        elif kind == "organs":
+            entry = pl.concat_str(
+                [pl.lit("'"), pl.element().struct.field("organ"), pl.lit("': {")]
+                + [part for i, field in enumerate(psi_rules.ORGAN_ANALYSIS_FIELDS)
+                   for part in (pl.lit(("" if i == 0 else ", ") + f"'{field}': "),
+                                pl.when(pl.element().struct.field(field)).then(pl.lit("True")).otherwise(pl.lit("False")))]
+                + [pl.lit("}")]
+            )
+            exprs.append((pl.lit("{") + pl.col(column).list.eval(entry).list.join(", ") + pl.lit("}")).alias(column))
+    return exprs
+
+
+# --- Scoring ---
+def psi_frame(features, psi, validate_timing=True):
+    """LazyFrame with the result columns of one PSI (Reason and typed Param_ columns)."""
+    compiled = psi_rules.compile_psi(psi, validate_timing)
+    return features.select(
+        [pl.col("OUT_EncounterID").alias("EncounterID"), pl.lit(psi).alias("PSI"), pl.sql_expr(compiled["Status"]).alias("Status")]
+        + [pl.sql_expr(compiled[c]).alias(c) if c in compiled else pl.lit(None, dtype=pl.Utf8).alias(c)
+           for c in psi_rules.reason_columns(psi)]
+        + [pl.col("OUT_Age").alias("Age"), pl.col("OUT_MS_DRG").alias("MS_DRG"),
+         pl.col("OUT_PrincipalDX").alias("PrincipalDX"), pl.col("OUT_ATYPE").alias("ATYPE"),
+         pl.col("OUT_Length_of_Stay").alias("Length_of_Stay")]
+        + [pl.sql_expr(expr).alias(name) for name, expr in compiled.items() if name.startswith("Detail_")]
+    )
+
+def dimension_frame(source, dimensions, cache_dir=DEFAULT_CACHE_DIR):
+    """row_idx and the `dimensions` input columns (dim_0, dim_1, ...; null where absent) of funnel groups."""
+    lf = scan_input(source, cache_dir)
+    names = lf.collect_schema().names()
+    return lf.with_row_index("row_idx").select(
+        [pl.col("row_idx")] + [pl.col(d).alias(f"dim_{i}") if d in names else pl.lit(None).alias(f"dim_{i}")
+                               for i, d in enumerate(dimensions)]
+    ).collect(engine="streaming").lazy()
+
+def funnel_frame(features, psi, dimensions=None, validate_timing=True):
+    """
+    Encounters per Reason of one PSI (and per dimension_frame() value): a group_by on the
+    Reason expression alone, without the result's other columns.
+    """
+    frame = features.select(pl.col("row_idx"), pl.sql_expr(psi_rules.compile_psi(psi, validate_timing)["Reason"]).alias("Reason"))
+    groups = ["Reason"]
+    if dimensions is not None:
+        frame = frame.join(dimensions, on="row_idx", how="left")
+        groups = [c for c in dimensions.collect_schema().names() if c != "row_idx"] + groups
+    return frame.group_by(groups).len(name="Encounters").select(groups + ["Encounters"])
+
+def text_frame(frame, psi):
+    """
+    `frame`'s results in text form: the Rationale of each distinct reason and parameters is
+    rendered once (psi_rules.render_rationale) and joined back after Reason, in place of the
+    Param_ columns.
+    """
+    columns = psi_rules.reason_columns(psi)
+    reasons = frame.select(columns).unique().collect(engine="streaming")
+    rendered = psi_rules.render_rationale(psi, psi_rules.apply_reason_dtypes(psi, reasons.to_pandas()))
+    lookup = reasons.with_columns(pl.Series("Rationale", rendered.tolist(), dtype=pl.Utf8))
+    names = [c for c in frame.collect_schema().names() if c not in columns[1:]]
+    names.insert(names.index("Reason") + 1, "Rationale")
+    return frame.join(lookup.lazy(), on=columns, how="left", nulls_equal=True, maintain_order="left").select(names)
+
+def score(source, code_sets, psis=None, validate_timing=True, cache_dir=DEFAULT_CACHE_DIR, progress_callback=None,
+          use_cache=True, reasons="text", details="text"):
+    """
+    Scores a DataFrame or input file with Polars' streaming engine.
+    Returns {psi: pandas DataFrame} with the columns of psi_engine.score_dataframe's records
+    (with reasons="codes", the compact Param_ columns instead of Rationale; with
+    details="typed", the typed Detail_ columns).
+    File inputs go through the normalized Arrow cache unless `use_cache` is False.
+    """
+    return score_versions(source, {None: code_sets}, psis, validate_timing, cache_dir, progress_callback, use_cache, reasons,
+                          details)[None]
+
+def score_versions(source, versions, psis=None, validate_timing=True, cache_dir=DEFAULT_CACHE_DIR, progress_callback=None,
+                   use_cache=True, reasons="text", details="text", funnels=None):
+    """
+    score() against several appendix versions ({label: code_sets}). The normalized tables
+    are loaded (or built) once and shared; each version builds its own feature table from
+    them. Returns {label: {psi: pandas DataFrame}}. `funnels`
+    ({label: psi_funnel.FunnelCounter}) are counted from each version's feature table.
+    """
+    psis = list(psis or PSI_LIST)
+    funnels = funnels or {}
+    tables = load_normalized(source, cache_dir, use_cache)
+    if len(versions) > 1 and (not use_cache or not isinstance(source, str)):
+        # Uncached inputs are normalized once here rather than once per version (cached ones are memory-mapped)
+        tables = {name: frame.collect(engine="streaming").lazy() for name, frame in tables.items()}
+    results, done, total = {}, 0, len(psis) * len(versions)
+    for label, code_sets in versions.items():
+        features = features_from_normalized(tables, code_sets, psis, validate_timing).collect(engine="streaming").lazy()
+        funnel = funnels.get(label)
+        dimensions = dimension_frame(source, funnel.dimensions, cache_dir) if funnel and funnel.dimensions else None
+        results[label] = {}
+        for psi in psis:
+            if funnel is not None:
+                funnel.add_grouped(psi, funnel_frame(features, psi, dimensions, validate_timing).collect(engine="streaming").to_pandas())
+            df = psi_frame(features, psi, validate_timing).collect(engine="streaming")
+            # Detail columns no encounter has a value for are dropped (the pandas engine never creates them)
+            df = df.drop([c for c in df.columns if c.startswith("Detail_") and df[c].null_count() == len(df)])
+            # The native list/struct details become the typed or the text form
+            df = df.to_pandas()
+            df = psi_rules.type_details(psi, df) if details == "typed" else psi_rules.text_details(psi, df)
+            results[label][psi] = psi_rules.apply_reason_dtypes(psi, df)
+            if reasons == "text":
+                results[label][psi] = psi_rules.decode_reasons(psi, results[label][psi])
+            done += 1
+            if progress_callback:
+                progress_callback(done, total)
+    return results
+
+def score_to_files(source, code_sets, output_dir, psis=None, validate_timing=True, fmt="parquet",
+                   cache_dir=DEFAULT_CACHE_DIR, use_cache=True, reasons="text"):
+    """
+    Out-of-core scoring: streams the feature table to a temporary Parquet file,
+    then streams each PSI's results from it to <output_dir>/<PSI>.<fmt>.
+    Returns {psi: {status: count}}.
+    """
+    psis = list(psis or PSI_LIST)
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {}
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        feature_path = os.path.join(tmp_dir, "features.parquet")
+        tables = load_normalized(source, cache_dir, use_cache)
+        features_from_normalized(tables, code_sets, psis, validate_timing).sink_parquet(feature_path, engine="streaming")
+        for psi in psis:
+            path = os.path.join(output_dir, f"{psi}.{fmt}")
+            frame = psi_frame(pl.scan_parquet(feature_path), psi, validate_timing)
+            if reasons == "text":
+                frame = text_frame(frame, psi)
+            if fmt == "parquet":
+                # Detail_ lists and structs keep their native types
+                frame.sink_parquet(path, engine="streaming")
+                scan = pl.scan_parquet(path)
+            else:
+                frame.with_columns(text_detail_exprs(psi)).sink_csv(path, engine="streaming")
+                scan = pl.scan_csv(path)
+            status_counts = scan.group_by("Status").len().collect(engine="streaming")
+            counts[psi] = dict(zip(status_counts["Status"].to_list(), status_counts["len"].to_list()))
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score PSI 05-15 with the Polars streaming backend")
+    parser.add_argument("--input", required=True, help="Encounters (.xlsx, .csv or .parquet)")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--output-dir", required=True, help="Directory for <PSI>.parquet (or .csv) result files")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Where converted and normalized inputs are cached")
+    parser.add_argument("--no-cache", action="store_true", help="Re-read and re-normalize the input instead of using the cache")
+    parser.add_argument("--reasons", choices=psi_rules.REASON_FORMATS, default="text",
+                        help="Reason codes with the Rationale text, or with typed parameters (compact)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+
+    started = time.time()
+    code_sets = load_code_sets(args.appendix)
+    counts = score_to_files(args.input, code_sets, args.output_dir, psis, validate_timing=not args.no_timing_validation,
+                            fmt=args.format, cache_dir=args.cache_dir, use_cache=not args.no_cache,
+                            reasons=args.reasons)
+    print(json.dumps({"psis": counts, "seconds": round(time.time() - started, 2)}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Approximate preview: estimated PSI rates with confidence bounds from a stratified
+sample, for a first look at a large upload while the exact run is still going.
+
+Encounters are stratified by MDC, DRG family (surgical / medical / other, from the
+appendix's SURGI2R and MEDIC2R sets, which decide most PSI populations) and discharge
+quarter (YEAR, DQTR). Each stratum is sampled in proportion to its size, with at
+least MIN_PER_STRATUM encounters so small strata still get a variance estimate. The
+sample is scored with any backend and the rates are combined with the stratum
+weights; the bounds are Wilson intervals on the design's effective sample size, so a
+PSI with no sampled inclusion still gets a non-zero upper bound.
+
+    python psi_preview.py --input encounters.xlsx --appendix PSI_Appendix.xlsx --sample-size 2000
+    python psi_preview.py ... --exact      # also score everything and check the bounds
+
+In the Streamlit app the preview is scored when a job is submitted and shown until
+the job's exact results replace it (JobManager.record_preview).
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+import psi_engine
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_SIZE = 2000
+MIN_PER_STRATUM = 2 # Smallest sample for which a stratum's variance can be estimated
+DEFAULT_CONFIDENCE = 0.95
+
+PREVIEW_COLUMNS = ["PSI", "Encounters", "Sample_Size", "Sample_Inclusions", "Estimated_Inclusions",
+                   "Rate_per_1000", "Lower_per_1000", "Upper_per_1000"]
+
+
+# --- Sampling ---
+def assign_strata(df, code_sets):
+    """Stratum label per encounter: 'MDC|DRG family|YEAR Qn' (blank parts for missing values)."""
+    def text(column):
+        if column not in df.columns:
+            return pd.Series("", index=df.index)
+        return df[column].map(lambda v: "" if pd.isna(v) else str(v).strip())
+
+    drg = text("MS-DRG")
+    family = np.select([drg.isin(set(code_sets.get("SURGI2R_CODES", []))).to_numpy(),
+                        drg.isin(set(code_sets.get("MEDIC2R_CODES", []))).to_numpy()],
+                       ["surgical", "medical"], "other")
+    # Numeric columns read from Excel come back as floats (2024.0); the label keeps the integer
+    mdc, year, quarter = (text(c).str.replace(r"\.0$", "", regex=True) for c in ("MDC", "YEAR", "DQTR"))
+    return mdc + "|" + family + "|" + year + " Q" + quarter
+
+def stratified_sample(df, strata, sample_size=DEFAULT_SAMPLE_SIZE, seed=0):
+    """
+    Proportional stratified sample of about `sample_size` encounters (at least MIN_PER_STRATUM
+    per stratum, or the whole stratum if smaller). Returns (sample, stratum sizes in `df`).
+    """
+    sizes = strata.value_counts()
+    if sample_size >= len(df):
+        return df, sizes
+    allocation = (sizes * sample_size / len(df)).round().astype(int)
+    allocation = allocation.clip(lower=np.minimum(MIN_PER_STRATUM, sizes), upper=sizes)
+    rng = np.random.default_rng(seed)
+    positions = np.arange(len(df))
+    picked = []
+    for stratum, members in pd.Series(positions).groupby(strata.to_numpy()):
+        picked.append(rng.choice(members.to_numpy(), size=allocation[stratum], replace=False))
+    # Input order is kept so every backend sees the encounters as it would in the full run
+    return df.iloc[np.sort(np.concatenate(picked))], sizes
+
+
+# --- Estimation ---
+def _wilson(rate, n, z):
+    """Wilson score interval for a proportion observed on an (effective) sample of n."""
+    if n <= 0:
+        return 0.0, 1.0
+    center = (rate + z * z / (2 * n)) / (1 + z * z / n)
+    half = z / (1 + z * z / n) * np.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n))
+    return max(0.0, center - half), min(1.0, center + half)
+
+def estimate_rates(results, sample_strata, stratum_sizes, confidence=DEFAULT_CONFIDENCE):
+    """
+    Stratified rate estimates per PSI from the sample's results ({psi: DataFrame} in sample
+    order). The variance includes the finite population correction per stratum; the
+    interval is Wilson's on the effective sample size p(1-p)/variance.
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    total = int(stratum_sizes.sum())
+    weights = stratum_sizes / total
+    strata = pd.Series(np.asarray(sample_strata))
+    rows = []
+    for psi, frame in results.items():
+        included = pd.Series(frame["Status"].eq("Inclusion").to_numpy(), index=strata.index)
+        by_stratum = included.groupby(strata.to_numpy()).agg(["sum", "count"])
+        n_h = by_stratum["count"]
+        p_h = by_stratum["sum"] / n_h
+        W_h = weights.reindex(by_stratum.index)
+        N_h = stratum_sizes.reindex(by_stratum.index)
+        rate = float((W_h * p_h).sum())
+        fpc = 1 - n_h / N_h
+        variance = float((W_h ** 2 * fpc * p_h * (1 - p_h) / (n_h - 1).clip(lower=1)).sum())
+        sample_size = int(n_h.sum())
+        if sample_size >= total:
+            low = high = rate # Everything was scored: the rate is exact
+        else:
+            effective_n = min(rate * (1 - rate) / variance, sample_size) if variance > 0 else sample_size
+            low, high = _wilson(rate, effective_n, z)
+            low, high = min(low, rate), max(high, rate)
+        rows.append({
+            "PSI": psi, "Encounters": total, "Sample_Size": sample_size,
+            "Sample_Inclusions": int(by_stratum["sum"].sum()), "Estimated_Inclusions": round(rate * total),
+            "Rate_per_1000": round(rate * 1000, 2), "Lower_per_1000": round(low * 1000, 2),
+            "Upper_per_1000": round(high * 1000, 2),
+        })
+    return pd.DataFrame(rows, columns=PREVIEW_COLUMNS)
+
+def preview(df, psis, code_sets, sample_size=DEFAULT_SAMPLE_SIZE, validate_timing=True, backend="pandas",
+            confidence=DEFAULT_CONFIDENCE, seed=0):
+    """Scores a stratified sample of `df` and returns the estimate table (PREVIEW_COLUMNS)."""
+    strata = assign_strata(df, code_sets)
+    sample, sizes = stratified_sample(df, strata, sample_size, seed)
+    results = psi_engine.score_with_backend(sample, list(psis), code_sets, validate_timing=validate_timing,
+                                            backend=backend)
+    return estimate_rates(results, strata.loc[sample.index], sizes, confidence)
+
+def compare_to_exact(estimates, results):
+    """Adds the exact rate of finished results ({psi: DataFrame}) and whether it fell within the bounds."""
+    exact = {psi: round(frame["Status"].eq("Inclusion").mean() * 1000, 2) if len(frame) else 0.0
+             for psi, frame in results.items()}
+    compared = estimates.copy()
+    compared["Exact_Rate_per_1000"] = compared["PSI"].map(exact)
+    compared["Within_Bounds"] = compared["Exact_Rate_per_1000"].between(compared["Lower_per_1000"], compared["Upper_per_1000"])
+    return compared
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate PSI 05-15 rates from a stratified sample")
+    parser.add_argument("--input", required=True, help="Encounter file (.xlsx, .csv or .parquet)")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--sample-size", type=int, default=DEFAULT_SAMPLE_SIZE)
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--backend", choices=psi_engine.BACKENDS, default="pandas")
+    parser.add_argument("--exact", action="store_true", help="Also score every encounter and compare")
+    parser.add_argument("--output", help="Write the estimate table (.csv)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
+    validate_timing = not args.no_timing_validation
+
+    df = psi_engine.read_input_file(args.input)
+    code_sets = psi_engine.load_code_sets(args.appendix)
+    started = time.time()
+    estimates = preview(df, psis, code_sets, args.sample_size, validate_timing, args.backend, args.confidence, args.seed)
+    summary = {"encounters": len(df), "sample_size": int(estimates["Sample_Size"].iloc[0]),
+               "preview_seconds": round(time.time() - started, 2)}
+    if args.exact:
+        started = time.time()
+        results = psi_engine.score_with_backend(df, psis, code_sets, validate_timing=validate_timing, backend=args.backend)
+        estimates = compare_to_exact(estimates, results)
+        summary["exact_seconds"] = round(time.time() - started, 2)
+        summary["within_bounds"] = f"{int(estimates['Within_Bounds'].sum())}/{len(estimates)}"
+    if args.output:
+        estimates.to_csv(args.output, index=False)
+    logger.info("Estimated %d PSIs from %d of %d encounters", len(psis), summary["sample_size"], len(df))
+    print(estimates.to_string(index=False))
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
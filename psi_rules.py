@@ -0,0 +1,855 @@
+"""
+Declarative PSI 05-15 rule table for the columnar scoring backends.
+
+`evaluate_psi_comprehensive` in psi_engine.py is the reference implementation
+and walks one encounter at a time. The columnar backends (psi_duckdb.py,
+psi_polars.py) instead build a per-encounter feature table and evaluate the
+rules below over whole columns. Every rule is a SQL predicate over feature
+columns; both DuckDB and Polars (`pl.sql_expr`) evaluate the same strings, so
+the PSI logic is written once for both backends.
+
+Feature column naming (computed by the backends):
+    DX_<SET>_<SCOPE>          any diagnosis of code set <SET> in scope, where SCOPE is
+                              P (principal), S (secondary), SY / SN (secondary with POA Y / N),
+                              A (any position), AY / AN (any position with POA Y / N)
+    DX_<SET>_<SCOPE>_FIRST    first matching code (diagnosis order)
+    DX_<SET>_<SCOPE>_LIST     all matching codes in diagnosis order (a list; NULL if none)
+    PR_<SET>                  any procedure of <SET>
+    PR_<SET>_COUNT            number of procedures of <SET> (dated or not)
+    PR_<SET>_FIRST / _LAST    first / last procedure minute (int64 epoch minutes, NULL if none dated)
+    PR_<SET>_FIRST_DAY / _LAST_DAY   calendar day numbers of the above
+    MSDRG_<SET>               MS-DRG (as a string) is in <SET>
+    BITS_<PLANE>_<WORD>       code set membership bit planes (see MembershipLayout); the DX_ and
+                              PR_ flags above are bit tests on them
+    AGE, AGE_STR, LOS, LOS_STR, ATYPE_3, MDC_4, DRG_VALUE, MISSING_FIELDS,
+    ADMIT_MINUTE, HAS_ADMIT_DATE, ADMIT_TO_FIRST_OR_DAYS     encounter fields
+plus the WINDOW_FEATURES, DAY_COUNT_FEATURES, DERIVED_FEATURES and PSI15_ORGAN_FEATURES
+defined below.
+<SET> is an appendix code set name without the _CODES suffix, or one of DERIVED_SETS.
+"""
+import re
+
+import pandas as pd
+
+from psi_engine import PSI_LIST, RULE_PARAMETERS, OrganSystem
+
+# --- Code sets ---
+# Combinations of appendix code sets used by the rules: (union of, minus union of)
+DERIVED_SETS = {
+    "FXNOTHIP": (["FXID"], ["HIPFXID"]), # PSI 08 other (non-hip) fracture
+    "DVTPE": (["DEEPVIB", "PULMOID"], []), # PSI 12 numerator
+    "ORNOTVT": (["ORPROC"], ["VENACIP", "THROMP"]), # PSI 12 OR procedures other than vena cava interruption/thrombectomy
+    "INJ15": (["SPLEEN15D", "ADRENAL15D", "VESSEL15D", "DIAPHR15D", "GI15D", "GU15D"], []), # PSI 15 any organ injury
+}
+
+# PSI 15 organ systems -> (injury dx set, related procedure set), in OrganSystem order
+PSI15_ORGAN_SETS = {
+    OrganSystem.SPLEEN: ("SPLEEN15D", "SPLEEN15P"),
+    OrganSystem.ADRENAL: ("ADRENAL15D", "ADRENAL15P"),
+    OrganSystem.VESSEL: ("VESSEL15D", "VESSEL15P"),
+    OrganSystem.DIAPHRAGM: ("DIAPHR15D", "DIAPHR15P"),
+    OrganSystem.GASTROINTESTINAL: ("GI15D", "GI15P"),
+    OrganSystem.GENITOURINARY: ("GU15D", "GU15P"),
+}
+
+def build_rule_code_sets(code_sets):
+    """Returns {set name: set of codes} for every appendix code set plus DERIVED_SETS."""
+    sets = {name[:-len("_CODES")] if name.endswith("_CODES") else name: set(codes) for name, codes in code_sets.items()}
+    for name, (union_of, minus) in DERIVED_SETS.items():
+        codes = set().union(*(sets.get(s, set()) for s in union_of))
+        sets[name] = codes.difference(*(sets.get(s, set()) for s in minus))
+    return sets
+
+# --- Features computed from procedure timing ---
+# name -> (procedure set, anchor set, min days, max days): any dated procedure of the set
+# whose day offset from the anchor set's first procedure is within [min, max]
+WINDOW_PARAMETERS = ("PSI15_WINDOW_MIN_DAYS", "PSI15_WINDOW_MAX_DAYS") # RULE_PARAMETERS giving min / max days
+WINDOW_FEATURES = {
+    f"PSI15_{organ.name}_WINDOW": (proc_set, "ABDOMI15P") + tuple(RULE_PARAMETERS[p] for p in WINDOW_PARAMETERS)
+    for organ, (_, proc_set) in PSI15_ORGAN_SETS.items()
+}
+# name -> anchor set: number of dated procedures (any code) on the anchor set's first procedure day
+DAY_COUNT_FEATURES = {
+    "PSI15_INDEX_DAY_PROCS": "ABDOMI15P",
+}
+
+
+# --- SQL helpers ---
+def sql_str(text):
+    """SQL string literal."""
+    return "'" + text.replace("'", "''") + "'"
+
+def fill_parameters(template, parameters=None):
+    """
+    A rationale template with its RULE_PARAMETERS placeholders filled in, e.g.
+    "Length of stay < {MIN_LOS_DAYS} days" -> "Length of stay < 2 days". `parameters`
+    overrides the values (the active parameter set); other placeholders are kept.
+    """
+    values = dict(RULE_PARAMETERS, **(parameters or {}))
+    return re.sub(r"\{([A-Z0-9_]+)\}", lambda m: format_param(m.group(1), values[m.group(1)]) if m.group(1) in values else m.group(0),
+                  template)
+
+# Per-encounter features derived from other features, evaluated in order.
+# `{validate_timing}` is replaced with TRUE/FALSE when the rules are compiled, and
+# `{<RULE_PARAMETERS name>}` with the parameter's value.
+DERIVED_FEATURES = {
+    # PSI 11 numerator criteria
+    "PSI11_CRIT1": "DX_ACURF2D_SN",
+    "PSI11_CRIT2": "CASE WHEN {validate_timing} AND PR_ORPROC_FIRST IS NOT NULL "
+                   "THEN COALESCE(PR_PR9672P_LAST >= PR_ORPROC_FIRST, FALSE) "
+                   "WHEN NOT {validate_timing} THEN PR_PR9672P_COUNT > 0 ELSE FALSE END",
+    "PSI11_CRIT3": "CASE WHEN {validate_timing} AND PR_ORPROC_FIRST IS NOT NULL "
+                   "THEN COALESCE(PR_PR9671P_LAST >= PR_ORPROC_FIRST + {PSI11_VENT_OFFSET_DAYS} * 1440, FALSE) "
+                   "WHEN NOT {validate_timing} THEN PR_PR9671P_COUNT > 0 ELSE FALSE END",
+    "PSI11_CRIT4": "CASE WHEN {validate_timing} AND PR_ORPROC_FIRST IS NOT NULL "
+                   "THEN COALESCE(PR_PR9604P_LAST >= PR_ORPROC_FIRST + {PSI11_INTUBATION_OFFSET_DAYS} * 1440, FALSE) "
+                   "WHEN NOT {validate_timing} THEN PR_PR9604P_COUNT > 0 ELSE FALSE END",
+    # PSI 13 risk category (classify_immune_compromise)
+    "PSI13_RISK": "CASE WHEN DX_SEVEREIMMUNED_AY OR DX_SEVEREIMMUNED_AN THEN 'severe_immune_compromise' "
+                  "WHEN DX_MODERATEIMMUNED_AY OR DX_MODERATEIMMUNED_AN THEN 'moderate_immune_compromise' "
+                  "WHEN DX_MALIGNANCY_A AND (PR_CHEMOTHERAPYP OR PR_RADIATIONP) THEN 'malignancy_with_treatment' "
+                  "ELSE 'baseline_risk' END",
+    # PSI 15 risk category (classify_procedure_complexity_psi15)
+    "PSI15_RISK": "CASE WHEN PSI15_INDEX_DAY_PROCS >= {PSI15_HIGH_COMPLEXITY_PROCS} THEN 'high_complexity' "
+                  "WHEN PSI15_INDEX_DAY_PROCS >= {PSI15_MODERATE_COMPLEXITY_PROCS} THEN 'moderate_complexity' "
+                  "ELSE 'low_complexity' END",
+}
+for _organ, (_injury_set, _) in PSI15_ORGAN_SETS.items():
+    DERIVED_FEATURES[f"PSI15_{_organ.name}_POA_EXCLUDED"] = f"DX_{_injury_set}_SY AND PSI15_{_organ.name}_WINDOW"
+    DERIVED_FEATURES[f"PSI15_{_organ.name}_QUALIFIES"] = (
+        f"DX_{_injury_set}_SN AND PSI15_{_organ.name}_WINDOW AND NOT PSI15_{_organ.name}_POA_EXCLUDED"
+    )
+DERIVED_FEATURES["PSI15_ANY_QUALIFIES"] = " OR ".join(f"PSI15_{o.name}_QUALIFIES" for o in PSI15_ORGAN_SETS)
+DERIVED_FEATURES["PSI15_QUALIFYING"] = "concat_ws(', ', " + ", ".join(
+    f"CASE WHEN PSI15_{o.name}_QUALIFIES THEN {sql_str(o.value)} END" for o in PSI15_ORGAN_SETS) + ")"
+
+# PSI 15 detail features with list and struct values. SQL strings cannot build those in both
+# backends, so each builds them natively after the derived features (DuckDB list_filter /
+# struct_pack, Polars concat_list / struct) from these boolean features:
+#   PSI15_QUALIFYING_LIST   list of the organs whose PSI15_<ORGAN>_QUALIFIES holds
+#   PSI15_ORGAN_ANALYSIS    list of {organ, ORGAN_ANALYSIS_FIELDS...}, one per organ system
+PSI15_ORGAN_FEATURES = [
+    (organ.value, f"PSI15_{organ.name}_QUALIFIES",
+     {"has_injury_dx": f"DX_{injury_set}_SN", "has_related_proc_in_window": f"PSI15_{organ.name}_WINDOW",
+      "is_poa_excluded": f"PSI15_{organ.name}_POA_EXCLUDED"})
+    for organ, (injury_set, _) in PSI15_ORGAN_SETS.items()
+]
+
+
+# --- Rule table ---
+class Step:
+    """An exclusion step: if `condition` holds the encounter is excluded with `message`."""
+    def __init__(self, code, condition, message):
+        self.code = code
+        self.condition = condition
+        self.message = message
+
+class Outcome:
+    """A numerator branch: the first outcome whose condition holds decides status and message."""
+    def __init__(self, code, condition, status, message, details=None):
+        self.code = code
+        self.condition = condition
+        self.status = status
+        self.message = message
+        self.details = details or {} # detail key -> SQL expression
+
+class Note:
+    """An extra rationale entry for encounters that reach the numerator stage."""
+    def __init__(self, condition, message):
+        self.condition = condition
+        self.message = message
+
+class PsiRules:
+    """Steps (in order), numerator outcomes, notes and details of one PSI."""
+    def __init__(self, steps, outcomes, notes_before=(), notes_after=(), details_before=None, details_after=None):
+        self.steps = list(steps)
+        self.outcomes = list(outcomes)
+        self.notes_before = list(notes_before)
+        self.notes_after = list(notes_after)
+        self.details_before = details_before or {}
+        self.details_after = details_after or {}
+
+    def detail_keys(self):
+        """Detail keys in a fixed order (the per-PSI Detail_* schema)."""
+        keys = list(self.details_before)
+        for outcome in self.outcomes:
+            keys += [k for k in outcome.details if k not in keys]
+        return keys + [k for k in self.details_after if k not in keys]
+
+TIMED = "{validate_timing} AND HAS_ADMIT_DATE" # Timing rules that also require an admission date
+
+# Data quality and population exclusions shared by every PSI
+COMMON_STEPS = [
+    Step("DQ_DRG_999", "DRG_VALUE = 999", "Data Quality: Ungroupable DRG (999)"),
+    Step("DQ_MISSING_FIELDS", "MISSING_FIELDS IS NOT NULL", "Data Quality: Missing required fields ({MISSING_FIELDS})"),
+    Step("POP_MDC14", "DX_MDC14PRINDX_P", "Population Exclusion: Principal diagnosis in MDC 14 (Obstetric)"),
+    Step("POP_MDC15", "DX_MDC15PRINDX_P", "Population Exclusion: Principal diagnosis in MDC 15 (Neonatal)"),
+    Step("AGE_UNDER_18", "AGE < 18", "Age Exclusion: Patient age {AGE_STR} < 18 years"),
+]
+
+def _timing_outcomes(dx, proc, found_message, details, mismatch_message, dx_only_message, proc_only_message, none_message):
+    """PSI 09/10 numerator: diagnosis AND procedure, with the procedure after the first OR procedure."""
+    both = f"DX_{dx}_SN AND PR_{proc}"
+    dated = f"PR_ORPROC_FIRST IS NOT NULL AND PR_{proc}_FIRST IS NOT NULL"
+    return [
+        Outcome("NUMERATOR", f"{both} AND {{validate_timing}} AND {dated} AND PR_{proc}_FIRST > PR_ORPROC_FIRST",
+                "Inclusion", f"{found_message} (DX: {{DX_{dx}_SN_FIRST}})", details),
+        Outcome("NUM_TIMING_MISMATCH", f"{both} AND {{validate_timing}} AND {dated}", "Exclusion", mismatch_message),
+        Outcome("NUMERATOR_NO_TIMING", f"{both} AND NOT {{validate_timing}}",
+                "Inclusion", f"{found_message} (DX: {{DX_{dx}_SN_FIRST}}) (Timing validation off)", details),
+        Outcome("NUM_MISSING_DATES", both, "Exclusion", "Numerator: Missing procedure dates for timing validation"),
+        Outcome("NUM_DX_ONLY", f"DX_{dx}_SN", "Exclusion", dx_only_message),
+        Outcome("NUM_PROC_ONLY", f"PR_{proc}", "Exclusion", proc_only_message),
+        Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", none_message),
+    ]
+
+PSI_RULES = {
+    "PSI_05": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT ((AGE >= 18 AND (MSDRG_SURGI2R OR MSDRG_MEDIC2R)) OR DX_MDC14PRINDX_P)",
+                 "Population Exclusion: Not surgical/medical DRG (>=18) or obstetric case (any age)"),
+            Step("EXCL_PRINCIPAL_FOREIID", "DX_FOREIID_P", "Exclusion: Principal diagnosis of retained surgical item"),
+            Step("EXCL_POA_FOREIID", "DX_FOREIID_SY",
+                 "Exclusion: Secondary diagnosis of retained surgical item Present on Admission (POA=Y)"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "DX_FOREIID_SN", "Inclusion",
+                    "Numerator: Retained surgical item found (DX: {DX_FOREIID_SN_FIRST}, POA: N)",
+                    {"retained_surgical_item_matches": "DX_FOREIID_SN_LIST"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying retained surgical item diagnosis found for numerator"),
+        ],
+    ),
+    "PSI_06": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND (MSDRG_SURGI2R OR MSDRG_MEDIC2R))",
+                 "Population Exclusion: Not surgical/medical DRG or age < 18"),
+            Step("EXCL_PRINCIPAL_IATPTXD", "DX_IATPTXD_P", "Exclusion: Principal diagnosis of non-traumatic pneumothorax"),
+            Step("EXCL_POA_IATPTXD", "DX_IATPTXD_SY", "Exclusion: Secondary diagnosis of non-traumatic pneumothorax POA=Y"),
+            Step("EXCL_CHEST_TRAUMA", "DX_CTRAUMD_A", "Exclusion: Any diagnosis of specified chest trauma"),
+            Step("EXCL_PLEURAL_EFFUSION", "DX_PLEURAD_A", "Exclusion: Any diagnosis of pleural effusion"),
+            Step("EXCL_THORACIC_CARDIAC_PROC", "PR_THORAIP OR PR_CARDSIP",
+                 "Exclusion: Thoracic surgery or trans-pleural cardiac procedure"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "DX_IATROID_SN", "Inclusion",
+                    "Numerator: Iatrogenic pneumothorax found (DX: {DX_IATROID_SN_FIRST}, POA: N)",
+                    {"iatrogenic_pneumothorax_matches": "DX_IATROID_SN_LIST"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying iatrogenic pneumothorax diagnosis found for numerator"),
+        ],
+    ),
+    "PSI_07": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT ((AGE >= 18 AND (MSDRG_SURGI2R OR MSDRG_MEDIC2R)) OR DX_MDC14PRINDX_P)",
+                 "Population Exclusion: Not surgical/medical DRG (>=18) or obstetric case (any age)"),
+            Step("EXCL_PRINCIPAL_IDTMC3D", "DX_IDTMC3D_P", "Exclusion: Principal diagnosis of CVC-related BSI"),
+            Step("EXCL_POA_IDTMC3D", "DX_IDTMC3D_SY", "Exclusion: Secondary diagnosis of CVC-related BSI POA=Y"),
+            Step("EXCL_LOS_SHORT", "LOS IS NOT NULL AND LOS < {MIN_LOS_DAYS}",
+                 "Exclusion: Length of stay < {MIN_LOS_DAYS} days ({LOS_STR} days)"),
+            Step("EXCL_CANCER", "DX_CANCEID_A", "Exclusion: Any diagnosis of cancer"),
+            Step("EXCL_IMMUNOCOMPROMISED", "DX_IMMUNID_A OR PR_IMMUNIP",
+                 "Exclusion: Any diagnosis/procedure for immunocompromised state"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "DX_IDTMC3D_SN", "Inclusion",
+                    "Numerator: CVC-related BSI found (DX: {DX_IDTMC3D_SN_FIRST}, POA: N)",
+                    {"cvc_bsi_matches": "DX_IDTMC3D_SN_LIST"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying CVC-related BSI diagnosis found for numerator"),
+        ],
+    ),
+    "PSI_08": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND (MSDRG_SURGI2R OR MSDRG_MEDIC2R))",
+                 "Population Exclusion: Not surgical/medical DRG or age < 18"),
+            Step("EXCL_PRINCIPAL_FXID", "DX_FXID_P", "Exclusion: Principal diagnosis of fracture"),
+            Step("EXCL_POA_FXID", "DX_FXID_SY", "Exclusion: Secondary diagnosis of fracture POA=Y"),
+            Step("EXCL_PROSTHESIS_FRACTURE", "DX_PROSFXID_A", "Exclusion: Any diagnosis of joint prosthesis-associated fracture"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR_HIP", "DX_HIPFXID_SN", "Inclusion",
+                    "Numerator: Hip fracture found (DX: {DX_HIPFXID_SN_FIRST}, POA: N)",
+                    {"fracture_type": "'hip_fracture'", "hip_fracture_matches": "DX_HIPFXID_SN_LIST", "overall_fracture": "TRUE"}),
+            Outcome("NUMERATOR_OTHER", "DX_FXNOTHIP_SN", "Inclusion",
+                    "Numerator: Other fracture found (DX: {DX_FXNOTHIP_SN_FIRST}, POA: N)",
+                    {"fracture_type": "'other_fracture'", "other_fracture_matches": "DX_FXNOTHIP_SN_LIST", "overall_fracture": "TRUE"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying in-hospital fracture found for numerator"),
+        ],
+    ),
+    "PSI_09": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND MSDRG_SURGI2R AND PR_ORPROC)",
+                 "Population Exclusion: Not surgical DRG (>=18) or no OR procedure"),
+            Step("EXCL_PRINCIPAL_POHMRI2D", "DX_POHMRI2D_P", "Exclusion: Principal diagnosis of postoperative hemorrhage/hematoma"),
+            Step("EXCL_POA_POHMRI2D", "DX_POHMRI2D_SY",
+                 "Exclusion: Secondary diagnosis of postoperative hemorrhage/hematoma POA=Y"),
+            Step("EXCL_COAGULATION_DISORDER", "DX_COAGDID_A", "Exclusion: Any diagnosis of coagulation disorder"),
+            Step("EXCL_PRINCIPAL_MEDBLEEDD", "DX_MEDBLEEDD_P", "Exclusion: Principal diagnosis of medication-related coagulopathy"),
+            Step("EXCL_POA_MEDBLEEDD", "DX_MEDBLEEDD_SY",
+                 "Exclusion: Secondary diagnosis of medication-related coagulopathy POA=Y"),
+            Step("EXCL_ONLY_OR_IS_TREATMENT", f"{TIMED} AND PR_ORPROC_COUNT = 1 AND PR_HEMOTH2P_COUNT > 0",
+                 "Exclusion: Only OR procedure is for hemorrhage/hematoma treatment"),
+            Step("EXCL_TREATMENT_BEFORE_OR", f"{TIMED} AND PR_HEMOTH2P_FIRST IS NOT NULL AND PR_ORPROC_FIRST IS NOT NULL "
+                 "AND PR_HEMOTH2P_FIRST < PR_ORPROC_FIRST",
+                 "Exclusion: Hemorrhage treatment before first OR procedure"),
+            Step("EXCL_THROMBOLYTIC_BEFORE_TREATMENT", f"{TIMED} AND PR_THROMBOLYTICP_FIRST_DAY IS NOT NULL "
+                 "AND PR_HEMOTH2P_FIRST_DAY IS NOT NULL AND PR_THROMBOLYTICP_FIRST_DAY <= PR_HEMOTH2P_FIRST_DAY",
+                 "Exclusion: Thrombolytic therapy before/same day as hemorrhage treatment"),
+        ],
+        outcomes=_timing_outcomes(
+            "POHMRI2D", "HEMOTH2P", "Numerator: Postop hemorrhage/hematoma with treatment",
+            {"hemorrhage_dx_matches": "DX_POHMRI2D_SN_LIST", "has_treatment_procedure": "TRUE"},
+            "Numerator: Hemorrhage treatment procedure occurred before or same day as first OR procedure (timing mismatch)",
+            "Numerator: Postop hemorrhage/hematoma diagnosis found, but no qualifying treatment procedure",
+            "Numerator: Treatment procedure found, but no qualifying postop hemorrhage/hematoma diagnosis",
+            "No qualifying postop hemorrhage/hematoma diagnosis or treatment procedure found for numerator",
+        ),
+    ),
+    "PSI_10": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND MSDRG_SURGI2R AND ATYPE_3 AND PR_ORPROC)",
+                 "Population Exclusion: Not elective surgical DRG (>=18) or no OR procedure"),
+            Step("EXCL_PRINCIPAL_PHYSIDB", "DX_PHYSIDB_P", "Exclusion: Principal diagnosis of acute kidney failure"),
+            Step("EXCL_POA_PHYSIDB", "DX_PHYSIDB_SY", "Exclusion: Secondary diagnosis of acute kidney failure POA=Y"),
+            Step("EXCL_DIALYSIS_BEFORE_OR", f"{TIMED} AND PR_DIALYIP_FIRST_DAY IS NOT NULL AND PR_ORPROC_FIRST_DAY IS NOT NULL "
+                 "AND PR_DIALYIP_FIRST_DAY <= PR_ORPROC_FIRST_DAY",
+                 "Exclusion: Dialysis procedure before or same day as first OR procedure"),
+            Step("EXCL_DIALYSIS_ACCESS_BEFORE_OR", f"{TIMED} AND PR_DIALY2P_FIRST_DAY IS NOT NULL AND PR_ORPROC_FIRST_DAY IS NOT NULL "
+                 "AND PR_DIALY2P_FIRST_DAY <= PR_ORPROC_FIRST_DAY",
+                 "Exclusion: Dialysis access procedure before or same day as first OR procedure"),
+            Step("EXCL_CARDIAC_SHOCK", "DX_CARDIID_P OR DX_CARDRID_P OR DX_SHOCKID_P "
+                 "OR DX_CARDIID_SY OR DX_CARDRID_SY OR DX_SHOCKID_SY",
+                 "Exclusion: Principal/POA diagnosis of cardiac arrest, dysrhythmia, or shock"),
+            Step("EXCL_CKD5_ESRD", "DX_CRENLFD_P OR DX_CRENLFD_SY", "Exclusion: Principal/POA diagnosis of CKD stage 5 or ESRD"),
+            Step("EXCL_PRINCIPAL_URINARY_OBSTRUCTION", "DX_URINARYOBSID_P",
+                 "Exclusion: Principal diagnosis of urinary tract obstruction"),
+            Step("EXCL_SOLITARY_KIDNEY_NEPHRECTOMY", "DX_SOLKIDD_AY AND PR_PNEPHREP",
+                 "Exclusion: Solitary kidney (POA) with partial/total nephrectomy"),
+        ],
+        outcomes=_timing_outcomes(
+            "PHYSIDB", "DIALYIP", "Numerator: Postop AKI requiring dialysis",
+            {"aki_dx_matches": "DX_PHYSIDB_SN_LIST", "has_dialysis_procedure": "TRUE"},
+            "Numerator: Dialysis procedure occurred before or same day as first OR procedure (timing mismatch)",
+            "Numerator: AKI diagnosis found, but no qualifying dialysis procedure",
+            "Numerator: Dialysis procedure found, but no qualifying AKI diagnosis",
+            "No qualifying postop AKI diagnosis or dialysis procedure found for numerator",
+        ),
+    ),
+    "PSI_11": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND MSDRG_SURGI2R AND ATYPE_3 AND PR_ORPROC)",
+                 "Population Exclusion: Not elective surgical DRG (>=18) or no OR procedure"),
+            Step("EXCL_PRINCIPAL_ACURF3D", "DX_ACURF3D_P", "Exclusion: Principal diagnosis of acute respiratory failure"),
+            Step("EXCL_POA_ACURF3D", "DX_ACURF3D_SY", "Exclusion: Secondary diagnosis of acute respiratory failure POA=Y"),
+            Step("EXCL_POA_TRACHEOSTOMY_DX", "DX_TRACHID_AY", "Exclusion: Any diagnosis of tracheostomy POA=Y"),
+            Step("EXCL_ONLY_OR_IS_TRACHEOSTOMY", "PR_ORPROC_COUNT = 1 AND PR_TRACHIP_COUNT > 0",
+                 "Exclusion: Only OR procedure is tracheostomy"),
+            Step("EXCL_TRACHEOSTOMY_BEFORE_OR", "{validate_timing} AND PR_TRACHIP_FIRST IS NOT NULL AND PR_ORPROC_FIRST IS NOT NULL "
+                 "AND PR_TRACHIP_FIRST < PR_ORPROC_FIRST",
+                 "Exclusion: Tracheostomy procedure before first OR procedure"),
+            Step("EXCL_MALIGNANT_HYPERTHERMIA", "DX_MALHYPD_A", "Exclusion: Any diagnosis of malignant hyperthermia"),
+            Step("EXCL_POA_NEUROMUSCULAR", "DX_NEUROMD_AY", "Exclusion: Any diagnosis of neuromuscular disorder POA=Y"),
+            Step("EXCL_POA_DEGENERATIVE_NEURO", "DX_DGNEUID_AY",
+                 "Exclusion: Any diagnosis of degenerative neurological disorder POA=Y"),
+            Step("EXCL_HIGH_RISK_SURGERY", "PR_NUCRANP OR PR_PRESOPP OR PR_LUNGCIP OR PR_LUNGTRANSP",
+                 "Exclusion: Patient underwent high-risk surgery (e.g., head/neck, esophageal, lung transplant)"),
+            Step("EXCL_MDC4", "MDC_4", "Exclusion: MDC 4 (Respiratory System Disorders)"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "PSI11_CRIT1 OR PSI11_CRIT2 OR PSI11_CRIT3 OR PSI11_CRIT4", "Inclusion",
+                    "Numerator: Patient meets at least one postoperative respiratory complication criterion.",
+                    {"crit1_met": "PSI11_CRIT1", "crit2_met": "PSI11_CRIT2", "crit3_met": "PSI11_CRIT3", "crit4_met": "PSI11_CRIT4"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying postoperative respiratory failure criteria met for numerator."),
+        ],
+    ),
+    "PSI_12": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND MSDRG_SURGI2R AND PR_ORPROC)",
+                 "Population Exclusion: Not surgical DRG (>=18) or no OR procedure"),
+            Step("EXCL_PRINCIPAL_DVT_PE", "DX_DEEPVIB_P OR DX_PULMOID_P", "Exclusion: Principal diagnosis of DVT or PE"),
+            Step("EXCL_POA_DVT_PE", "DX_DEEPVIB_SY OR DX_PULMOID_SY", "Exclusion: Secondary diagnosis of DVT or PE POA=Y"),
+            Step("EXCL_SECONDARY_HIT", "DX_HITD_S", "Exclusion: Secondary diagnosis of heparin-induced thrombocytopenia"),
+            Step("EXCL_POA_BRAIN_SPINAL_INJURY", "DX_NEURTRAD_AY", "Exclusion: Any diagnosis of acute brain or spinal injury POA=Y"),
+            Step("EXCL_ECMO", "PR_ECMOP", "Exclusion: Patient underwent ECMO procedure"),
+            Step("EXCL_VENA_CAVA_BEFORE_OR", f"{TIMED} AND PR_VENACIP_FIRST_DAY IS NOT NULL AND PR_ORPROC_FIRST_DAY IS NOT NULL "
+                 "AND PR_VENACIP_FIRST_DAY <= PR_ORPROC_FIRST_DAY",
+                 "Exclusion: Vena cava interruption before/same day as first OR procedure"),
+            Step("EXCL_THROMBECTOMY_BEFORE_OR", f"{TIMED} AND PR_THROMP_FIRST_DAY IS NOT NULL AND PR_ORPROC_FIRST_DAY IS NOT NULL "
+                 "AND PR_THROMP_FIRST_DAY <= PR_ORPROC_FIRST_DAY",
+                 "Exclusion: Thrombectomy before/same day as first OR procedure"),
+            Step("EXCL_ONLY_OR_IS_VENA_CAVA_THROMBECTOMY", f"{TIMED} AND PR_ORPROC_COUNT > 0 AND PR_ORNOTVT_COUNT = 0",
+                 "Exclusion: Only OR procedures are vena cava interruption/thrombectomy"),
+            Step("EXCL_FIRST_OR_LATE", f"{TIMED} AND ADMIT_TO_FIRST_OR_DAYS IS NOT NULL AND ADMIT_TO_FIRST_OR_DAYS >= {{FIRST_OR_EXCLUSION_DAY}}",
+                 "Exclusion: First OR procedure on/after {FIRST_OR_EXCLUSION_DAY} day of admission (Day {ADMIT_TO_FIRST_OR_DAYS})"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "DX_DVTPE_SN", "Inclusion",
+                    "Numerator: Perioperative DVT/PE found (DX: {DX_DVTPE_SN_FIRST}, POA: N)",
+                    {"dvt_pe_matches": "DX_DVTPE_SN_LIST"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying perioperative DVT/PE diagnosis found for numerator"),
+        ],
+    ),
+    "PSI_13": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND MSDRG_SURGI2R AND ATYPE_3 AND PR_ORPROC)",
+                 "Population Exclusion: Not elective surgical DRG (>=18) or no OR procedure"),
+            Step("EXCL_PRINCIPAL_SEPSIS", "DX_SEPTI2D_P", "Exclusion: Principal diagnosis of sepsis"),
+            Step("EXCL_POA_SEPSIS", "DX_SEPTI2D_SY", "Exclusion: Secondary diagnosis of sepsis POA=Y"),
+            Step("EXCL_PRINCIPAL_INFECTION", "DX_INFECID_P", "Exclusion: Principal diagnosis of general infection"),
+            Step("EXCL_POA_INFECTION", "DX_INFECID_SY", "Exclusion: Secondary diagnosis of general infection POA=Y"),
+            Step("EXCL_FIRST_OR_LATE", f"{TIMED} AND ADMIT_TO_FIRST_OR_DAYS IS NOT NULL AND ADMIT_TO_FIRST_OR_DAYS >= {{FIRST_OR_EXCLUSION_DAY}}",
+                 "Exclusion: First OR procedure on/after {FIRST_OR_EXCLUSION_DAY} day of admission (Day {ADMIT_TO_FIRST_OR_DAYS})"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "DX_SEPTI2D_SN", "Inclusion",
+                    "Numerator: Postoperative sepsis found (DX: {DX_SEPTI2D_SN_FIRST}, POA: N)",
+                    {"sepsis_matches": "DX_SEPTI2D_SN_LIST"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying postoperative sepsis diagnosis found for numerator"),
+        ],
+        notes_after=[Note("TRUE", "Risk Category: {PSI13_RISK}")],
+        details_after={"risk_category": "PSI13_RISK"},
+    ),
+    "PSI_14": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND (PR_ABDOMIPOPEN OR PR_ABDOMIPOTHER))",
+                 "Population Exclusion: Not age >= 18 or no abdominopelvic surgery"),
+            Step("EXCL_PRINCIPAL_WOUND_DISRUPTION", "DX_ABWALLCD_P", "Exclusion: Principal diagnosis of wound disruption"),
+            Step("EXCL_POA_WOUND_DISRUPTION", "DX_ABWALLCD_SY", "Exclusion: Secondary diagnosis of wound disruption POA=Y"),
+            Step("EXCL_LOS_SHORT", "LOS IS NOT NULL AND LOS < {MIN_LOS_DAYS}",
+                 "Exclusion: Length of stay < {MIN_LOS_DAYS} days ({LOS_STR})"),
+            Step("EXCL_RECLOSURE_BEFORE_OPEN", "{validate_timing} AND PR_RECLOIP_LAST_DAY IS NOT NULL "
+                 "AND PR_ABDOMIPOPEN_FIRST_DAY IS NOT NULL AND PR_RECLOIP_LAST_DAY <= PR_ABDOMIPOPEN_FIRST_DAY",
+                 "Exclusion: Reclosure before/same day as first open abdominopelvic surgery"),
+            Step("EXCL_RECLOSURE_BEFORE_NON_OPEN", "{validate_timing} AND PR_RECLOIP_LAST_DAY IS NOT NULL "
+                 "AND PR_ABDOMIPOTHER_FIRST_DAY IS NOT NULL AND PR_RECLOIP_LAST_DAY <= PR_ABDOMIPOTHER_FIRST_DAY",
+                 "Exclusion: Reclosure before/same day as first non-open abdominopelvic surgery"),
+        ],
+        outcomes=[
+            Outcome("NUMERATOR_OPEN", "PR_RECLOIP AND DX_ABWALLCD_AN AND PR_ABDOMIPOPEN", "Inclusion",
+                    "Numerator: Postoperative wound dehiscence (DX: {DX_ABWALLCD_AN_FIRST}) with reclosure procedure; "
+                    "Stratum: open_approach",
+                    {"has_reclosure_procedure": "TRUE", "wound_disruption_dx_matches": "DX_ABWALLCD_AN_LIST",
+                     "stratum": "'open_approach'"}),
+            Outcome("NUMERATOR_NON_OPEN", "PR_RECLOIP AND DX_ABWALLCD_AN", "Inclusion",
+                    "Numerator: Postoperative wound dehiscence (DX: {DX_ABWALLCD_AN_FIRST}) with reclosure procedure; "
+                    "Stratum: non_open_approach",
+                    {"has_reclosure_procedure": "TRUE", "wound_disruption_dx_matches": "DX_ABWALLCD_AN_LIST",
+                     "stratum": "'non_open_approach'"}),
+            Outcome("NUM_PROC_ONLY", "PR_RECLOIP", "Exclusion",
+                    "Numerator: Reclosure procedure found, but no qualifying wound disruption diagnosis"),
+            Outcome("NUM_DX_ONLY", "DX_ABWALLCD_AN", "Exclusion", "Numerator: Wound disruption diagnosis found, but no reclosure procedure"),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion", "No qualifying wound dehiscence criteria met for numerator"),
+        ],
+    ),
+    "PSI_15": PsiRules(
+        steps=[
+            Step("POP_DENOMINATOR", "NOT (AGE >= 18 AND (MSDRG_SURGI2R OR MSDRG_MEDIC2R) AND PR_ABDOMI15P)",
+                 "Population Exclusion: Not surgical/medical DRG (>=18) or no abdominopelvic procedure"),
+            Step("EXCL_MISSING_INDEX_DATE", "PR_ABDOMI15P_FIRST IS NULL", "Exclusion: Missing index abdominopelvic procedure date"),
+            Step("EXCL_PRINCIPAL_INJURY", "DX_INJ15_P", "Exclusion: Principal diagnosis of accidental puncture/laceration for any organ"),
+        ],
+        notes_before=[
+            Note(f"PSI15_{organ.name}_POA_EXCLUDED",
+                 f"Exclusion: POA injury ({{DX_{injury_set}_SY_FIRST}}) with matching related procedure for {organ.value}")
+            for organ, (injury_set, _) in PSI15_ORGAN_SETS.items()
+        ],
+        outcomes=[
+            Outcome("NUMERATOR", "PSI15_ANY_QUALIFIES", "Inclusion",
+                    "Numerator: Accidental puncture/laceration found for organs: {PSI15_QUALIFYING}",
+                    {"qualifying_organs": "PSI15_QUALIFYING_LIST"}),
+            Outcome("NOT_IN_NUMERATOR", "TRUE", "Exclusion",
+                    "No qualifying accidental puncture/laceration (injury + procedure + timing + organ match) found for numerator"),
+        ],
+        notes_after=[Note("TRUE", "Risk Category: {PSI15_RISK}")],
+        details_before={"organ_analysis_results": "PSI15_ORGAN_ANALYSIS"},
+        details_after={"risk_category": "PSI15_RISK"},
+    ),
+}
+
+
+# --- Compilation ---
+def _bind(expr, validate_timing, parameters=None):
+    """
+    Fills in {validate_timing} and the RULE_PARAMETERS placeholders. `parameters` maps
+    parameter names to SQL (e.g. grid columns in psi_sweep.py); the default is their values.
+    """
+    expr = expr.replace("{validate_timing}", "TRUE" if validate_timing else "FALSE")
+    for name, value in RULE_PARAMETERS.items():
+        expr = expr.replace("{" + name + "}", str(parameters[name]) if parameters and name in parameters else str(value))
+    return expr
+
+def _guard(expr, validate_timing, parameters=None):
+    """A condition that is FALSE (never NULL) when a feature it reads is NULL."""
+    return f"COALESCE(({_bind(expr, validate_timing, parameters)}), FALSE)"
+
+def compile_derived_features(validate_timing=True, parameters=None):
+    """Returns [(name, SQL expression)] for DERIVED_FEATURES, in evaluation order."""
+    return [(name, _bind(expr, validate_timing, parameters)) for name, expr in DERIVED_FEATURES.items()]
+
+def compile_psi(psi, validate_timing=True, parameters=None):
+    """
+    Compiles one PSI into SQL expressions over the feature table:
+    {"Status", "Reason", "Param_<name>", ..., "Detail_<key>", ...}. Reason is the code
+    of the step or outcome that decided the encounter; Param_ columns hold the values its
+    rationale text is rendered from (render_rationale). `parameters` overrides
+    RULE_PARAMETERS (see _bind).
+    """
+    rules = PSI_RULES[psi]
+    steps = COMMON_STEPS + rules.steps
+    step_conditions = [_guard(step.condition, validate_timing, parameters) for step in steps]
+    outcome_conditions = [_guard(outcome.condition, validate_timing, parameters) for outcome in rules.outcomes]
+    reached_numerator = "NOT (" + " OR ".join(step_conditions) + ")"
+
+    def case(values_for_steps, values_for_outcomes):
+        branches = [f"WHEN {c} THEN {v}" for c, v in zip(step_conditions, values_for_steps)]
+        branches += [f"WHEN {c} THEN {v}" for c, v in zip(outcome_conditions, values_for_outcomes)]
+        return "CASE " + " ".join(branches) + " END"
+
+    compiled = {
+        "Status": case(["'Exclusion'"] * len(steps), [sql_str(o.status) for o in rules.outcomes]),
+        "Reason": case([sql_str(s.code) for s in steps], [sql_str(o.code) for o in rules.outcomes]),
+    }
+
+    # Typed reason parameters (the compact form): the placeholder value of the deciding message,
+    # or for note parameters, the value when the note applies
+    for column, is_integer in reason_layout(psi).params.items():
+        def value(template):
+            placeholders = [p for p in value_placeholders(template) if param_column(p) == column]
+            if not placeholders:
+                return "NULL"
+            # A rule parameter is the value it is bound to (a constant, or a grid column in psi_sweep.py)
+            expr = _bind("{" + placeholders[0] + "}", validate_timing, parameters) if placeholders[0] in RULE_PARAMETERS else placeholders[0]
+            return f"CAST({expr} AS {'INTEGER' if is_integer else 'VARCHAR'})"
+        notes = [(n.condition, value(n.message)) for n in rules.notes_before + rules.notes_after if value(n.message) != "NULL"]
+        if notes:
+            branches = " ".join(f"WHEN {_guard(c, validate_timing, parameters)} THEN {v}" for c, v in notes)
+            compiled[column] = f"CASE WHEN {reached_numerator} THEN CASE {branches} END END"
+        else:
+            compiled[column] = case([value(s.message) for s in steps], [value(o.message) for o in rules.outcomes])
+
+    for key in rules.detail_keys():
+        if key in rules.details_before or key in rules.details_after:
+            expr = rules.details_before.get(key) or rules.details_after.get(key)
+            compiled[f"Detail_{key}"] = f"CASE WHEN {reached_numerator} THEN {_bind(expr, validate_timing, parameters)} END"
+        else:
+            branches = [f"WHEN {c} THEN {_bind(o.details[key], validate_timing, parameters) if key in o.details else 'NULL'}"
+                        for c, o in zip(outcome_conditions, rules.outcomes)]
+            # An outcome only applies if no step excluded the encounter first
+            compiled[f"Detail_{key}"] = f"CASE WHEN {reached_numerator} THEN CASE {' '.join(branches)} END END"
+    return compiled
+
+def referenced_features(psis, validate_timing=True):
+    """All feature names read by the compiled rules of `psis` (and the derived features)."""
+    expressions = [expr for _, expr in compile_derived_features(validate_timing)]
+    for psi in psis:
+        expressions += compile_psi(psi, validate_timing).values()
+    names = set()
+    for expr in expressions:
+        # Drop string literals before collecting identifiers
+        names.update(re.findall(r"\b[A-Z][A-Z0-9_]*\b", re.sub(r"'(?:[^']|'')*'", "''", expr)))
+    return names - SQL_KEYWORDS
+
+SQL_KEYWORDS = {"CASE", "WHEN", "THEN", "ELSE", "END", "AND", "OR", "NOT", "IS", "NULL", "TRUE", "FALSE",
+                "CAST", "AS", "VARCHAR", "COALESCE", "IN"}
+
+def required_code_set_features(features):
+    """
+    Splits referenced feature names into what the backends must compute:
+    ({dx set: {scopes}}, {dx (set, scope): {"FIRST", "LIST"}}, {proc sets}, {MS-DRG sets}).
+    """
+    dx_scopes, dx_values, proc_sets, drg_sets = {}, {}, set(), set()
+    for name in features:
+        m = re.fullmatch(r"DX_([A-Z0-9]+)_(P|S|SY|SN|A|AY|AN)(?:_(FIRST|LIST))?", name)
+        if m:
+            dx_scopes.setdefault(m.group(1), set()).add(m.group(2))
+            if m.group(3):
+                dx_values.setdefault((m.group(1), m.group(2)), set()).add(m.group(3))
+            continue
+        m = re.fullmatch(r"PR_([A-Z0-9]+)(?:_(?:COUNT|FIRST|LAST|FIRST_DAY|LAST_DAY))?", name)
+        if m:
+            proc_sets.add(m.group(1))
+            continue
+        m = re.fullmatch(r"MSDRG_([A-Z0-9]+)", name)
+        if m:
+            drg_sets.add(m.group(1))
+    for proc_set, anchor, _, _ in WINDOW_FEATURES.values():
+        proc_sets.update((proc_set, anchor))
+    proc_sets.update(DAY_COUNT_FEATURES.values())
+    proc_sets.add("ORPROC") # ADMIT_TO_FIRST_OR_DAYS
+    return dx_scopes, dx_values, proc_sets, drg_sets
+
+
+# --- Bitset membership matrix ---
+# Code set membership is packed into int64 words, one bit per code set. Each diagnosis and
+# procedure is looked up once (code -> membership words) and each encounter gets bit planes:
+# the bitwise OR of the words of its diagnoses in one position/POA class (DX_PLANES), or of
+# its procedures. DX_<SET>_<SCOPE> and PR_<SET> are then bit tests on the planes, instead of
+# one joined row per (code, set) pair.
+BITS_PER_WORD = 63 # int64 words; the sign bit is left unused
+DX_PLANES = ["P", "PY", "PN", "S", "SY", "SN"] # principal / secondary, any POA, POA Y, POA N
+SCOPE_PLANES = {
+    "P": ["P"], "S": ["S"], "SY": ["SY"], "SN": ["SN"],
+    "A": ["P", "S"], "AY": ["PY", "SY"], "AN": ["PN", "SN"],
+}
+PROC_PLANE = "PR"
+
+class MembershipLayout:
+    """Bit positions of code sets in the membership words (M_0, M_1, ...) and planes (BITS_<PLANE>_<word>)."""
+
+    def __init__(self, set_names):
+        self.set_names = sorted(set_names)
+        self.bits = {name: divmod(i, BITS_PER_WORD) for i, name in enumerate(self.set_names)}
+        self.words = max(1, -(-len(self.set_names) // BITS_PER_WORD))
+
+    def word_columns(self):
+        return [f"M_{w}" for w in range(self.words)]
+
+    def plane_columns(self, plane):
+        return [f"BITS_{plane}_{w}" for w in range(self.words)]
+
+    def mask(self, set_name):
+        """(word index, int mask) of one code set."""
+        word, bit = self.bits[set_name]
+        return word, 1 << bit
+
+    def code_table(self, rule_sets):
+        """DataFrame (code, M_0, ...): the membership words of every code in at least one of the sets."""
+        words = {}
+        for name in self.set_names:
+            word, mask = self.mask(name)
+            for code in rule_sets.get(name, ()):
+                words.setdefault(str(code), [0] * self.words)[word] |= mask
+        table = pd.DataFrame({"code": pd.Series(list(words), dtype=object)})
+        for w, column in enumerate(self.word_columns()):
+            table[column] = pd.Series([v[w] for v in words.values()], dtype="int64")
+        return table
+
+def membership_layouts(dx_scopes, proc_sets):
+    """(diagnosis layout, procedure layout): the two code systems get separate words."""
+    return MembershipLayout(dx_scopes), MembershipLayout(proc_sets)
+
+
+# --- Reason codes with typed parameters ---
+# Every engine decides an encounter with the code of a step or outcome (Reason) and the
+# values of its message placeholders, one Param_<name> column each (categorical or integer).
+# The compact result form ("codes") keeps those; the Rationale text is rendered from the
+# templates only when results are displayed or exported (render_rationale / decode_reasons).
+REASON_FORMATS = ["text", "codes"]
+NAMED_PARAMS = {
+    "MISSING_FIELDS": "Missing_Fields",
+    "AGE_STR": "Age",
+    "LOS_STR": "LOS",
+    "ADMIT_TO_FIRST_OR_DAYS": "First_OR_Day",
+    "MIN_LOS_DAYS": "Min_LOS",
+    "FIRST_OR_EXCLUSION_DAY": "First_OR_Exclusion_Day",
+    "PSI15_QUALIFYING": "Organs",
+    "PSI13_RISK": "Risk_Category",
+    "PSI15_RISK": "Risk_Category",
+}
+# Rule parameters in a message are carried per result too, so the text shows the value it was scored with
+INTEGER_PARAMS = {"ADMIT_TO_FIRST_OR_DAYS", "MIN_LOS_DAYS", "FIRST_OR_EXCLUSION_DAY"}
+ORDINAL_PARAMS = {"FIRST_OR_EXCLUSION_DAY"} # Shown as "10th"
+_PLACEHOLDER = r"\{([A-Z0-9_]+)\}"
+_reason_layouts = {}
+
+def outcome_codes(psi):
+    """Codes of the numerator-stage outcomes (encounters in the denominator) of `psi`."""
+    return [o.code for o in PSI_RULES[psi].outcomes]
+
+def value_placeholders(template):
+    """Placeholders of a template, each held in a Param_ column (features and RULE_PARAMETERS alike)."""
+    return re.findall(_PLACEHOLDER, template)
+
+def format_param(placeholder, value):
+    """Text of a placeholder value in a rationale, e.g. FIRST_OR_EXCLUSION_DAY 10 -> "10th"."""
+    if placeholder in ORDINAL_PARAMS:
+        value = int(value)
+        suffix = "th" if 10 <= value % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(value % 10, "th")
+        return f"{value}{suffix}"
+    return str(value)
+
+def param_column(placeholder):
+    """Param_ column a template placeholder is stored in, e.g. DX_FOREIID_SN_FIRST -> Param_DX."""
+    if placeholder in NAMED_PARAMS:
+        return f"Param_{NAMED_PARAMS[placeholder]}"
+    m = re.fullmatch(r"DX_([A-Z0-9]+)_(SN|AN|SY)_FIRST", placeholder)
+    if not m:
+        raise ValueError(f"No reason parameter for template placeholder {placeholder}")
+    # PSI 15 notes name a POA diagnosis per organ; decision messages name at most one diagnosis
+    return f"Param_POA_DX_{m.group(1)}" if m.group(2) == "SY" else "Param_DX"
+
+class ReasonLayout:
+    """Decision templates by code, notes and Param_ columns of one PSI."""
+
+    def __init__(self, psi):
+        rules = PSI_RULES[psi]
+        decisions = [(s.code, s.message) for s in COMMON_STEPS + rules.steps]
+        decisions += [(o.code, o.message) for o in rules.outcomes]
+        self.templates = dict(decisions)
+        assert len(self.templates) == len(decisions), f"{psi}: reason codes must be unique"
+        self.notes_before = [n.message for n in rules.notes_before]
+        self.notes_after = [n.message for n in rules.notes_after]
+        self.params = {} # Param_ column -> True if integer
+        for template in list(self.templates.values()) + self.notes_before + self.notes_after:
+            for placeholder in re.findall(_PLACEHOLDER, template):
+                self.params[param_column(placeholder)] = placeholder in INTEGER_PARAMS
+        self.columns = ["Reason"] + list(self.params)
+
+    def render(self, reason, params):
+        """Rationale text of one result from its reason code and {Param_ column: value}."""
+        def fill(template):
+            values = [params.get(param_column(p)) for p in re.findall(_PLACEHOLDER, template)]
+            if any(v is None for v in values):
+                return None
+            return re.sub(_PLACEHOLDER, lambda m: format_param(m.group(1), params[param_column(m.group(1))]), template)
+        # A note applies when its parameters are set (every note has at least one)
+        parts = [fill(t) for t in self.notes_before] + [fill(self.templates[reason])] + [fill(t) for t in self.notes_after]
+        return "; ".join(p for p in parts if p is not None)
+
+def reason_layout(psi):
+    if psi not in _reason_layouts:
+        _reason_layouts[psi] = ReasonLayout(psi)
+    return _reason_layouts[psi]
+
+def reason_columns(psi):
+    """Reason columns of the compact form: Reason and the Param_ columns."""
+    return reason_layout(psi).columns
+
+def apply_reason_dtypes(psi, df):
+    """Stores Status, Reason and text parameters as categoricals and integer parameters as Int32."""
+    layout = reason_layout(psi)
+    for column in ["Status"] + layout.columns:
+        if column in df.columns:
+            df[column] = df[column].astype("Int32" if layout.params.get(column) else "category")
+    return df
+
+def render_rationale(psi, df):
+    """Rationale text for the rows of a compact results frame (rendered once per distinct reason/parameters)."""
+    layout = reason_layout(psi)
+    columns = [c for c in layout.columns if c in df.columns]
+    rendered = {}
+    texts = []
+    for values in zip(*(df[c].astype(object).where(df[c].notna(), None) for c in columns)):
+        if values not in rendered:
+            row = dict(zip(columns, values))
+            rendered[values] = layout.render(row["Reason"], {k: v for k, v in row.items() if v is not None})
+        texts.append(rendered[values])
+    return pd.Series(texts, index=df.index, dtype=object)
+
+def decode_reasons(psi, df):
+    """Text form of a results frame: compact frames get Rationale after Reason, in place of the Param_ columns."""
+    if "Rationale" in df.columns:
+        return df
+    out = df.drop(columns=[c for c in reason_layout(psi).params if c in df.columns])
+    out.insert(out.columns.get_loc("Reason") + 1, "Rationale", render_rationale(psi, df))
+    out["Status"] = out["Status"].astype(object)
+    out["Reason"] = out["Reason"].astype(object)
+    return out
+
+
+# --- Typed detail columns ---
+# By default Detail_ values are text: lists and dicts as str(), and only the Detail_ columns
+# some encounter has. The typed form keeps every Detail_ column of the PSI with one fixed type,
+# so "crit2_met" or "organ = spleen" are column predicates (see psi_engine.write_results_parquet).
+# Every engine produces native values (the columnar backends as LIST / STRUCT / BOOLEAN
+# columns); both forms are made from those, and text is never parsed back:
+#   bool      boolean (nullable)
+#   category  categorical string
+#   codes     list of strings
+#   organs    list of {organ, has_injury_dx, has_related_proc_in_window, is_poa_excluded}
+DETAIL_FORMATS = ["text", "typed"]
+DETAIL_KINDS = {
+    "retained_surgical_item_matches": "codes",
+    "iatrogenic_pneumothorax_matches": "codes",
+    "cvc_bsi_matches": "codes",
+    "fracture_type": "category",
+    "hip_fracture_matches": "codes",
+    "other_fracture_matches": "codes",
+    "overall_fracture": "bool",
+    "hemorrhage_dx_matches": "codes",
+    "has_treatment_procedure": "bool",
+    "aki_dx_matches": "codes",
+    "has_dialysis_procedure": "bool",
+    "crit1_met": "bool",
+    "crit2_met": "bool",
+    "crit3_met": "bool",
+    "crit4_met": "bool",
+    "dvt_pe_matches": "codes",
+    "sepsis_matches": "codes",
+    "risk_category": "category",
+    "has_reclosure_procedure": "bool",
+    "wound_disruption_dx_matches": "codes",
+    "stratum": "category",
+    "organ_analysis_results": "organs",
+    "qualifying_organs": "codes",
+}
+ORGAN_ANALYSIS_FIELDS = ["has_injury_dx", "has_related_proc_in_window", "is_poa_excluded"]
+
+def detail_kinds(psi):
+    """{Detail_ column: kind} of `psi`, in detail_keys order (the fixed typed schema)."""
+    return {f"Detail_{key}": DETAIL_KINDS[key] for key in PSI_RULES[psi].detail_keys()}
+
+def _is_missing(value):
+    return value is None or value is pd.NA or (isinstance(value, float) and value != value)
+
+def _typed_detail(kind, value):
+    """Typed value of one detail, from the pandas engine's value or a list/struct read from Arrow (arrays, dicts)."""
+    if _is_missing(value):
+        return None
+    if kind == "bool":
+        return bool(value)
+    if kind == "category":
+        return str(value)
+    if kind == "codes":
+        return [str(code) for code in value]
+    if isinstance(value, dict):
+        return [dict(organ=organ, **{f: bool(flags[f]) for f in ORGAN_ANALYSIS_FIELDS}) for organ, flags in value.items()]
+    return [{"organ": entry["organ"], **{f: bool(entry[f]) for f in ORGAN_ANALYSIS_FIELDS}} for entry in value]
+
+def _text_detail(kind, value):
+    """The text form build_result_record gives a detail value (text is kept as it is)."""
+    if _is_missing(value):
+        return None
+    if isinstance(value, str):
+        return value
+    if kind == "codes":
+        return str([str(code) for code in value])
+    if kind == "organs":
+        return str({entry["organ"]: {f: bool(entry[f]) for f in ORGAN_ANALYSIS_FIELDS} for entry in value})
+    return bool(value) if kind == "bool" else value
+
+def apply_detail_dtypes(psi, df):
+    """boolean / category dtypes for the typed Detail_ columns (lists stay object columns)."""
+    for column, kind in detail_kinds(psi).items():
+        if column in df.columns and kind in ("bool", "category"):
+            df[column] = df[column].astype("boolean" if kind == "bool" else "category")
+    return df
+
+def type_details(psi, df):
+    """Typed form of a results frame: every Detail_ column of the PSI, with its fixed type."""
+    out = df.copy()
+    for column, kind in detail_kinds(psi).items():
+        values = out[column] if column in out.columns else [None] * len(out)
+        out[column] = pd.Series([_typed_detail(kind, v) for v in values], index=out.index, dtype=object)
+    return apply_detail_dtypes(psi, out)
+
+def has_typed_details(psi, df):
+    """True for frames in the typed form: every Detail_ column of the PSI, with no text lists."""
+    kinds = detail_kinds(psi)
+    if not all(column in df.columns for column in kinds):
+        return False
+    return not any(isinstance(v, str) for column, kind in kinds.items() if kind in ("codes", "organs") for v in df[column])
+
+def text_details(psi, df):
+    """Text form of a results frame (e.g. for CSV/Excel): str() values, without Detail_ columns nobody has."""
+    out = df.copy()
+    for column, kind in detail_kinds(psi).items():
+        if column not in out.columns:
+            continue
+        values = [_text_detail(kind, None if _is_missing(v) else v) for v in out[column].astype(object)]
+        if all(v is None for v in values):
+            out = out.drop(columns=column)
+        else:
+            out[column] = pd.Series(values, index=out.index, dtype=object)
+    return out
+
+assert set(DETAIL_KINDS) == {key for rules in PSI_RULES.values() for key in rules.detail_keys()}
+assert set(PSI_RULES) == set(PSI_LIST)
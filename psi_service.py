@@ -0,0 +1,372 @@
+"""
+Low-latency HTTP scoring service for PSI 05-15.
+
+Loads and compiles the appendix once at startup and keeps it resident in a pool
+of scoring worker processes. Encounters use the same fields that
+`evaluate_psi_comprehensive` reads from an input row (DX1/Pdx, POA, Proc1..20
+with dates/times, Age, MS-DRG, ATYPE, admission_date, ...).
+
+Endpoints:
+    GET  /health        service status and load
+    POST /score         one encounter object            -> per-PSI results
+    POST /score/batch   {"encounters": [...]} or [...]  -> list of per-PSI results
+
+Optional query parameters on both POST endpoints:
+    psis=PSI_05,PSI_12    PSIs to evaluate (default: all)
+    validate_timing=0|1   override the server's timing validation setting
+
+Single-encounter requests that arrive close together are micro-batched into
+one worker call. At most --max-in-flight requests are accepted at once; beyond
+that the service answers 503 with Retry-After (backpressure) instead of queueing
+without bound.
+
+Usage:
+    python psi_service.py --appendix appendix.xlsx --port 8080 --workers 4
+"""
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+import multiprocessing
+from enum import Enum
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT = 64 # Requests accepted concurrently before answering 503
+DEFAULT_MAX_BATCH_SIZE = 32 # Encounters per worker call
+DEFAULT_BATCH_WINDOW_MS = 2.0 # How long a single-encounter request may wait for batch companions
+MAX_BODY_BYTES = 32 * 1024 * 1024
+# Encounter-level date fields arrive as JSON strings; they are parsed once per encounter
+# instead of once per PSI inside evaluate_psi_comprehensive
+ENCOUNTER_DATE_FIELDS = ["admission_date", "Admission_Date", "discharge_date", "Discharge_Date"]
+
+# --- Worker process state (the compiled appendix stays resident per worker) ---
+_worker_state = {}
+
+def init_worker(code_sets, validate_timing):
+    """Compiles the appendix once when a scoring worker starts."""
+    compiled = psi_engine.compile_code_sets(code_sets)
+    _worker_state["code_sets"] = compiled
+    _worker_state["organ_systems"] = psi_engine.build_organ_system_mapping(compiled)
+    _worker_state["temporal_code_sets"] = psi_engine.build_temporal_code_sets(compiled)
+    _worker_state["validate_timing"] = validate_timing
+
+def score_encounters(encounters, psis, validate_timing=None):
+    """
+    Scores a batch of encounter dicts in a worker. Returns one result dict per
+    encounter: {"EncounterID", "results": {psi: {"status", "reason", "rationale", "details"}}}
+    or {"EncounterID", "error"} if the encounter could not be evaluated. The rationale
+    text is rendered once per PSI for the whole batch (psi_rules.render_rationale).
+    """
+    if validate_timing is None:
+        validate_timing = _worker_state["validate_timing"]
+    output = []
+    reasons = {} # psi -> [(result dict, Reason and Param_ values)] still to be rendered
+    for i, encounter in enumerate(encounters):
+        row = pd.Series(encounter, name=i, dtype=object)
+        for field in ENCOUNTER_DATE_FIELDS:
+            if isinstance(row.get(field), str):
+                row[field] = psi_engine.parse_date_safe(row[field])
+        enc_id = row.get("EncounterID") or row.get("Encounter_ID") or f"Row_{i}"
+        try:
+            evaluations = psi_engine.evaluate_encounter(
+                row, psis, _worker_state["code_sets"], _worker_state["organ_systems"],
+                validate_timing=validate_timing, temporal_code_sets=_worker_state["temporal_code_sets"]
+            )
+        except Exception as e:
+            output.append({"EncounterID": enc_id, "error": f"{type(e).__name__}: {e}"})
+            continue
+        results = {}
+        for psi, (status, reason, params, detailed_info) in evaluations.items():
+            results[psi] = {"status": status, "reason": reason, "details": detailed_info}
+            reasons.setdefault(psi, []).append((results[psi], {"Reason": reason, **params}))
+        output.append({"EncounterID": enc_id, "results": results})
+    for psi, pending in reasons.items():
+        frame = pd.DataFrame([values for _, values in pending], columns=psi_rules.reason_layout(psi).columns)
+        rendered = psi_rules.render_rationale(psi, psi_rules.apply_reason_dtypes(psi, frame))
+        for (result, _), rationale in zip(pending, rendered):
+            result["rationale"] = rationale
+    return output
+
+def to_json_value(value):
+    """json.dumps default: converts numpy scalars, Enums, timestamps and sets in result details."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class MicroBatcher:
+    """
+    Groups single-encounter requests arriving within `window_ms` of each other
+    (up to `max_batch_size`, same PSI selection) into one worker call.
+    """
+
+    def __init__(self, executor, max_batch_size=DEFAULT_MAX_BATCH_SIZE, window_ms=DEFAULT_BATCH_WINDOW_MS):
+        self._executor = executor
+        self._max_batch_size = max_batch_size
+        self._window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="psi-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, encounter, psis, validate_timing):
+        """Queues one encounter; the returned Future resolves to its result dict."""
+        future = Future()
+        self._queue.put((encounter, tuple(psis), validate_timing, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # One worker call per distinct (PSI selection, timing) combination in the batch
+            groups = {}
+            for item in batch:
+                groups.setdefault((item[1], item[2]), []).append(item)
+            for (psis, validate_timing), items in groups.items():
+                self._dispatch(list(psis), validate_timing, items)
+
+    def _dispatch(self, psis, validate_timing, items):
+        futures = [item[3] for item in items]
+        try:
+            worker_future = self._executor.submit(score_encounters, [item[0] for item in items], psis, validate_timing)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        def deliver(done):
+            try:
+                results = done.result()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                return
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        worker_future.add_done_callback(deliver)
+
+
+class ScoringService:
+    """Resident scoring state shared by all HTTP handler threads."""
+
+    def __init__(self, code_sets, validate_timing=True, workers=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, batch_window_ms=DEFAULT_BATCH_WINDOW_MS):
+        self.validate_timing = validate_timing
+        self.max_batch_size = max_batch_size
+        self.code_set_count = len(code_sets)
+        if workers == 0:
+            # In-process scoring (single thread), mainly for development
+            init_worker(code_sets, validate_timing)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            # Not forked: threads of the caller (or an embedding app) could hold locks a forked child would inherit
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method),
+                                                initializer=init_worker, initargs=(code_sets, validate_timing))
+        # Start the workers (and compile the appendix in each) now rather than on the first request
+        self.executor.submit(score_encounters, [], PSI_LIST).result()
+        self.batcher = MicroBatcher(self.executor, max_batch_size=max_batch_size, window_ms=batch_window_ms)
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests_served = 0
+        self.requests_rejected = 0
+
+    def try_acquire(self):
+        """Reserves an in-flight slot; False means the service is saturated."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.requests_rejected += 1
+            return False
+        with self._lock:
+            self._in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self.requests_served += 1
+        self._slots.release()
+
+    def health(self):
+        with self._lock:
+            return {
+                "status": "ok",
+                "psis": PSI_LIST,
+                "code_sets": self.code_set_count,
+                "validate_timing": self.validate_timing,
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "requests_served": self.requests_served,
+                "requests_rejected": self.requests_rejected,
+                "uptime_seconds": round(time.time() - self.started_at, 1),
+            }
+
+    def score_one(self, encounter, psis, validate_timing):
+        return self.batcher.submit(encounter, psis, validate_timing).result()
+
+    def score_batch(self, encounters, psis, validate_timing):
+        # Large batches are split across workers and reassembled in order
+        futures = [
+            self.executor.submit(score_encounters, encounters[start:start + self.max_batch_size], psis, validate_timing)
+            for start in range(0, len(encounters), self.max_batch_size)
+        ]
+        return [result for future in futures for result in future.result()]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end; `server.service` holds the ScoringService."""
+    protocol_version = "HTTP/1.1" # Keep-alive for low per-request overhead
+    disable_nagle_algorithm = True # Headers and body are separate writes; avoid delayed-ACK stalls
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, default=to_json_value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parse_options(self, query):
+        """Returns (psis, validate_timing) from the query string, or raises ValueError."""
+        params = parse_qs(query)
+        psis = PSI_LIST
+        if "psis" in params:
+            psis = [p.strip().upper() for p in ",".join(params["psis"]).split(",") if p.strip()]
+            unknown = [p for p in psis if p not in PSI_LIST]
+            if unknown or not psis:
+                raise ValueError(f"Unknown PSI(s): {', '.join(unknown) or '(none given)'}")
+        validate_timing = None
+        if "validate_timing" in params:
+            validate_timing = params["validate_timing"][-1].strip().lower() in ("1", "true", "yes")
+        return psis, validate_timing
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/score", "/score/batch"):
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": f"Request body exceeds {MAX_BODY_BYTES} bytes"})
+            return
+        body = self.rfile.read(length)
+
+        service = self.server.service
+        if not service.try_acquire():
+            self._send_json(503, {"error": "Service busy, retry later"}, headers={"Retry-After": "1"})
+            return
+        try:
+            try:
+                psis, validate_timing = self._parse_options(url.query)
+                payload = json.loads(body or b"null")
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+
+            if url.path == "/score":
+                if not isinstance(payload, dict):
+                    self._send_json(400, {"error": "Expected one encounter object"})
+                    return
+                result = service.score_one(payload, psis, validate_timing)
+                self._send_json(422 if "error" in result else 200, result)
+            else:
+                encounters = payload.get("encounters") if isinstance(payload, dict) else payload
+                if not isinstance(encounters, list) or not all(isinstance(e, dict) for e in encounters):
+                    self._send_json(400, {"error": "Expected a list of encounter objects (or {\"encounters\": [...]})"})
+                    return
+                self._send_json(200, {"results": service.score_batch(encounters, psis, validate_timing)})
+        except Exception as e:
+            logger.exception("Scoring request failed")
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+        finally:
+            service.release()
+
+
+def create_server(code_sets, host="127.0.0.1", port=8080, **service_options):
+    """Creates the HTTP server with a resident ScoringService (call serve_forever() to run)."""
+    server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+    server.daemon_threads = True
+    server.service = ScoringService(code_sets, **service_options)
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PSI 05-15 HTTP scoring service")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Scoring worker processes (0 = in-process)")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="Concurrent requests accepted before answering 503")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--batch-window-ms", type=float, default=DEFAULT_BATCH_WINDOW_MS)
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    code_sets = psi_engine.load_code_sets(args.appendix)
+    server = create_server(
+        code_sets, host=args.host, port=args.port,
+        validate_timing=not args.no_timing_validation, workers=args.workers,
+        max_in_flight=args.max_in_flight, max_batch_size=args.max_batch_size,
+        batch_window_ms=args.batch_window_ms
+    )
+    logger.info("PSI scoring service on http://%s:%s (%d code sets, %s workers)",
+                args.host, args.port, len(code_sets), args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+Sharded scoring: split one run across several machines and merge the results exactly.
+
+Encounters are assigned to shards deterministically (CRC32 of the EncounterID,
+or of the facility column, modulo the shard count), so every node can read the
+same input and score only its own shard without coordination:
+
+    python psi_shard.py score --input all_states.parquet --appendix PSI_Code_Sets.xlsx \
+        --shard-index 0 --shard-count 8 --output-dir shards/
+    python psi_shard.py merge --shards shards/shard-*-of-00008 --output-dir merged/
+
+Each shard directory holds the encounter results (<PSI>.parquet, with the
+encounter's Source_Row in the input) and aggregates.json with partial
+aggregates that merge by addition:
+- per PSI: encounters, denominator (encounters reaching the numerator stage) and numerator
+- cube cells: counts per PSI x YEAR x DQTR x SEX x Status
+- rule hits: counts per PSI and deciding step/outcome code (psi_rules)
+
+`merge` accepts any set of shards of the same run and reports which shards it
+covered. `run-local` runs every shard as a separate local process (standing in
+for the nodes) and merges them:
+
+    python psi_shard.py run-local --input encounters.xlsx --appendix PSI_Code_Sets.xlsx --shard-count 4 --output-dir run/
+"""
+import os
+import sys
+import glob
+import json
+import time
+import zlib
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE_VERSION = 1
+SHARD_KEYS = ["encounter", "facility"]
+DEFAULT_FACILITY_COLUMN = "Facility"
+CUBE_DIMENSIONS = ["YEAR", "DQTR", "SEX"] # Input columns; the cube also has PSI and Status
+AGGREGATES_FILE = "aggregates.json"
+
+
+# --- Partitioning ---
+def shard_of(key, shard_count):
+    """Shard of a partition key: stable across processes, machines and Python versions."""
+    return zlib.crc32(str(key).encode("utf-8")) % shard_count
+
+def partition_keys(df, key="encounter", facility_column=DEFAULT_FACILITY_COLUMN):
+    """The value each encounter is partitioned on (EncounterID with the Row_<n> fallback, or the facility)."""
+    if key == "encounter":
+        encounter_ids = psi_engine.canonicalize_input(df)["EncounterID"]
+        return pd.Series([value or f"Row_{idx}" for idx, value in encounter_ids.items()], index=df.index)
+    if key == "facility":
+        if facility_column not in df.columns:
+            raise ValueError(f"Facility sharding needs a '{facility_column}' column in the input")
+        return df[facility_column].map(lambda v: "" if pd.isna(v) else str(v))
+    raise ValueError(f"Unknown shard key: {key} (expected one of {', '.join(SHARD_KEYS)})")
+
+def select_shard(df, shard_index, shard_count, key="encounter", facility_column=DEFAULT_FACILITY_COLUMN):
+    """Rows of `df` belonging to `shard_index` (original index kept, so Row_<n> fallbacks stay the same)."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is outside 0..{shard_count - 1}")
+    shards = partition_keys(df, key, facility_column).map(lambda k: shard_of(k, shard_count))
+    return df[shards.to_numpy() == shard_index]
+
+def shard_dir_name(shard_index, shard_count):
+    return f"shard-{shard_index:05d}-of-{shard_count:05d}"
+
+
+# --- Partial aggregates ---
+def _cell(value):
+    return "" if pd.isna(value) else str(value)
+
+def partial_aggregates(df, results):
+    """
+    Mergeable aggregates of one shard: `df` is the scored input, `results`
+    {psi: results DataFrame in df order}. All values are counts.
+    """
+    dimensions = {name: [_cell(v) for v in df[name]] if name in df.columns else [""] * len(df) for name in CUBE_DIMENSIONS}
+    counts, rule_hits, cube = {}, {}, {}
+    for psi, res in results.items():
+        reasons = res["Reason"].astype(str).tolist()
+        outcomes = set(psi_rules.outcome_codes(psi))
+        counts[psi] = {
+            "encounters": len(res),
+            "denominator": sum(1 for r in reasons if r in outcomes),
+            "numerator": int((res["Status"] == "Inclusion").sum()),
+        }
+        hits = {}
+        for reason in reasons:
+            hits[reason] = hits.get(reason, 0) + 1
+        rule_hits[psi] = hits
+        for i, status in enumerate(res["Status"]):
+            cell = (psi,) + tuple(dimensions[name][i] for name in CUBE_DIMENSIONS) + (status,)
+            cube[cell] = cube.get(cell, 0) + 1
+    return {
+        "encounters": len(df),
+        "counts": counts,
+        "rule_hits": rule_hits,
+        "cube_dimensions": ["PSI"] + CUBE_DIMENSIONS + ["Status"],
+        "cube": [list(cell) + [n] for cell, n in sorted(cube.items())],
+    }
+
+def merge_aggregates(parts):
+    """
+    Combines shard aggregates (dicts as written to aggregates.json) by addition.
+    Shards must come from the same run (shard count, key, PSIs, timing) and not repeat.
+    """
+    if not parts:
+        raise ValueError("No shard aggregates to merge")
+    run_fields = ["version", "shard_count", "key", "psis", "validate_timing"]
+    first = parts[0]
+    for part in parts[1:]:
+        different = [f for f in run_fields if part.get(f) != first.get(f)]
+        if different:
+            raise ValueError(f"Shards come from different runs (differ in {', '.join(different)})")
+    shards = [i for part in parts for i in part["shards"]]
+    if len(shards) != len(set(shards)):
+        raise ValueError(f"Shards merged more than once: {sorted({i for i in shards if shards.count(i) > 1})}")
+
+    merged = {field: first[field] for field in run_fields}
+    merged["shards"] = sorted(shards)
+    merged["complete"] = merged["shards"] == list(range(first["shard_count"]))
+    merged["encounters"] = sum(part["encounters"] for part in parts)
+    merged["counts"] = {
+        psi: {name: sum(part["counts"][psi][name] for part in parts) for name in ("encounters", "denominator", "numerator")}
+        for psi in first["psis"]
+    }
+    merged["rule_hits"] = {}
+    for psi in first["psis"]:
+        hits = {}
+        for part in parts:
+            for code, n in part["rule_hits"][psi].items():
+                hits[code] = hits.get(code, 0) + n
+        merged["rule_hits"][psi] = dict(sorted(hits.items()))
+    cube = {}
+    for part in parts:
+        for *cell, n in part["cube"]:
+            cube[tuple(cell)] = cube.get(tuple(cell), 0) + n
+    merged["cube_dimensions"] = first["cube_dimensions"]
+    merged["cube"] = [list(cell) + [n] for cell, n in sorted(cube.items())]
+    return merged
+
+def rates_table(aggregates):
+    """Per-PSI rates from (merged) aggregates: per 1000 encounters, as in the app, and per denominator."""
+    rows = []
+    for psi, c in aggregates["counts"].items():
+        rows.append({
+            "PSI": psi, "Encounters": c["encounters"], "Denominator": c["denominator"], "Numerator": c["numerator"],
+            "Rate_per_1000": round(c["numerator"] / c["encounters"] * 1000, 2) if c["encounters"] else 0.0,
+            "Observed_Rate": round(c["numerator"] / c["denominator"], 6) if c["denominator"] else 0.0,
+        })
+    return pd.DataFrame(rows)
+
+
+# --- Shard scoring ---
+def _write_atomically(output_dir, name, write):
+    """Writes a directory via a temporary sibling and renames it, so merges never see half a shard."""
+    os.makedirs(output_dir, exist_ok=True)
+    final = os.path.join(output_dir, name)
+    tmp_dir = tempfile.mkdtemp(dir=output_dir, prefix=f".{name}-")
+    try:
+        write(tmp_dir)
+        if os.path.isdir(final):
+            shutil.rmtree(final)
+        os.replace(tmp_dir, final)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return final
+
+def score_shard(df, code_sets, shard_index, shard_count, output_dir, psis=None, key="encounter",
+                facility_column=DEFAULT_FACILITY_COLUMN, validate_timing=True, details="text"):
+    """
+    Scores one shard of `df` and writes <output_dir>/shard-<i>-of-<n>/ with the
+    per-PSI results and aggregates.json. Returns the shard directory.
+    """
+    psis = list(psis or PSI_LIST)
+    started = time.time()
+    shard = select_shard(df, shard_index, shard_count, key, facility_column)
+    results = psi_engine.score_with_backend(shard, psis, code_sets, validate_timing=validate_timing, details=details)
+    aggregates = {
+        "version": AGGREGATE_VERSION, "shard_count": shard_count, "key": key, "psis": psis,
+        "validate_timing": validate_timing, "shards": [shard_index],
+    }
+    aggregates.update(partial_aggregates(shard, results))
+    aggregates["seconds"] = round(time.time() - started, 2)
+
+    def write(tmp_dir):
+        for psi, res in results.items():
+            res.insert(0, "Source_Row", shard.index.to_numpy())
+            psi_engine.write_results_parquet(res, os.path.join(tmp_dir, f"{psi}.parquet"), psi)
+        with open(os.path.join(tmp_dir, AGGREGATES_FILE), "w") as f:
+            json.dump(aggregates, f, indent=2)
+    return _write_atomically(output_dir, shard_dir_name(shard_index, shard_count), write)
+
+
+# --- Merge ---
+def load_shard_aggregates(shard_dir):
+    with open(os.path.join(shard_dir, AGGREGATES_FILE)) as f:
+        return json.load(f)
+
+def merge_shards(shard_dirs, output_dir=None, fmt="parquet"):
+    """
+    Merges shard directories: aggregates by addition, results in input order
+    (Source_Row). Writes <PSI>.<fmt>, aggregates.json and rates.csv to `output_dir`
+    if given. Returns (merged results {psi: DataFrame}, merged aggregates).
+    """
+    shard_dirs = sorted(shard_dirs)
+    aggregates = merge_aggregates([load_shard_aggregates(d) for d in shard_dirs])
+    results = {}
+    for psi in aggregates["psis"]:
+        parts = [pd.read_parquet(os.path.join(d, f"{psi}.parquet")) for d in shard_dirs]
+        merged = pd.concat(parts, ignore_index=True).sort_values("Source_Row", kind="stable")
+        if psi_rules.has_typed_details(psi, merged):
+            # Parquet lists come back as arrays
+            merged = psi_rules.type_details(psi, merged)
+        results[psi] = psi_engine.order_result_columns(merged.drop(columns="Source_Row").reset_index(drop=True), psi)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        for psi, df in results.items():
+            path = os.path.join(output_dir, f"{psi}.{fmt}")
+            if fmt == "parquet":
+                psi_engine.write_results_parquet(df, path, psi)
+            else:
+                psi_rules.text_details(psi, df).to_csv(path, index=False)
+        with open(os.path.join(output_dir, AGGREGATES_FILE), "w") as f:
+            json.dump(aggregates, f, indent=2)
+        rates_table(aggregates).to_csv(os.path.join(output_dir, "rates.csv"), index=False)
+    if not aggregates["complete"]:
+        missing = sorted(set(range(aggregates["shard_count"])) - set(aggregates["shards"]))
+        logger.warning("Merged %d of %d shards; missing %s", len(aggregates["shards"]), aggregates["shard_count"], missing)
+    return results, aggregates
+
+
+# --- Local nodes ---
+def run_local(input_path, appendix_path, shard_count, output_dir, psis=None, key="encounter",
+              facility_column=DEFAULT_FACILITY_COLUMN, validate_timing=True, fmt="parquet", details="text"):
+    """Scores every shard in its own local process (one per node) and merges them into <output_dir>/merged."""
+    shards_dir = os.path.join(output_dir, "shards")
+    command = [sys.executable, os.path.abspath(__file__), "score", "--input", input_path, "--appendix", appendix_path,
+               "--shard-count", str(shard_count), "--output-dir", shards_dir, "--key", key,
+               "--facility-column", facility_column, "--details", details]
+    if psis:
+        command += ["--psis", ",".join(psis)]
+    if not validate_timing:
+        command.append("--no-timing-validation")
+    nodes = [subprocess.Popen(command + ["--shard-index", str(i)]) for i in range(shard_count)]
+    failed = [i for i, node in enumerate(nodes) if node.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shard process(es) failed: {failed}")
+    shard_dirs = [os.path.join(shards_dir, shard_dir_name(i, shard_count)) for i in range(shard_count)]
+    return merge_shards(shard_dirs, os.path.join(output_dir, "merged"), fmt)
+
+
+def _parse_psis(parser, text):
+    psis = [p.strip().upper() for p in (text or "").split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    return psis
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded PSI scoring with mergeable partial aggregates")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_run_options(p):
+        p.add_argument("--input", required=True, help="Encounters (.xlsx, .csv or .parquet), the same file on every node")
+        p.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+        p.add_argument("--shard-count", type=int, required=True)
+        p.add_argument("--key", choices=SHARD_KEYS, default="encounter", help="Partition by EncounterID hash or by facility")
+        p.add_argument("--facility-column", default=DEFAULT_FACILITY_COLUMN)
+        p.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+        p.add_argument("--output-dir", required=True)
+        p.add_argument("--details", choices=psi_rules.DETAIL_FORMATS, default="text",
+                       help="Detail_ columns as text, or typed (bool, categorical, list and struct columns)")
+        p.add_argument("--no-timing-validation", action="store_true")
+
+    score = commands.add_parser("score", help="Score one shard")
+    add_run_options(score)
+    score.add_argument("--shard-index", type=int, required=True)
+    merge = commands.add_parser("merge", help="Merge shard directories")
+    merge.add_argument("--shards", nargs="+", required=True, help="Shard directories (globs allowed)")
+    merge.add_argument("--output-dir", required=True)
+    merge.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    local = commands.add_parser("run-local", help="Run every shard as a local process, then merge")
+    add_run_options(local)
+    local.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "merge":
+        shard_dirs = [d for pattern in args.shards for d in (glob.glob(pattern) or [pattern])]
+        _, aggregates = merge_shards(shard_dirs, args.output_dir, args.format)
+    elif args.command == "score":
+        df = psi_engine.read_input_file(args.input)
+        shard_dir = score_shard(df, psi_engine.load_code_sets(args.appendix), args.shard_index, args.shard_count,
+                                args.output_dir, _parse_psis(parser, args.psis), args.key, args.facility_column,
+                                validate_timing=not args.no_timing_validation, details=args.details)
+        aggregates = load_shard_aggregates(shard_dir)
+        logger.info("Shard %d/%d: %d encounters -> %s", args.shard_index, args.shard_count, aggregates["encounters"], shard_dir)
+    else:
+        _, aggregates = run_local(args.input, args.appendix, args.shard_count, args.output_dir,
+                                  _parse_psis(parser, args.psis), args.key, args.facility_column,
+                                  validate_timing=not args.no_timing_validation, fmt=args.format, details=args.details)
+    print(json.dumps({"shards": aggregates["shards"], "encounters": aggregates["encounters"],
+                      "counts": aggregates["counts"]}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""
+Streaming PSI scoring for a continuous feed of finished encounters.
+
+Reads encounters as JSON lines (one encounter object per line, same fields as
+an input workbook row) from stdin or from a file that is tailed as it grows,
+scores them in micro-batches with the compiled appendix and writes one JSON
+line of PSI results per encounter as soon as its batch is scored.
+
+A batch is scored when it reaches --batch-size encounters or when the oldest
+encounter in it has waited --flush-interval seconds, whichever comes first:
+larger batches give more throughput, a shorter interval lower latency.
+
+Running per-PSI status counters and the input position are checkpointed to
+--checkpoint every --checkpoint-interval seconds (and on exit). Restarting with
+the same checkpoint resumes after the last checkpointed encounter instead of
+rescoring the feed. Results are written before the checkpoint that covers
+them, so after a crash at most the encounters since the last checkpoint are
+emitted again (at-least-once).
+
+Usage:
+    adt_feed | python psi_stream.py --appendix appendix.xlsx --checkpoint stream.ckpt
+    python psi_stream.py --appendix appendix.xlsx --input feed.jsonl --follow \
+        --output flags.jsonl --checkpoint stream.ckpt --batch-size 200 --flush-interval 0.5
+"""
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import logging
+import argparse
+import threading
+
+import psi_service
+from psi_engine import PSI_LIST, load_code_sets
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100 # Encounters per scoring call
+DEFAULT_FLUSH_INTERVAL = 1.0 # Seconds an encounter may wait for its batch to fill
+DEFAULT_CHECKPOINT_INTERVAL = 10.0 # Seconds between checkpoint writes
+FOLLOW_POLL_INTERVAL = 0.2 # Seconds between checks for new data when tailing a file
+
+_END_OF_INPUT = object()
+
+
+# --- Checkpoint ---
+def load_checkpoint(path):
+    """Returns the saved checkpoint dict, or None if there is none yet."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    """Writes the checkpoint atomically (a crash never leaves a half-written file)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def new_checkpoint(source, psis):
+    return {
+        "source": source,
+        "position": 0, # Byte offset for files, line count for stdin
+        "encounters_scored": 0,
+        "errors": 0,
+        "counters": {psi: {} for psi in psis}, # {psi: {status: count}}
+        "updated_at": None,
+    }
+
+
+# --- Input readers (run on a background thread, feed (line, position) pairs into a queue) ---
+def read_file(path, start_offset, follow, out_queue, stop_event):
+    """Reads complete lines from `path` starting at a byte offset; optionally waits for more."""
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        while not stop_event.is_set():
+            line_start = f.tell()
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                # End of file or a line still being written: rewind to its start
+                f.seek(line_start)
+                if not follow:
+                    # A last line without a newline is taken only if it is complete JSON;
+                    # otherwise it is left for the next run (the writer may still be appending)
+                    if line.strip():
+                        try:
+                            json.loads(line)
+                            out_queue.put((line, line_start + len(line)))
+                        except ValueError:
+                            logger.warning("Incomplete last line at offset %d left for the next run", line_start)
+                    break
+                time.sleep(FOLLOW_POLL_INTERVAL)
+                continue
+            out_queue.put((line, f.tell()))
+    out_queue.put(_END_OF_INPUT)
+
+def read_stdin(skip_lines, out_queue, stop_event):
+    """Reads lines from stdin; the first `skip_lines` were already scored by a previous run."""
+    line_number = 0
+    for line in sys.stdin.buffer:
+        if stop_event.is_set():
+            break
+        line_number += 1
+        if line_number <= skip_lines:
+            continue
+        out_queue.put((line, line_number))
+    out_queue.put(_END_OF_INPUT)
+
+
+class StreamScorer:
+    """Scores queued JSON lines in micro-batches, emits results and keeps running counters."""
+
+    def __init__(self, code_sets, psis, output, checkpoint, checkpoint_path=None, validate_timing=True,
+                 batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        # Same resident compiled state as the HTTP service workers, held in this process
+        psi_service.init_worker(code_sets, validate_timing)
+        self.psis = psis
+        self.output = output
+        self.checkpoint = checkpoint
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = time.monotonic()
+
+    def run(self, in_queue):
+        """Consumes the queue until the reader signals end of input."""
+        finished = False
+        while not finished:
+            item = in_queue.get()
+            if item is _END_OF_INPUT:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = in_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _END_OF_INPUT:
+                    finished = True
+                    break
+                batch.append(item)
+            self.process_batch(batch)
+            if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+                self.write_checkpoint()
+        self.write_checkpoint()
+
+    def process_batch(self, batch):
+        encounters = []
+        lines_out = []
+        errors = 0
+        for line, _ in batch:
+            if line.strip() == b"":
+                continue # Blank lines (e.g. keep-alives in a feed) are skipped, not counted as errors
+            try:
+                encounter = json.loads(line)
+                if not isinstance(encounter, dict):
+                    raise ValueError("expected a JSON object")
+                encounters.append(encounter)
+            except ValueError as e:
+                errors += 1
+                lines_out.append({"error": f"Invalid input line: {e}", "line": line.decode("utf-8", "replace").strip()[:200]})
+
+        batch_counts = {}
+        scored = 0
+        for result in psi_service.score_encounters(encounters, self.psis):
+            if "error" in result:
+                errors += 1
+            else:
+                for psi, psi_result in result["results"].items():
+                    counts = batch_counts.setdefault(psi, {})
+                    counts[psi_result["status"]] = counts.get(psi_result["status"], 0) + 1
+                result["flagged"] = [psi for psi, r in result["results"].items() if r["status"] == "Inclusion"]
+                scored += 1
+            lines_out.append(result)
+
+        self.output.write("".join(json.dumps(r, default=psi_service.to_json_value) + "\n" for r in lines_out))
+        self.output.flush()
+        # Counters and position only advance once the batch's results have been written out
+        for psi, counts in batch_counts.items():
+            totals = self.checkpoint["counters"].setdefault(psi, {})
+            for status, count in counts.items():
+                totals[status] = totals.get(status, 0) + count
+        self.checkpoint["encounters_scored"] += scored
+        self.checkpoint["errors"] += errors
+        self.checkpoint["position"] = batch[-1][1]
+
+    def write_checkpoint(self):
+        self._last_checkpoint = time.monotonic()
+        if not self.checkpoint_path:
+            return
+        self.checkpoint["updated_at"] = time.time()
+        save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Streaming PSI 05-15 scoring of JSON-lines encounters")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--input", help="JSON-lines file to read (default: stdin)")
+    parser.add_argument("--follow", action="store_true", help="Keep tailing --input for new encounters")
+    parser.add_argument("--output", help="Append results to this file (default: stdout)")
+    parser.add_argument("--checkpoint", help="Checkpoint file for counters and resume position")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL)
+    parser.add_argument("--checkpoint-interval", type=float, default=DEFAULT_CHECKPOINT_INTERVAL)
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    if args.follow and not args.input:
+        parser.error("--follow requires --input")
+
+    source = os.path.abspath(args.input) if args.input else "<stdin>"
+    checkpoint = load_checkpoint(args.checkpoint)
+    if checkpoint is None:
+        checkpoint = new_checkpoint(source, psis)
+    elif checkpoint.get("source") != source:
+        parser.error(f"Checkpoint {args.checkpoint} belongs to {checkpoint.get('source')}, not {source}")
+    else:
+        logger.info("Resuming at position %s (%d encounters already scored)",
+                    checkpoint["position"], checkpoint["encounters_scored"])
+
+    code_sets = load_code_sets(args.appendix)
+    output = open(args.output, "a") if args.output else sys.stdout
+    scorer = StreamScorer(
+        code_sets, psis, output, checkpoint, checkpoint_path=args.checkpoint,
+        validate_timing=not args.no_timing_validation, batch_size=args.batch_size,
+        flush_interval=args.flush_interval, checkpoint_interval=args.checkpoint_interval
+    )
+
+    in_queue = queue.Queue(maxsize=args.batch_size * 4) # Bounded: the reader waits for the scorer
+    stop_event = threading.Event()
+    if args.input:
+        reader = threading.Thread(target=read_file, args=(args.input, checkpoint["position"], args.follow, in_queue, stop_event),
+                                  name="psi-stream-reader", daemon=True)
+    else:
+        reader = threading.Thread(target=read_stdin, args=(checkpoint["position"], in_queue, stop_event),
+                                  name="psi-stream-reader", daemon=True)
+    reader.start()
+    # Service managers stop the stream with SIGTERM; treat it like Ctrl+C so the final checkpoint is written
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    try:
+        scorer.run(in_queue)
+    except KeyboardInterrupt:
+        stop_event.set()
+        scorer.write_checkpoint()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info("Scored %d encounters (%d errors)", checkpoint["encounters_scored"], checkpoint["errors"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Parameter sweeps: PSI rates over grids of the specification thresholds in
+psi_engine.RULE_PARAMETERS (timing windows, day offsets, length-of-stay and
+first-OR cutoffs), e.g. to see how sensitive a rate is to the PSI 15 window.
+
+The input is read and the DuckDB feature table built once (psi_duckdb.prepare).
+Only what a swept parameter can change is then recomputed: the PSI 15 procedure
+windows (from each encounter's procedure day offsets), the derived features that
+read a swept parameter and the rule conditions, with the parameters bound to the
+columns of a grid table (psi_rules._bind). The feature table is cross-joined with
+the grid and counted per combination in one query, so a grid of N combinations
+costs one scan of the input instead of N full runs.
+
+    python psi_sweep.py --input encounters.xlsx --appendix PSI_Appendix.xlsx \
+        --grid PSI15_WINDOW_MAX_DAYS=14,30,60 --grid MIN_LOS_DAYS=1,2,3 --output sweep_rates.csv
+
+Output: one row per combination and PSI with the swept parameter values, Is_Default,
+Encounters, Inclusions, Exclusions, Rate_per_1000 and Rate_Change against the default
+parameters (always part of the grid).
+"""
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+
+import pandas as pd
+
+import psi_duckdb
+import psi_rules
+from psi_engine import PSI_LIST, RULE_PARAMETERS, MINUTES_PER_DAY, load_code_sets
+
+logger = logging.getLogger(__name__)
+
+
+# --- Grid ---
+def parse_grid(spec):
+    """'NAME=v1,v2,...' -> (name, [values])."""
+    name, sep, values = spec.partition("=")
+    name = name.strip().upper()
+    if not sep or name not in RULE_PARAMETERS:
+        raise ValueError(f"Invalid grid {spec!r} (expected NAME=v1,v2 with NAME one of {', '.join(RULE_PARAMETERS)})")
+    try:
+        parsed = [int(v) for v in values.split(",") if v.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid grid {spec!r}: values must be whole numbers")
+    if not parsed:
+        raise ValueError(f"Invalid grid {spec!r}: no values")
+    return name, parsed
+
+def load_grid(specs, grid_file=None):
+    """{parameter: [values]} from --grid specs and an optional JSON file {"NAME": [values], ...}."""
+    grid = {}
+    if grid_file:
+        with open(grid_file) as f:
+            for name, values in json.load(f).items():
+                name, values = parse_grid(f"{name}={','.join(str(v) for v in values)}")
+                grid[name] = values
+    for spec in specs or []:
+        name, values = parse_grid(spec)
+        grid[name] = values
+    if not grid:
+        raise ValueError("No parameters to sweep")
+    return grid
+
+def build_grid(grid):
+    """
+    One row per combination of the grid values (Combination, P_<name> per swept parameter,
+    Is_Default). The default parameters are added if the grid does not contain them.
+    """
+    names = list(grid)
+    combos = list(dict.fromkeys(itertools.product(*(sorted(set(grid[n])) for n in names))))
+    default = tuple(RULE_PARAMETERS[n] for n in names)
+    if default not in combos:
+        combos.append(default)
+    df = pd.DataFrame(combos, columns=[f"P_{n}" for n in names])
+    df.insert(0, "Combination", range(len(df)))
+    df["Is_Default"] = [c == default for c in combos]
+    return df
+
+
+# --- Query ---
+def _dependent_features(swept, windows_swept):
+    """Names of the window and derived features whose value depends on a swept parameter."""
+    dirty = set(psi_rules.WINDOW_FEATURES) if windows_swept else set()
+    for name, expr in psi_rules.DERIVED_FEATURES.items():
+        if any("{" + p + "}" in expr for p in swept) or set(re.findall(r"\b[A-Z][A-Z0-9_]*\b", expr)) & dirty:
+            dirty.add(name)
+    return dirty
+
+def build_window_offsets(con, psis, validate_timing=True):
+    """
+    Creates `window_offsets`: per encounter, the distinct day offsets of each window's procedure
+    set from its anchor's first procedure (<window>_OFFSETS), so any window bounds can be tested.
+    """
+    features = psi_rules.referenced_features(psis, validate_timing)
+    dx_scopes, _, proc_sets, _ = psi_rules.required_code_set_features(features)
+    _, proc_layout = psi_rules.membership_layouts(dx_scopes, proc_sets)
+    exprs = [f"list(DISTINCT floor_div(p.minute - f.PR_{anchor}_FIRST, {MINUTES_PER_DAY})) "
+             f"FILTER (WHERE {psi_duckdb._has_bit(proc_layout, proc_set, 'm.M_{}')} AND f.PR_{anchor}_FIRST IS NOT NULL) "
+             f"AS {name}_OFFSETS"
+             for name, (proc_set, anchor, _, _) in psi_rules.WINDOW_FEATURES.items()]
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE window_offsets AS
+        SELECT p.row_idx, {', '.join(exprs)}
+        FROM proc_long p JOIN proc_bits m ON m.code = p.code
+        JOIN proc_features f ON f.row_idx = p.row_idx
+        WHERE p.minute IS NOT NULL
+        GROUP BY p.row_idx
+    """)
+
+def sweep_query(psis, swept, validate_timing=True):
+    """
+    SELECT of Combination, Encounters and Inclusions_<PSI> per combination of `sweep_grid`.
+    Swept parameters read the grid's P_ columns; the others keep their values.
+    """
+    parameters = {name: f"P_{name}" for name in swept}
+    low_param, high_param = psi_rules.WINDOW_PARAMETERS
+    windows_swept = low_param in swept or high_param in swept
+    dirty = _dependent_features(swept, windows_swept)
+
+    low = f"P_{low_param}" if low_param in swept else RULE_PARAMETERS[low_param]
+    high = f"P_{high_param}" if high_param in swept else RULE_PARAMETERS[high_param]
+    windows = [f"COALESCE(len(list_filter(o.{name}_OFFSETS, x -> x BETWEEN {low} AND {high})) > 0, FALSE) AS {name}"
+               for name in psi_rules.WINDOW_FEATURES] if windows_swept else []
+    derived = [f"{expr} AS {name}" for name, expr in psi_rules.compile_derived_features(validate_timing, parameters)
+               if name in dirty]
+    counts = [f"count_if(({psi_rules.compile_psi(psi, validate_timing, parameters)['Status']}) = 'Inclusion') "
+              f"AS Inclusions_{psi}" for psi in psis]
+    exclude = f" EXCLUDE ({', '.join(sorted(dirty))})" if dirty else ""
+    join = "LEFT JOIN window_offsets o ON o.row_idx = f.row_idx" if windows_swept else ""
+    return f"""
+        SELECT Combination, count(*) AS Encounters, {', '.join(counts)}
+        FROM (
+            SELECT *{', ' + ', '.join(derived) if derived else ''}
+            FROM (
+                SELECT f.*{exclude}, {', '.join(windows) + ',' if windows else ''} g.*
+                FROM features f {join}
+                CROSS JOIN sweep_grid g
+            )
+        )
+        GROUP BY Combination
+        ORDER BY Combination
+    """
+
+
+# --- Sweep ---
+def sweep_rates(counts, grid_df, psis):
+    """Long rate table (one row per combination and PSI) from the per-combination counts."""
+    swept = [c[2:] for c in grid_df.columns if c.startswith("P_")]
+    merged = grid_df.merge(counts, on="Combination")
+    default = merged[merged["Is_Default"]].iloc[0]
+    rows = []
+    for _, combo in merged.iterrows():
+        for psi in psis:
+            total_cases, inclusions = int(combo["Encounters"]), int(combo[f"Inclusions_{psi}"])
+            rate = round(inclusions / total_cases * 1000, 2) if total_cases > 0 else 0.0
+            base_inclusions = int(default[f"Inclusions_{psi}"])
+            base_rate = round(base_inclusions / total_cases * 1000, 2) if total_cases > 0 else 0.0
+            row = {name: int(combo[f"P_{name}"]) for name in swept}
+            row.update({
+                "Is_Default": bool(combo["Is_Default"]), "PSI": psi, "Encounters": total_cases,
+                "Inclusions": inclusions, "Exclusions": total_cases - inclusions, "Rate_per_1000": rate,
+                "Rate_Change": round(rate - base_rate, 2),
+            })
+            rows.append(row)
+    return pd.DataFrame(rows, columns=swept + ["Is_Default", "PSI", "Encounters", "Inclusions", "Exclusions",
+                                               "Rate_per_1000", "Rate_Change"])
+
+def sweep(source, code_sets, grid, psis=None, validate_timing=True, threads=None, cache_dir=psi_duckdb.DEFAULT_CACHE_DIR):
+    """
+    Rates of `psis` for every combination of `grid` ({parameter: [values]}, see load_grid).
+    Returns the long rate table of sweep_rates().
+    """
+    psis = list(psis or PSI_LIST)
+    grid_df = build_grid(grid)
+    con = psi_duckdb.connect(threads)
+    try:
+        psi_duckdb.prepare(con, source, code_sets, psis, validate_timing, cache_dir)
+        if set(grid) & set(psi_rules.WINDOW_PARAMETERS):
+            build_window_offsets(con, psis, validate_timing)
+        con.register("sweep_grid_df", grid_df.drop(columns=["Is_Default"]))
+        con.execute("CREATE OR REPLACE TEMP TABLE sweep_grid AS SELECT * FROM sweep_grid_df")
+        counts = con.execute(sweep_query(psis, list(grid), validate_timing)).df()
+    finally:
+        con.close()
+    return sweep_rates(counts, grid_df, psis)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PSI 05-15 rates over grids of the specification thresholds")
+    parser.add_argument("--input", required=True, help="Encounter file (.xlsx, .csv or .parquet)")
+    parser.add_argument("--appendix", required=True, help="PSI appendix (.xlsx or .json)")
+    parser.add_argument("--grid", action="append", default=[], metavar="NAME=V1,V2",
+                        help=f"Values of one parameter; repeat per parameter. Parameters: {', '.join(RULE_PARAMETERS)}")
+    parser.add_argument("--grid-file", help='JSON grid {"NAME": [values], ...} (--grid entries override it)')
+    parser.add_argument("--output", required=True, help="Rate table (.csv or .parquet)")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--threads", type=int, help="DuckDB threads (default: all cores)")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    try:
+        grid = load_grid(args.grid, args.grid_file)
+    except ValueError as e:
+        parser.error(str(e))
+
+    started = time.time()
+    rates = sweep(args.input, load_code_sets(args.appendix), grid, psis,
+                  validate_timing=not args.no_timing_validation, threads=args.threads)
+    elapsed = time.time() - started
+    if args.output.lower().endswith(".parquet"):
+        rates.to_parquet(args.output, index=False)
+    else:
+        rates.to_csv(args.output, index=False)
+    combinations = len(rates) // len(psis)
+    logger.info("Swept %d parameter combinations in %.1fs", combinations, elapsed)
+    print(json.dumps({
+        "input": args.input,
+        "parameters": {name: sorted(set(values)) for name, values in grid.items()},
+        "combinations": combinations,
+        "encounters": int(rates["Encounters"].iloc[0]) if len(rates) else 0,
+        "seconds": round(elapsed, 2),
+        "output": args.output,
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
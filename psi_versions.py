@@ -0,0 +1,165 @@
+"""
+Multi-version scoring: evaluates the same encounters against several appendix
+versions in one run, e.g. the previous and the new AHRQ release during a
+transition period.
+
+The input is read, its column aliases resolved and every encounter's diagnoses
+and procedures extracted (pandas) or unpivoted into the long tables
+(DuckDB/Polars) once; each version then runs its own code sets and rules on
+that shared data (psi_engine.score_versions), so N versions cost little more
+than one run.
+
+    python psi_versions.py --input encounters.xlsx --appendix v2024=PSI_Appendix_v2024.xlsx \
+        --appendix v2025=PSI_Appendix_v2025.xlsx --output-dir versions/
+
+Outputs in --output-dir:
+- <PSI>.parquet (or .csv): one row per encounter with Status, Rationale and details per version
+  (suffixed _<label>) and Status_Changed
+- version_rates.csv: encounters, inclusions and rate per 1000 per PSI and version, with the change
+  against the first version and how many encounters moved between Inclusion and Exclusion
+- versions_summary.json: versions, rows and timings
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import pandas as pd
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+logger = logging.getLogger(__name__)
+
+# Result columns that come from the encounter, not from the appendix; they appear once per row
+SHARED_COLUMNS = ["EncounterID", "PSI", "Age", "MS_DRG", "PrincipalDX", "ATYPE", "Length_of_Stay"]
+
+
+# --- Inputs ---
+def parse_version(spec):
+    """'LABEL=path' (or just a path, labelled by its file name) -> (label, path)."""
+    label, sep, path = spec.partition("=")
+    if not sep:
+        path, label = spec, os.path.splitext(os.path.basename(spec))[0]
+    label = label.strip()
+    if not label or not path:
+        raise ValueError(f"Invalid appendix version: {spec!r} (expected LABEL=path)")
+    return label, path
+
+def load_versions(specs):
+    """{label: code sets} in the order given; the first version is the baseline of the comparison."""
+    versions = {}
+    for spec in specs:
+        label, path = parse_version(spec)
+        if label in versions:
+            raise ValueError(f"Appendix version {label!r} given twice")
+        versions[label] = psi_engine.load_code_sets(path)
+    return versions
+
+
+# --- Comparison ---
+def side_by_side(results, psi):
+    """
+    One row per encounter: the shared columns, then every other result column of each
+    version suffixed with _<label>, and Status_Changed (the versions disagree on Status).
+    """
+    labels = list(results)
+    frames = [psi_rules.decode_reasons(psi, results[label][psi]) for label in labels]
+    frames = [psi_rules.text_details(psi, f) if psi_rules.has_typed_details(psi, f) else f for f in frames]
+    combined = frames[0][[c for c in SHARED_COLUMNS if c in frames[0].columns]].copy()
+    for label, frame in zip(labels, frames):
+        for column in frame.columns:
+            if column not in SHARED_COLUMNS:
+                combined[f"{column}_{label}"] = frame[column].to_numpy()
+    statuses = combined[[f"Status_{label}" for label in labels]]
+    combined["Status_Changed"] = statuses.nunique(axis=1).gt(1).to_numpy()
+    return combined
+
+def version_rates(results):
+    """
+    Encounters, inclusions and rate per 1000 per PSI and version. Rate_Change and the moves
+    between Inclusion and Exclusion are measured against the first version.
+    """
+    labels = list(results)
+    baseline = labels[0]
+    rows = []
+    for psi in results[baseline]:
+        base_included = results[baseline][psi]["Status"].eq("Inclusion").to_numpy()
+        base_rate = None
+        for label in labels:
+            included = results[label][psi]["Status"].eq("Inclusion").to_numpy()
+            total_cases = len(included)
+            inclusions = int(included.sum())
+            rate = round(inclusions / total_cases * 1000, 2) if total_cases > 0 else 0.0
+            base_rate = rate if base_rate is None else base_rate
+            rows.append({
+                "PSI": psi, "Version": label, "Encounters": total_cases, "Inclusions": inclusions,
+                "Exclusions": total_cases - inclusions, "Rate_per_1000": rate,
+                "Rate_Change": round(rate - base_rate, 2),
+                "Became_Inclusion": int((included & ~base_included).sum()),
+                "Became_Exclusion": int((~included & base_included).sum()),
+            })
+    return pd.DataFrame(rows, columns=["PSI", "Version", "Encounters", "Inclusions", "Exclusions", "Rate_per_1000",
+                                       "Rate_Change", "Became_Inclusion", "Became_Exclusion"])
+
+def write_outputs(combined, rates, summary, output_dir, fmt="parquet"):
+    os.makedirs(output_dir, exist_ok=True)
+    for psi, df in combined.items():
+        path = os.path.join(output_dir, f"{psi}.{fmt}")
+        if fmt == "parquet":
+            psi_engine.make_parquet_safe(df).to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+    rates.to_csv(os.path.join(output_dir, "version_rates.csv"), index=False)
+    with open(os.path.join(output_dir, "versions_summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score PSI 05-15 against several appendix versions in one pass")
+    parser.add_argument("--input", required=True, help="Encounter file (.xlsx, .csv or .parquet)")
+    parser.add_argument("--appendix", action="append", required=True, metavar="LABEL=PATH",
+                        help="Appendix version (.xlsx or .json); repeat for each version, the first is the baseline")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--psis", default="", help="Comma-separated PSIs (default: all)")
+    parser.add_argument("--backend", choices=psi_engine.BACKENDS, default="pandas")
+    parser.add_argument("--no-timing-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    psis = [p.strip().upper() for p in args.psis.split(",") if p.strip()] or PSI_LIST
+    unknown = [p for p in psis if p not in PSI_LIST]
+    if unknown:
+        parser.error(f"Unknown PSI(s): {', '.join(unknown)}")
+    try:
+        versions = load_versions(args.appendix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    started = time.time()
+    results = psi_engine.score_versions(args.input, psis, versions, validate_timing=not args.no_timing_validation,
+                                        backend=args.backend)
+    elapsed = time.time() - started
+    combined = {psi: side_by_side(results, psi) for psi in psis}
+    rates = version_rates(results)
+    summary = {
+        "input": args.input,
+        "versions": list(versions),
+        "encounters": len(combined[psis[0]]),
+        "psis": psis,
+        "backend": args.backend,
+        "seconds": round(elapsed, 2),
+        "status_changed": {psi: int(df["Status_Changed"].sum()) for psi, df in combined.items()},
+    }
+    write_outputs(combined, rates, summary, args.output_dir, args.format)
+    logger.info("Scored %d encounters against %d appendix versions in %.1fs", summary["encounters"], len(versions), elapsed)
+    print(json.dumps({k: v for k, v in summary.items() if k != "psis"}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
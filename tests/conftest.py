@@ -0,0 +1,144 @@
+"""
+Shared fixtures: a small synthetic appendix covering every code set the rules read, and
+encounters drawn from it, so the suite needs no AHRQ files.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psi_engine
+from psi_engine import PSI_LIST
+
+CODES_PER_SET = 3
+MAX_DX = 12
+MAX_PROCS = 8
+
+# Appendix sets the PSI logic reads
+DX_SETS = [
+    "ABWALLCD", "ACURF2D", "ACURF3D", "ADRENAL15D", "CANCEID", "CARDIID", "CARDRID", "COAGDID", "CRENLFD", "CTRAUMD",
+    "DEEPVIB", "DGNEUID", "DIAPHR15D", "FOREIID", "FXID", "GI15D", "GU15D", "HIPFXID", "HITD", "IATPTXD", "IATROID",
+    "IDTMC3D", "IMMUNID", "INFECID", "MALHYPD", "MALIGNANCY", "MDC14PRINDX", "MDC15PRINDX", "MEDBLEEDD",
+    "MODERATEIMMUNED", "NEUROMD", "NEURTRAD", "PHYSIDB", "PLEURAD", "POHMRI2D", "PROSFXID", "PULMOID", "SEPTI2D",
+    "SEVEREIMMUNED", "SHOCKID", "SOLKIDD", "SPLEEN15D", "TRACHID", "URINARYOBSID", "VESSEL15D",
+]
+PROC_SETS = [
+    "ABDOMI15P", "ABDOMIPOPEN", "ABDOMIPOTHER", "ADRENAL15P", "CARDSIP", "CHEMOTHERAPYP", "DIALY2P", "DIALYIP",
+    "DIAPHR15P", "ECMOP", "GI15P", "GU15P", "HEMOTH2P", "IMMUNIP", "LUNGCIP", "LUNGTRANSP", "NUCRANP", "ORPROC",
+    "PNEPHREP", "PR9604P", "PR9671P", "PR9672P", "PRESOPP", "RADIATIONP", "RECLOIP", "SPLEEN15P", "THORAIP",
+    "THROMBOLYTICP", "THROMP", "TRACHIP", "VENACIP", "VESSEL15P",
+]
+DRG_SETS = {"SURGI2R": range(100, 140), "MEDIC2R": range(140, 180)}
+
+
+def make_sets():
+    """
+    {set name: codes} with a few made-up codes per set. Some sets overlap the way the real
+    ones do (hip fractures are fractures, several procedure sets are OR procedures), so the
+    exclusions that depend on that fire.
+    """
+    sets = {name: [f"{kind}{name[:4]}{i:03d}" for i in range(CODES_PER_SET)]
+            for kind, names in (("D", DX_SETS), ("P", PROC_SETS)) for name in names}
+    sets["HIPFXID"] = sets["FXID"][:1]
+    sets["ORPROC"] += sets["HEMOTH2P"][:1] + sets["TRACHIP"][:1] + sets["VENACIP"][:1] + sets["ABDOMIPOPEN"] + sets["ABDOMI15P"]
+    sets.update({name: [str(drg) for drg in drgs] for name, drgs in DRG_SETS.items()})
+    return sets
+
+def make_appendix():
+    """An appendix DataFrame in the "Codes (<SET>)" layout."""
+    sets = make_sets()
+    rows = max(len(codes) for codes in sets.values())
+    return pd.DataFrame({f"Codes ({name})": codes + [None] * (rows - len(codes)) for name, codes in sets.items()})
+
+def make_encounters(rows, seed=0):
+    """
+    `rows` encounters in the DX/POA/Proc layout the app documents, with codes from make_sets(),
+    invalid POAs, missing fields, DRG 999, minors and undated procedures mixed in.
+    """
+    rng = np.random.default_rng(seed)
+    sets = make_sets()
+    dx_pool = [c for name in DX_SETS for c in sets[name]] + ["Z000", "I10", "E119"]
+    proc_pool = [c for name in PROC_SETS for c in sets[name]] + ["0000000"]
+    drgs = [int(c) for name in DRG_SETS for c in sets[name]]
+    admit = pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 700, rows), unit="D")
+    los = rng.integers(0, 31, rows)
+
+    def pick(values, mask=None):
+        out = np.asarray(values, dtype=object)[rng.integers(0, len(values), rows)]
+        if mask is not None:
+            out[~mask] = None
+        return out
+
+    df = pd.DataFrame({
+        "EncounterID": [f"E{i:07d}" for i in range(rows)],
+        "Age": np.where(rng.random(rows) < 0.9, rng.integers(18, 96, rows), rng.integers(0, 18, rows)),
+        "SEX": pick(["M", "F"], rng.random(rows) > 0.02),
+        "ATYPE": pick([1, 2, 3, 3]),
+        "DQTR": rng.integers(1, 5, rows),
+        "YEAR": rng.integers(2024, 2026, rows),
+        "MS-DRG": np.where(rng.random(rows) < 0.02, 999, np.where(rng.random(rows) < 0.8, pick(drgs).astype(int), rng.integers(1, 999, rows))),
+        "MDC": rng.integers(1, 26, rows),
+        "admission_date": admit,
+        "discharge_date": admit + pd.to_timedelta(los, unit="D"),
+        "length_of_stay": los,
+    })
+    dx_count = rng.integers(1, MAX_DX + 1, rows)
+    for j in range(1, MAX_DX + 1):
+        present = dx_count >= j
+        df[f"DX{j}"] = pick(dx_pool, present)
+        df[f"POA{j}"] = pick(["Y", "N", "N", "U", "W", "X", None] if j > 1 else ["Y", "N"], present)
+    proc_count = rng.integers(0, MAX_PROCS + 1, rows)
+    for j in range(1, MAX_PROCS + 1):
+        present = proc_count >= j
+        codes = pick(proc_pool, present)
+        if j == 1: # Most encounters with procedures start with an OR procedure
+            codes = np.where(present & (rng.random(rows) < 0.7), pick(sets["ORPROC"]), codes)
+        dated = present & (rng.random(rows) < 0.9)
+        offsets = pd.to_timedelta(rng.integers(0, 13 if j == 1 else 26, rows), unit="D")
+        df[f"Proc{j}"] = codes
+        df[f"Proc{j}_Date"] = np.where(dated, (admit + offsets).strftime("%Y-%m-%d"), None)
+        df[f"Proc{j}_Time"] = pick(["0830", "143000", "23:15:00"], dated & (rng.random(rows) < 0.5))
+    return df
+
+
+@pytest.fixture(scope="session")
+def appendix_df():
+    return make_appendix()
+
+@pytest.fixture(scope="session")
+def code_sets(appendix_df):
+    return psi_engine.build_code_sets(appendix_df)
+
+@pytest.fixture(scope="session")
+def encounters():
+    """400 synthetic encounters (fixed seed) with a Facility column for grouping."""
+    df = make_encounters(400, seed=11)
+    df["Facility"] = pd.Series(["North", "South", None, "East"] * 100, dtype=object)
+    return df
+
+@pytest.fixture(scope="session", params=[b for b in psi_engine.BACKENDS if b in psi_engine.available_backends()])
+def backend(request):
+    return request.param
+
+@pytest.fixture(scope="session")
+def pandas_codes(encounters, code_sets):
+    """{psi: results} of the pandas engine in the compact (reason codes) form."""
+    return psi_engine.score_with_backend(encounters, PSI_LIST, code_sets, backend="pandas", reasons="codes")
+
+@pytest.fixture
+def make_encounter():
+    """Builds a one-row input: an adult surgical encounter that passes the common steps, with fields overridden."""
+    def make(**fields):
+        row = {"EncounterID": "T1", "Age": 40, "SEX": "F", "ATYPE": 3, "DQTR": 1, "YEAR": 2024, "MS-DRG": 110, "MDC": 5,
+               "admission_date": pd.Timestamp("2024-03-01"), "discharge_date": pd.Timestamp("2024-03-06"),
+               "length_of_stay": 5, "DX1": "I10", "POA1": "Y"}
+        row.update(fields)
+        return pd.DataFrame([row])
+    return make
+
@@ -0,0 +1,50 @@
+"""App load test (psi_appload): server metrics and one session driving the running app."""
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import psi_appload
+
+
+def test_usage_includes_child_processes():
+    child = subprocess.Popen([sys.executable, "-c", "while True: pass"]) # Busy, so it uses CPU
+    try:
+        time.sleep(1.0)
+        cpu, rss = psi_appload.process_usage(child.pid)
+        assert cpu > 0.3 and rss > 0
+        total, _ = psi_appload.process_usage(os.getpid())
+        assert total >= cpu # This process and its children, including the busy one
+    finally:
+        child.kill()
+        child.wait()
+    assert psi_appload.process_usage(child.pid) is None
+
+def test_sampler_summary():
+    sampler = psi_appload.ServerSampler(os.getpid(), interval=0.05)
+    assert sampler.summary()["cpu_percent_mean"] is None
+    sampler.start()
+    time.sleep(0.3)
+    summary = sampler.stop()
+    assert summary["rss_mb_peak"] >= summary["rss_mb_mean"] > 0 and summary["cpu_percent_peak"] >= 0
+
+def test_one_session_runs_the_scenario(encounters, appendix_df, tmp_path):
+    if psi_appload.websocket_connect is None:
+        pytest.skip("driving the app needs streamlit and websockets")
+    input_path, appendix_path = str(tmp_path / "input.xlsx"), str(tmp_path / "appendix.xlsx")
+    encounters.head(120).drop(columns="Facility").to_excel(input_path, index=False)
+    appendix_df.to_excel(appendix_path, index=False)
+    process, base_url = psi_appload.launch_app()
+    try:
+        records, summary = psi_appload.run_level(base_url, 1, input_path, appendix_path, think_time=0, timeout=120,
+                                                 server_pid=process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    assert [r["Step"] for r in records] == psi_appload.SCENARIO, records
+    assert all(r["OK"] for r in records), [r["Error"] for r in records if not r["OK"]]
+    assert summary["completed_sessions"] == 1 and summary["errors"] == 0
+    assert set(summary["steps"]) == set(psi_appload.SCENARIO) and summary["rss_mb_peak"] > 0
+    assert next(r for r in records if r["Step"] == "download")["Bytes"] > 0
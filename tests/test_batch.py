@@ -0,0 +1,60 @@
+"""Batch mode (psi_batch): many files scored in a pool, merged in file order, rated per facility."""
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import psi_batch
+import psi_engine
+
+PSIS = ["PSI_08", "PSI_12", "PSI_15"]
+
+
+@pytest.fixture
+def facility_files(tmp_path, encounters):
+    """The encounters split into one parquet file per facility (of different sizes) plus a broken file."""
+    parts = {"north": encounters.iloc[:50], "south": encounters.iloc[50:300], "east": encounters.iloc[300:]}
+    paths = {}
+    for name, part in parts.items():
+        paths[name] = str(tmp_path / f"{name}.parquet")
+        psi_engine.make_parquet_safe(part).to_parquet(paths[name])
+    paths["broken"] = str(tmp_path / "broken.csv")
+    with open(paths["broken"], "w") as f:
+        f.write("not,an\x00encounter,file\n\"")
+    return parts, paths
+
+
+def test_merged_results_and_rates(facility_files, encounters, code_sets, tmp_path):
+    parts, paths = facility_files
+    manifest = str(tmp_path / "manifest.json")
+    with open(manifest, "w") as f:
+        json.dump([{"path": os.path.basename(paths[name]), "facility": name.title()} for name in parts], f)
+    files = psi_batch.files_from_manifest(manifest)
+    assert [files[i].facility for i in psi_batch.schedule_largest_first(files)] == ["South", "East", "North"]
+
+    merged, rates, summary = psi_batch.score_batch(files, code_sets, psis=PSIS, workers=2)
+    assert summary["failed"] == 0 and summary["encounters"] == len(encounters)
+    expected = psi_engine.score_dataframe(encounters, PSIS, code_sets)
+    for psi in PSIS:
+        # Merged in manifest order, whatever order the files finished in
+        assert merged[psi]["EncounterID"].tolist() == encounters["EncounterID"].tolist()
+        assert merged[psi]["Status"].tolist() == [r["Status"] for r in expected[psi]]
+        assert merged[psi]["Facility"].tolist() == [name.title() for name, part in parts.items() for _ in range(len(part))]
+    rates = rates.set_index(["PSI", "Facility"])
+    for psi in PSIS:
+        inclusions = [r["Status"] == "Inclusion" for r in expected[psi]]
+        assert rates.loc[(psi, "ALL"), "Inclusions"] == sum(inclusions)
+        assert rates.loc[(psi, "North"), "Inclusions"] == sum(inclusions[:50])
+        assert rates.loc[(psi, "North"), "Rate_per_1000"] == round(sum(inclusions[:50]) / 50 * 1000, 2)
+
+def test_a_failing_file_is_reported(facility_files, code_sets, tmp_path):
+    _, paths = facility_files
+    files = psi_batch.files_from_directory(str(tmp_path))
+    assert [f.facility for f in files] == ["broken", "east", "north", "south"]
+    merged, rates, summary = psi_batch.score_batch(files, code_sets, psis=["PSI_08"], workers=2)
+    assert summary["failed"] == 1 and "error" in summary["files"][0]
+    assert set(merged["PSI_08"]["Source_File"]) == {"east.parquet", "north.parquet", "south.parquet"}
+    psi_batch.write_outputs(merged, rates, summary, str(tmp_path / "out"))
+    assert sorted(os.listdir(tmp_path / "out")) == ["PSI_08.parquet", "batch_summary.json", "facility_rates.csv"]
+    assert pd.read_parquet(tmp_path / "out" / "PSI_08.parquet")["Status"].tolist() == merged["PSI_08"]["Status"].tolist()
@@ -0,0 +1,31 @@
+"""Code set membership bit planes (psi_rules.MembershipLayout) in the columnar engines."""
+import pytest
+
+import psi_engine
+import psi_rules
+
+PSIS = ["PSI_05", "PSI_09", "PSI_11", "PSI_13", "PSI_15"]
+
+
+def test_layout_packs_one_bit_per_set():
+    names = [f"SET{i:03d}" for i in range(130)]
+    layout = psi_rules.MembershipLayout(reversed(names))
+    assert layout.words == 3 and layout.word_columns() == ["M_0", "M_1", "M_2"]
+    masks = [layout.mask(name) for name in names]
+    assert len(set(masks)) == len(names)
+    assert all(0 < mask < 2 ** 63 for _, mask in masks) # The sign bit is never used
+    table = layout.code_table({"SET000": ["A1", "B2"], "SET064": ["A1"], "SET129": [7]}).set_index("code")
+    word, mask = layout.mask("SET064")
+    assert table.loc["A1", f"M_{word}"] == mask and table.loc["A1", "M_0"] == layout.mask("SET000")[1]
+    assert table.loc["7"].tolist() == [0, 0, layout.mask("SET129")[1]]
+    assert (table.dtypes == "int64").all()
+
+@pytest.mark.parametrize("bits_per_word", [psi_rules.BITS_PER_WORD, 5])
+def test_engines_match_across_words(encounters, code_sets, backend, bits_per_word, monkeypatch):
+    # With 5 bits per word every plane spans many words, so sets in later words are tested too
+    monkeypatch.setattr(psi_rules, "BITS_PER_WORD", bits_per_word)
+    expected = psi_engine.score_with_backend(encounters, PSIS, code_sets, backend="pandas")
+    results = psi_engine.score_with_backend(encounters, PSIS, code_sets, backend=backend)
+    for psi in PSIS:
+        for column in ("Status", "Reason", "Rationale"):
+            assert results[psi][column].astype(str).tolist() == expected[psi][column].astype(str).tolist(), (psi, column)
@@ -0,0 +1,48 @@
+"""Database source and sink (psi_db): a SQLite warehouse round trip."""
+import pandas as pd
+import pytest
+
+import psi_db
+import psi_engine
+
+pytest.importorskip("sqlalchemy")
+
+PSIS = ["PSI_08", "PSI_12", "PSI_15"]
+
+
+@pytest.fixture
+def warehouse(tmp_path, encounters):
+    """A SQLite file with the encounters under warehouse column names, dates stored as text."""
+    engine = psi_db.create_db_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    table = encounters.rename(columns={"EncounterID": "encounter_id", "MS-DRG": "ms_drg"})
+    table[["admission_date", "discharge_date"]] = table[["admission_date", "discharge_date"]].astype(str)
+    table.to_sql("encounters", engine, index=False)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_round_trip(warehouse, encounters, code_sets, workers):
+    summary = psi_db.score_database(warehouse, "SELECT * FROM encounters", code_sets, psis=PSIS,
+                                    column_map={"encounter_id": "EncounterID", "ms_drg": "MS-DRG"},
+                                    workers=workers, fetch_size=64, commit_rows=100)
+    assert summary["encounters"] == len(encounters) and summary["result_rows"] == len(encounters) * len(PSIS)
+    assert summary["tables"] == [psi_db.result_table_name(psi_db.DEFAULT_RESULT_PREFIX, psi) for psi in PSIS]
+    expected = psi_engine.score_dataframe(encounters, PSIS, code_sets)
+    for psi, table in zip(PSIS, summary["tables"]):
+        stored = pd.read_sql_table(table, warehouse)
+        assert (stored["Run_ID"] == summary["run_id"]).all()
+        # Chunks arrive in order from the pool too, so the rows keep the query order
+        assert stored["EncounterID"].tolist() == encounters["EncounterID"].tolist()
+        assert stored["Status"].tolist() == [r["Status"] for r in expected[psi]]
+        assert stored["Rationale"].notna().all()
+
+def test_runs_append_unless_replaced(warehouse, code_sets):
+    query = "SELECT * FROM encounters LIMIT 10"
+    column_map = {"encounter_id": "EncounterID", "ms_drg": "MS-DRG"}
+    first = psi_db.score_database(warehouse, query, code_sets, psis=["PSI_08"], column_map=column_map)
+    second = psi_db.score_database(warehouse, query, code_sets, psis=["PSI_08"], column_map=column_map)
+    table = first["tables"][0]
+    assert pd.read_sql_table(table, warehouse)["Run_ID"].value_counts().to_dict() == {first["run_id"]: 10, second["run_id"]: 10}
+    psi_db.score_database(warehouse, query, code_sets, psis=["PSI_08"], column_map=column_map, replace=True)
+    assert len(pd.read_sql_table(table, warehouse)) == 10
@@ -0,0 +1,73 @@
+"""Detail_ columns: the typed schema, its text form, and Parquet/Arrow types."""
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+
+@pytest.fixture(scope="module")
+def typed(encounters, code_sets, backend):
+    return psi_engine.score_with_backend(encounters, PSI_LIST, code_sets, backend=backend, reasons="codes", details="typed")
+
+@pytest.fixture(scope="module")
+def text(encounters, code_sets, backend):
+    return psi_engine.score_with_backend(encounters, PSI_LIST, code_sets, backend=backend, reasons="codes")
+
+def assert_same_values(left, right):
+    pd.testing.assert_frame_equal(left.astype(object).where(left.notna(), None).reset_index(drop=True),
+                                  right.astype(object).where(right.notna(), None).reset_index(drop=True))
+
+
+@pytest.mark.parametrize("psi", PSI_LIST)
+def test_typed_schema(typed, psi):
+    frame = typed[psi]
+    kinds = psi_rules.detail_kinds(psi)
+    assert psi_rules.has_typed_details(psi, frame)
+    for column, kind in kinds.items():
+        values = frame[column].dropna()
+        if kind == "bool":
+            assert frame[column].dtype == "boolean"
+        elif kind == "category":
+            assert isinstance(frame[column].dtype, pd.CategoricalDtype)
+        elif kind == "codes":
+            assert all(isinstance(v, list) and all(isinstance(c, str) for c in v) for v in values)
+        else:
+            assert all(isinstance(v, list) and all(set(e) == {"organ", *psi_rules.ORGAN_ANALYSIS_FIELDS} for e in v)
+                       for v in values)
+
+@pytest.mark.parametrize("psi", PSI_LIST)
+def test_text_form_of_typed_details(typed, text, psi):
+    # text_details() of the typed form is exactly what the engine writes in the text form
+    rendered = psi_rules.text_details(psi, typed[psi])
+    assert list(rendered.columns) == list(text[psi].columns)
+    assert_same_values(rendered, text[psi])
+
+@pytest.mark.parametrize("psi", ["PSI_08", "PSI_11", "PSI_15"])
+def test_typed_details_keep_their_arrow_types(typed, psi, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / f"{psi}.parquet")
+    psi_engine.write_results_parquet(typed[psi], path, psi)
+    schema = pq.read_schema(path)
+    kinds = psi_rules.detail_kinds(psi)
+    for column, kind in kinds.items():
+        if kind != "category":
+            assert schema.field(column).type == psi_engine._arrow_type(kind), column
+    # Lists come back as arrays; typed again they are the values written
+    stored = psi_rules.type_details(psi, pd.read_parquet(path))
+    assert_same_values(stored[list(kinds)], typed[psi][list(kinds)])
+
+
+def test_detail_values():
+    organs = [{"organ": "spleen", "has_injury_dx": True, "has_related_proc_in_window": False, "is_poa_excluded": False}]
+    assert psi_rules._typed_detail("codes", ("A1", "B2")) == ["A1", "B2"]
+    assert psi_rules._typed_detail("bool", 1) is True
+    assert psi_rules._typed_detail("organs", {"spleen": {"has_injury_dx": 1, "has_related_proc_in_window": 0,
+                                                         "is_poa_excluded": 0}}) == organs
+    assert psi_rules._typed_detail("codes", None) is None
+    assert psi_rules._text_detail("codes", ["A1", "B2"]) == "['A1', 'B2']"
+    assert psi_rules._text_detail("organs", organs) == str(
+        {"spleen": {"has_injury_dx": True, "has_related_proc_in_window": False, "is_poa_excluded": False}})
+    assert psi_rules._text_detail("codes", "['A1']") == "['A1']"
+    assert psi_rules._text_detail("bool", float("nan")) is None
@@ -0,0 +1,30 @@
+"""DuckDB backend (psi_duckdb): the SQL rules against the per-row engine."""
+import pandas as pd
+import pytest
+
+import psi_engine
+from psi_engine import PSI_LIST
+
+psi_duckdb = pytest.importorskip("psi_duckdb")
+pytest.importorskip("duckdb")
+
+
+def assert_matches_engine(results, expected):
+    """Columnar results agree with score_dataframe's records on the status and its reason."""
+    assert list(results) == list(expected)
+    for psi, records in expected.items():
+        frame, reference = results[psi], pd.DataFrame(records)
+        for column in [c for c in ("EncounterID", "Status", "Reason", "Rationale") if c in reference.columns]:
+            assert frame[column].astype(str).tolist() == reference[column].astype(str).tolist(), (psi, column)
+
+
+@pytest.mark.parametrize("validate_timing", [True, False])
+def test_matches_the_row_engine(encounters, code_sets, validate_timing):
+    expected = psi_engine.score_dataframe(encounters, PSI_LIST, code_sets, validate_timing=validate_timing)
+    assert_matches_engine(psi_duckdb.score(encounters, code_sets, validate_timing=validate_timing), expected)
+
+def test_file_inputs(encounters, code_sets, tmp_path):
+    path = str(tmp_path / "encounters.parquet")
+    psi_engine.make_parquet_safe(encounters).to_parquet(path)
+    expected = psi_engine.score_dataframe(encounters, ["PSI_09", "PSI_15"], code_sets)
+    assert_matches_engine(psi_duckdb.score(path, code_sets, psis=["PSI_09", "PSI_15"], cache_dir=str(tmp_path)), expected)
@@ -0,0 +1,60 @@
+"""Workbook reading (psi_excel): projected columns, codes as text, the rest as pd.read_excel() types them."""
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_excel
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    df = pd.DataFrame({
+        "EncounterID": ["E1", "E2", "E3"],
+        "Age": [40, 71, None],
+        "SEX": ["F", "M", "F"],
+        "YEAR": [2024, 2024, 2025],
+        "MS-DRG": [110, 999, 150],
+        "admission_date": pd.to_datetime(["2024-01-03", "2024-02-10", "2025-03-01"]),
+        "DX1": [4019, "I10", "E119"], # a code Excel stores as a number
+        "POA1": ["Y", "N", "Y"],
+        "DX2": [25000, None, None],
+        "Proc1": ["0DTJ4ZZ", None, "0FB03ZX"],
+        "Proc1_Date": ["2024-01-04", None, "2025-03-02"],
+        "Facility": ["North", "South", None],
+        "Notes": ["x", "y", "z"], # read by no engine
+    })
+    path = str(tmp_path / "encounters.xlsx")
+    df.to_excel(path, index=False)
+    return path
+
+
+def test_input_columns_are_projected_and_typed(workbook):
+    df, report = psi_excel.read_input_excel(workbook, extra_columns=["Facility"])
+    assert "Notes" not in df.columns and "Facility" in df.columns
+    assert report["rows"] == 3 and report["columns_in_file"] == 13 and report["columns_read"] == 12
+    assert df["DX1"].tolist() == ["4019", "I10", "E119"]
+    assert df["DX2"].tolist()[0] == "25000" and df["DX2"].isna().tolist()[1:] == [True, True]
+    assert df["YEAR"].dtype == "int64" and df["Age"].dtype == "float64"
+    # Columns outside the text plan come back as pd.read_excel() gives them
+    reference = pd.read_excel(workbook)
+    for column in ["EncounterID", "Age", "SEX", "YEAR", "MS-DRG", "admission_date", "Proc1_Date", "Facility"]:
+        pd.testing.assert_series_equal(df[column], reference[column], check_dtype=False)
+
+def test_pandas_fallback_reads_the_same_frame(workbook, monkeypatch):
+    scanned, engine = psi_excel.read_excel(workbook, return_engine=True)
+    assert engine == "scan"
+    def unsupported(self, *args):
+        raise psi_excel._Unsupported("test")
+    monkeypatch.setattr(psi_excel._SheetScanner, "header", unsupported)
+    fallback, engine = psi_excel.read_excel(workbook, return_engine=True)
+    assert engine == "pandas"
+    pd.testing.assert_frame_equal(scanned, fallback, check_dtype=False)
+
+def test_appendix_workbook_round_trip(appendix_df, code_sets, tmp_path):
+    path = str(tmp_path / "appendix.xlsx")
+    appendix = appendix_df.copy()
+    appendix["Codes (NUMERIC)"] = pd.Series([4019, 25000] + [None] * (len(appendix) - 2), dtype=object)
+    appendix.to_excel(path, index=False)
+    loaded = psi_engine.load_code_sets(path)
+    assert loaded.pop("NUMERIC_CODES") == ["4019", "25000"]
+    assert loaded == code_sets
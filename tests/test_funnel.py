@@ -0,0 +1,69 @@
+"""Exclusion funnel counts: taken while scoring, equal across engines, and adding up to the totals."""
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+import psi_engine
+from psi_engine import PSI_LIST
+from psi_funnel import FunnelCounter, DENOMINATOR_STEP, STAGE_DENOMINATOR, STAGE_OUTCOME
+
+DIMENSIONS = [[], ["YEAR", "DQTR"], ["Facility"]]
+
+
+def scored_funnel(encounters, code_sets, backend, dimensions):
+    counter = FunnelCounter(dimensions)
+    results = psi_engine.score_with_backend(encounters, PSI_LIST, code_sets, backend=backend, reasons="codes", funnel=counter)
+    return counter, results
+
+@pytest.mark.parametrize("dimensions", DIMENSIONS)
+def test_counts_match_the_results(encounters, code_sets, backend, dimensions):
+    counter, results = scored_funnel(encounters, code_sets, backend, dimensions)
+    for psi in PSI_LIST:
+        counted = {}
+        for key, n in counter.counts.items():
+            if key[0] == psi:
+                counted[key[-1]] = counted.get(key[-1], 0) + n
+        assert counted == results[psi]["Reason"].astype(str).value_counts().to_dict()
+
+@pytest.mark.parametrize("dimensions", DIMENSIONS)
+def test_funnel_adds_up_to_the_totals(encounters, code_sets, backend, dimensions):
+    counter = scored_funnel(encounters, code_sets, backend, dimensions)[0]
+    group_sizes = Counter(counter.row_groups(encounters))
+    table = counter.table()
+    assert list(table["PSI"].unique()) == PSI_LIST
+    for (psi, *group), rows in table.groupby(["PSI"] + dimensions, sort=False):
+        steps = rows[rows["Stage"] != STAGE_DENOMINATOR]
+        total = steps["Encounters"].sum()
+        assert total == group_sizes[tuple(group)]
+        # Remaining counts down step by step to zero after the last outcome
+        assert (steps["Remaining"] == total - steps["Encounters"].cumsum()).all()
+        assert steps["Remaining"].iloc[-1] == 0
+        denominator = rows[rows["Step"] == DENOMINATOR_STEP]
+        assert len(denominator) == 1
+        assert denominator["Encounters"].iloc[0] == rows[rows["Stage"] == STAGE_OUTCOME]["Encounters"].sum()
+
+@pytest.mark.parametrize("dimensions", DIMENSIONS)
+def test_backends_count_the_same_funnel(encounters, code_sets, backend, dimensions):
+    expected = scored_funnel(encounters, code_sets, "pandas", dimensions)[0]
+    assert scored_funnel(encounters, code_sets, backend, dimensions)[0].counts == expected.counts
+
+
+def test_counter_merges_and_serializes():
+    first, second = FunnelCounter(["YEAR"]), FunnelCounter(["YEAR"])
+    first.count("PSI_07", "EXCL_LOS_SHORT", ("2024",))
+    first.count("PSI_07", "EXCL_LOS_SHORT", ("2024",))
+    second.add_grouped("PSI_07", pd.DataFrame({"YEAR": [2024.0, None], "Reason": ["EXCL_LOS_SHORT", "NUMERATOR"],
+                                               "Encounters": [3, 1]}))
+    merged = first.merge(second)
+    assert merged.counts == {("PSI_07", "2024", "EXCL_LOS_SHORT"): 5, ("PSI_07", "", "NUMERATOR"): 1}
+    restored = FunnelCounter.from_records(merged.to_records(), ["YEAR"])
+    assert restored.counts == merged.counts
+    with pytest.raises(ValueError):
+        merged.merge(FunnelCounter(["DQTR"]))
+
+def test_row_groups_label_missing_and_float_values():
+    counter = FunnelCounter(["YEAR", "Facility"])
+    df = pd.DataFrame({"YEAR": [2024.0, None, 2025.0], "Facility": pd.Series(["A", None, "A"], dtype=object)})
+    assert counter.row_groups(df) == [("2024", "A"), ("", ""), ("2025", "A")]
+    assert FunnelCounter(["Missing"]).row_groups(df) == [("",)] * 3
@@ -0,0 +1,59 @@
+"""Historical result store (psi_history): partitioned appends and the trend queries over them."""
+
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_history
+
+PSIS = ["PSI_08", "PSI_12"]
+
+
+@pytest.fixture
+def history(tmp_path, encounters, code_sets):
+    """A history with the encounters appended in two runs (two halves, two appendix versions for the second)."""
+    history_dir = str(tmp_path / "history")
+    first, second = encounters.iloc[:200], encounters.iloc[200:]
+    for version, part in (("v1", first), ("v1", second), ("v2", second)):
+        psi_history.append_run(history_dir, part, psi_engine.score_with_backend(part, PSIS, code_sets), version,
+                               facility="General")
+    return history_dir
+
+
+def test_trend_sums_every_run(history, encounters, code_sets):
+    results = psi_engine.score_with_backend(encounters, PSIS, code_sets)
+    trend = psi_history.trend(history, versions="v1")
+    for psi in PSIS:
+        rows = trend[trend["PSI"] == psi]
+        assert rows["Encounters"].sum() == len(encounters)
+        assert rows["Numerator"].sum() == (results[psi]["Status"] == "Inclusion").sum()
+        # One row per discharge quarter, in period order
+        periods = encounters.groupby(["YEAR", "DQTR"]).size()
+        assert list(zip(rows["YEAR"].astype(int), rows["DQTR"].astype(int))) == list(periods.index)
+        assert rows["Encounters"].tolist() == periods.tolist()
+    yearly = psi_history.trend(history, psis="PSI_08", versions="v1", years=2024, by="year")
+    assert yearly["YEAR"].tolist() == ["2024"] and yearly["Encounters"].iloc[0] == (encounters["YEAR"] == 2024).sum()
+
+def test_facilities_and_versions(history, encounters):
+    facilities = psi_history.facility_series(history, psis="PSI_08", versions="v1", by="year")
+    # The input's Facility column wins over the facility given for the run; blanks are "unknown"
+    assert set(facilities["Facility"]) == {"North", "South", "East", psi_history.UNKNOWN_PARTITION}
+    v2 = psi_history.trend(history, psis="PSI_08", versions="v2")
+    assert v2["Encounters"].sum() == len(encounters) - 200
+    assert psi_history.trend(history, psis="PSI_08", versions="v3").empty
+
+def test_runs_can_be_dropped(history, encounters):
+    runs = psi_history.list_runs(history)
+    assert [run["version"] for run in runs] == ["v1", "v1", "v2"] and runs[0]["encounters"] == 200
+    with pytest.raises(ValueError):
+        psi_history.append_run(history, encounters, {}, "v1", run_id=runs[0]["run_id"])
+    stored = psi_history.read_results(history, "PSI_12", versions="v2")
+    assert sorted(stored["EncounterID"]) == sorted(encounters["EncounterID"].iloc[200:])
+    assert psi_history.drop_run(history, runs[2]["run_id"]) > 0
+    assert psi_history.read_results(history, "PSI_12", versions="v2").empty
+    assert [run["run_id"] for run in psi_history.list_runs(history)] == [runs[0]["run_id"], runs[1]["run_id"]]
+
+def test_partition_values():
+    assert psi_history.partition_value(2024.0) == "2024"
+    assert psi_history.partition_value(" General / East ") == "General_East"
+    assert psi_history.partition_value(None) == psi_history.partition_value("  ") == psi_history.UNKNOWN_PARTITION
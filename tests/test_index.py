@@ -0,0 +1,65 @@
+"""Encounter lookup, filtering and paging over one job's results (psi_index)."""
+import math
+
+import numpy as np
+import pytest
+
+import psi_rules
+from psi_index import ResultIndex
+
+PSIS = ["PSI_07", "PSI_15"]
+
+
+@pytest.fixture(params=[True, False], ids=["in_memory", "spilled"])
+def index(request, pandas_codes):
+    loads = []
+    def load(psi):
+        loads.append(psi)
+        return pandas_codes[psi]
+    result_index = ResultIndex(load, PSIS, keep_frames=request.param)
+    result_index.loads = loads
+    return result_index
+
+
+def test_lookup_finds_the_encounter_in_every_psi(index, pandas_codes):
+    encounter_id = pandas_codes["PSI_07"]["EncounterID"].iloc[17]
+    found = index.lookup(encounter_id)
+    assert found["PSI"].tolist() == PSIS
+    for _, row in found.iterrows():
+        expected = psi_rules.decode_reasons(row["PSI"], pandas_codes[row["PSI"]].iloc[[17]])
+        assert row["Rationale"] == expected["Rationale"].iloc[0]
+        assert row["Status"] == expected["Status"].iloc[0]
+    assert index.lookup("no such encounter").empty
+
+def test_select_intersects_status_and_reasons(index, pandas_codes):
+    frame = pandas_codes["PSI_07"]
+    reasons = ["EXCL_LOS_SHORT", "NOT_IN_NUMERATOR"]
+    selected = index.select("PSI_07", status="Exclusion", reasons=reasons)
+    expected = np.flatnonzero((frame["Status"] == "Exclusion") & frame["Reason"].isin(reasons))
+    assert selected.tolist() == expected.tolist()
+    assert index.select("PSI_07", reasons=["NO_SUCH_REASON"]).size == 0
+    assert sum(index.values("PSI_07", "Status").values()) == len(frame)
+
+def test_pages_cover_the_selection_in_sort_order(index, pandas_codes):
+    frame = pandas_codes["PSI_07"]
+    selected = index.select("PSI_07", status="Exclusion")
+    page_size = 45
+    seen = []
+    first, pages = index.page("PSI_07", selected, page=0, page_size=page_size, sort_by="Age", ascending=False)
+    assert pages == math.ceil(len(selected) / page_size)
+    assert "Rationale" in first.columns and not any(c.startswith("Param_") for c in first.columns)
+    for page in range(pages):
+        rows, _ = index.page("PSI_07", selected, page=page, page_size=page_size, sort_by="Age", ascending=False)
+        assert len(rows) <= page_size
+        seen += rows["EncounterID"].tolist()
+    expected = frame.iloc[selected].sort_values("Age", ascending=False, kind="stable")["EncounterID"].tolist()
+    assert seen == expected
+    # Pages past the end show the last page
+    assert index.page("PSI_07", selected, page=pages + 3, page_size=page_size, sort_by="Age",
+                      ascending=False)[0]["EncounterID"].tolist() == seen[(pages - 1) * page_size:]
+
+def test_frames_are_loaded_again_only_when_spilled(index):
+    # Spilled results hold just the PSI in use, so switching PSIs reads the other one again
+    for psi in ["PSI_07", "PSI_07", "PSI_15", "PSI_15", "PSI_07"]:
+        index.page(psi, page_size=10, sort_by="Age")
+    assert index.loads == (PSIS if index.keep_frames else PSIS + ["PSI_07"])
@@ -0,0 +1,88 @@
+"""Background scoring jobs (psi_jobs): chunked scoring in the pool, persistence, reconnects and cancellation."""
+import json
+import os
+import socket
+import time
+
+import pytest
+
+import psi_engine
+import psi_jobs
+from psi_jobs import JobManager, FINISHED_STATES, JOB_COMPLETED, JOB_CANCELLED, JOB_FAILED, JOB_RUNNING
+
+PSIS = ["PSI_08", "PSI_12", "PSI_15"]
+
+
+@pytest.fixture
+def managers(tmp_path):
+    """Creates JobManagers on one jobs directory and shuts them down after the test."""
+    created = []
+    def make(**options):
+        manager = JobManager(jobs_dir=str(tmp_path), max_workers=2, chunk_size=150, **options)
+        created.append(manager)
+        return manager
+    yield make
+    for manager in created:
+        manager.shutdown()
+
+def wait_for(manager, job_id, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = manager.get_status(job_id)
+        if status["status"] in FINISHED_STATES:
+            return status
+        time.sleep(0.1)
+    raise AssertionError(f"Job {job_id} did not finish within {timeout}s")
+
+
+def test_job_results_match_in_process_scoring(managers, encounters, code_sets):
+    manager = managers()
+    job_id = manager.submit(encounters, PSIS, code_sets, metadata={"input_file": "encounters.xlsx"})
+    status = wait_for(manager, job_id)
+    assert status["status"] == JOB_COMPLETED and status["progress"] == 1.0
+    assert status["total_rows"] == len(encounters) and status["input_file"] == "encounters.xlsx"
+    expected = psi_engine.score_dataframe(encounters, PSIS, code_sets)
+    results = manager.get_results(job_id)
+    assert list(results) == PSIS
+    for psi in PSIS:
+        # Chunks are scored out of order but the results keep the input order
+        assert results[psi]["EncounterID"].tolist() == encounters["EncounterID"].tolist()
+        assert results[psi]["Status"].tolist() == [r["Status"] for r in expected[psi]]
+    assert list(manager.get_results(job_id, ["PSI_15"])) == ["PSI_15"]
+
+def test_another_manager_reconnects_to_a_finished_job(managers, encounters, code_sets):
+    first = managers()
+    job_id = first.submit(encounters.head(50), ["PSI_08"], code_sets)
+    wait_for(first, job_id)
+    second = managers()
+    assert second.get_status(job_id)["status"] == JOB_COMPLETED
+    assert second.get_results(job_id)["PSI_08"].equals(first.get_results(job_id)["PSI_08"])
+    assert [job["job_id"] for job in second.list_jobs()] == [job_id]
+    assert second.get_status("unknown") is None and second.get_results("unknown") is None
+
+def test_a_queued_job_can_be_cancelled(managers, encounters, code_sets):
+    manager = managers(max_concurrent_jobs=1)
+    running = manager.submit(encounters, PSIS, code_sets)
+    queued = manager.submit(encounters, PSIS, code_sets)
+    assert manager.cancel(queued)
+    assert wait_for(manager, queued)["status"] == JOB_CANCELLED
+    assert manager.get_results(queued) is None
+    assert wait_for(manager, running)["status"] == JOB_COMPLETED
+    assert not manager.cancel(running) # Already finished
+
+def write_job(jobs_dir, job_id, owner):
+    os.makedirs(os.path.join(jobs_dir, job_id))
+    with open(os.path.join(jobs_dir, job_id, "status.json"), "w") as f:
+        json.dump({"job_id": job_id, "status": JOB_RUNNING, "psis": PSIS, "submitted_at": time.time(), "owner": owner}, f)
+
+def test_only_jobs_of_stopped_servers_are_failed(managers, tmp_path):
+    jobs_dir = str(tmp_path)
+    os.makedirs(os.path.join(jobs_dir, psi_jobs.OWNERS_DIR))
+    # A server on this host whose process has exited, and a live one elsewhere with a fresh lease
+    write_job(jobs_dir, "stopped", {"id": "gone", "host": socket.gethostname(), "pid": 2 ** 22 + 1})
+    write_job(jobs_dir, "remote", {"id": "other", "host": "elsewhere", "pid": 1})
+    with open(os.path.join(jobs_dir, psi_jobs.OWNERS_DIR, "other.json"), "w") as f:
+        json.dump({"id": "other", "renewed_at": time.time()}, f)
+    manager = managers()
+    assert manager.get_status("stopped")["status"] == JOB_FAILED
+    assert manager.get_status("remote")["status"] == JOB_RUNNING
@@ -0,0 +1,69 @@
+"""Memory budget and result spilling (psi_memory)."""
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_memory
+import psi_rules
+from psi_memory import MemoryBudget, SpillStore, MIN_CHUNK_SIZE
+
+PSIS = ["PSI_08", "PSI_15"]
+
+
+@pytest.fixture
+def unmeasured(monkeypatch):
+    """Budgets count the bytes registered with track() instead of the process's memory."""
+    monkeypatch.setattr(psi_memory, "process_memory", lambda include_children=True: None)
+
+
+def test_parse_size():
+    assert psi_memory.parse_size("4G") == 4 * 1024 ** 3
+    assert psi_memory.parse_size("512mb") == 512 * 1024 ** 2
+    assert psi_memory.parse_size("1.5K") == 1536
+    assert psi_memory.parse_size(1000) == 1000
+    assert psi_memory.parse_size("2048") == 2048
+    assert psi_memory.parse_size(None) is None
+    assert psi_memory.parse_size(" ") is None
+
+def test_budget_tracks_registered_bytes(unmeasured):
+    budget = MemoryBudget("1M", high_water=0.5)
+    assert budget.headroom() == 512 * 1024 and not budget.near_limit()
+    budget.track(600 * 1024)
+    assert budget.near_limit() and budget.peak == 600 * 1024
+    budget.track(-10 * 1024 ** 2)
+    assert budget.tracked == 0 and budget.peak == 600 * 1024
+
+def test_chunk_size_shrinks_with_the_headroom(unmeasured):
+    budget = MemoryBudget("1M", high_water=0.5)
+    assert budget.chunk_size(100000, bytes_per_row=1024) == 512
+    assert budget.chunk_size(100000, bytes_per_row=1024, in_flight=4) == 128
+    assert budget.chunk_size(100000, bytes_per_row=1024, in_flight=8) == MIN_CHUNK_SIZE
+    assert budget.chunk_size(200, bytes_per_row=1) == 200
+    assert budget.chunk_size(5000, bytes_per_row=0) == 5000
+    budget.track(2 * 1024 ** 2)
+    assert budget.chunk_size(5000, bytes_per_row=1024) == MIN_CHUNK_SIZE
+
+@pytest.mark.parametrize("details", ["text", "typed"])
+def test_spilled_results_read_back_in_chunk_order(encounters, code_sets, details, unmeasured, tmp_path):
+    pytest.importorskip("pyarrow")
+    chunks = [encounters.iloc[s:s + 150] for s in range(0, len(encounters), 150)]
+    scored = [psi_engine.score_with_backend(chunk, PSIS, code_sets, reasons="codes", details=details) for chunk in chunks]
+    budget = MemoryBudget("1K")
+    store = SpillStore(str(tmp_path), budget, typed_details=details == "typed")
+    # Chunks finish out of order; the first two are spilled, the last one stays in memory until frame()
+    for chunk in [2, 0]:
+        store.add(chunk, scored[chunk])
+    assert store.maybe_spill() and store.spilled and budget.tracked == 0
+    store.add(1, scored[1])
+    for psi in PSIS:
+        expected = pd.concat([results[psi] for results in scored], ignore_index=True)
+        frame = store.frame(psi)
+        assert frame["EncounterID"].tolist() == encounters["EncounterID"].tolist()
+        assert isinstance(frame["Reason"].dtype, pd.CategoricalDtype)
+        assert (psi_rules.render_rationale(psi, frame) == psi_rules.render_rationale(psi, expected)).all()
+        if details == "typed":
+            assert psi_rules.has_typed_details(psi, frame)
+            for column in psi_rules.detail_kinds(psi):
+                assert frame[column].astype(object).where(frame[column].notna(), None).tolist() == \
+                    expected[column].astype(object).where(expected[column].notna(), None).tolist()
+    assert store.spilled_rows == len(encounters) * len(PSIS)
@@ -0,0 +1,71 @@
+"""Polars backend (psi_polars) and backend selection in psi_engine."""
+import os
+
+import pandas as pd
+import pytest
+
+import psi_engine
+from psi_engine import PSI_LIST
+
+psi_polars = pytest.importorskip("psi_polars")
+pytest.importorskip("polars")
+
+PSIS = ["PSI_08", "PSI_12", "PSI_15"]
+
+
+def assert_same(results, expected, columns=("EncounterID", "Status", "Reason", "Rationale")):
+    assert list(results) == list(expected)
+    for psi, reference in expected.items():
+        reference = pd.DataFrame(reference)
+        for column in [c for c in columns if c in reference.columns]:
+            assert results[psi][column].astype(str).tolist() == reference[column].astype(str).tolist(), (psi, column)
+
+
+@pytest.mark.parametrize("validate_timing", [True, False])
+def test_matches_the_row_engine(encounters, code_sets, validate_timing):
+    expected = psi_engine.score_dataframe(encounters, PSI_LIST, code_sets, validate_timing=validate_timing)
+    assert_same(psi_polars.score(encounters, code_sets, validate_timing=validate_timing), expected)
+
+def test_backends_produce_the_same_columns(encounters, code_sets, backend):
+    pandas = psi_engine.score_with_backend(encounters, PSIS, code_sets, backend="pandas")
+    results = psi_engine.score_with_backend(encounters, PSIS, code_sets, backend=backend)
+    assert_same(results, pandas)
+    for psi in PSIS:
+        assert list(results[psi].columns) == list(pandas[psi].columns)
+    with pytest.raises(ValueError):
+        psi_engine.score_with_backend(encounters, PSIS, code_sets, backend="spark")
+
+def test_out_of_core_files(encounters, code_sets, tmp_path):
+    path = str(tmp_path / "encounters.parquet")
+    psi_engine.make_parquet_safe(encounters).to_parquet(path)
+    output_dir = str(tmp_path / "results")
+    counts = psi_polars.score_to_files(path, code_sets, output_dir, psis=PSIS, cache_dir=str(tmp_path / "cache"))
+    expected = psi_engine.score_dataframe(encounters, PSIS, code_sets)
+    for psi in PSIS:
+        statuses = [r["Status"] for r in expected[psi]]
+        assert counts[psi] == {s: statuses.count(s) for s in set(statuses)}
+        written = pd.read_parquet(os.path.join(output_dir, f"{psi}.parquet"))
+        assert written["EncounterID"].tolist() == encounters["EncounterID"].tolist()
+        assert written["Status"].tolist() == statuses
+
+def test_file_inputs_are_normalized_once(encounters, code_sets, tmp_path, monkeypatch):
+    path, cache_dir = str(tmp_path / "encounters.parquet"), str(tmp_path / "cache")
+    psi_engine.make_parquet_safe(encounters).to_parquet(path)
+    cached = psi_polars.score(path, code_sets, psis=PSIS, cache_dir=cache_dir)
+    normalized = psi_polars.normalized_cache_path(path, cache_dir)
+    assert sorted(os.listdir(normalized)) == sorted(f"{name}.arrow" for name in psi_polars.NORMALIZED_TABLES)
+    # Rescoring memory-maps the cache: the input file is not scanned again
+    def no_scan(*args):
+        raise AssertionError("input scanned again")
+    monkeypatch.setattr(psi_polars, "scan_input", no_scan)
+    again = psi_polars.score(path, code_sets, psis=PSIS, cache_dir=cache_dir, validate_timing=False)
+    monkeypatch.undo()
+    assert_same(cached, {psi: psi_polars.score(path, code_sets, psis=[psi], use_cache=False)[psi] for psi in PSIS})
+    assert_same(again, psi_engine.score_dataframe(encounters, PSIS, code_sets, validate_timing=False))
+
+def test_a_changed_file_gets_a_new_cache(encounters, tmp_path):
+    path = str(tmp_path / "encounters.parquet")
+    psi_engine.make_parquet_safe(encounters).to_parquet(path)
+    before = psi_polars.normalized_cache_path(path, str(tmp_path))
+    psi_engine.make_parquet_safe(encounters.head(10)).to_parquet(path)
+    assert psi_polars.normalized_cache_path(path, str(tmp_path)) != before
@@ -0,0 +1,61 @@
+"""Approximate preview (psi_preview): stratified sample, weighted estimates and their bounds."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import psi_diff
+import psi_engine
+import psi_jobs
+import psi_preview
+
+PSIS = ["PSI_07", "PSI_09", "PSI_12", "PSI_15"]
+
+
+@pytest.fixture(scope="module")
+def synthetic(code_sets):
+    return psi_diff.synthesize(code_sets, 3000, seed=2)
+
+
+def test_sample_is_proportional_with_a_floor(synthetic, code_sets):
+    strata = psi_preview.assign_strata(synthetic, code_sets)
+    assert strata.str.count(r"\|").eq(2).all()
+    sample, sizes = psi_preview.stratified_sample(synthetic, strata, 500, seed=1)
+    assert sizes.sum() == len(synthetic) and sample.index.is_monotonic_increasing
+    # Each stratum in proportion to its size, but at least MIN_PER_STRATUM (or all of it)
+    taken = strata.loc[sample.index].value_counts().reindex(sizes.index, fill_value=0)
+    proportional = (sizes * 500 / len(synthetic)).round().astype(int)
+    assert taken.tolist() == proportional.clip(lower=np.minimum(psi_preview.MIN_PER_STRATUM, sizes), upper=sizes).tolist()
+    again, _ = psi_preview.stratified_sample(synthetic, strata, 500, seed=1)
+    assert again.index.equals(sample.index)
+
+def test_estimates_cover_the_exact_rates(synthetic, code_sets):
+    estimates = psi_preview.preview(synthetic, PSIS, code_sets, sample_size=1500, seed=3)
+    assert list(estimates.columns) == psi_preview.PREVIEW_COLUMNS and estimates["Encounters"].eq(len(synthetic)).all()
+    assert (estimates["Lower_per_1000"] <= estimates["Rate_per_1000"]).all()
+    assert (estimates["Rate_per_1000"] <= estimates["Upper_per_1000"]).all()
+    compared = psi_preview.compare_to_exact(estimates, psi_engine.score_with_backend(synthetic, PSIS, code_sets))
+    assert compared["Within_Bounds"].all(), compared.to_string()
+
+def test_a_full_sample_is_exact(encounters, code_sets):
+    estimates = psi_preview.preview(encounters, PSIS, code_sets, sample_size=len(encounters))
+    compared = psi_preview.compare_to_exact(estimates, psi_engine.score_with_backend(encounters, PSIS, code_sets))
+    assert (compared["Rate_per_1000"] == compared["Exact_Rate_per_1000"]).all()
+    assert (compared["Lower_per_1000"] == compared["Upper_per_1000"]).all()
+
+def test_no_sampled_inclusion_still_has_an_upper_bound():
+    strata = pd.Series(["a"] * 50 + ["b"] * 50)
+    results = {"PSI_08": pd.DataFrame({"Status": ["Exclusion"] * 100})}
+    row = psi_preview.estimate_rates(results, strata, pd.Series({"a": 500, "b": 500})).iloc[0]
+    assert row["Rate_per_1000"] == 0 and row["Upper_per_1000"] > 0
+
+def test_jobs_keep_the_preview(encounters, code_sets, tmp_path):
+    managers = [psi_jobs.JobManager(jobs_dir=str(tmp_path), max_workers=1) for _ in range(2)]
+    try:
+        job_id = managers[0].submit(encounters, ["PSI_08"], code_sets)
+        estimates = psi_preview.preview(encounters, ["PSI_08"], code_sets, sample_size=100)
+        managers[0].record_preview(job_id, estimates)
+        # Every session polling the job (here another manager on the jobs directory) sees it
+        assert pd.DataFrame(managers[1].get_status(job_id)["preview"]).equals(estimates)
+    finally:
+        for manager in managers:
+            manager.shutdown()
@@ -0,0 +1,60 @@
+"""The columnar engines against the per-row reference, through the psi_diff harness."""
+import pandas as pd
+import pytest
+
+import psi_diff
+import psi_engine
+
+CANDIDATES = [e for e in psi_diff.CANDIDATE_ENGINES if e in psi_engine.available_backends()]
+
+pytestmark = pytest.mark.skipif(not CANDIDATES, reason="neither duckdb nor polars is installed")
+
+
+@pytest.mark.parametrize("validate_timing", [True, False])
+def test_synthetic_encounters_match_reference(code_sets, validate_timing):
+    summary, mismatches, repros = psi_diff.run_diff(code_sets, synthetic_rows=600, seed=1, engines=CANDIDATES,
+                                                    validate_timing=validate_timing, workers=2, chunk_size=300)
+    assert summary["rows"] == 600
+    assert summary["mismatched_results"] == 0, mismatches.head(20).to_string()
+    assert summary["mismatch_kinds"] == 0
+    assert mismatches.empty and repros.empty
+
+def test_synthesis_is_repeatable(code_sets):
+    first = psi_diff.synthesize_chunks(code_sets, 250, seed=3, chunk_size=100)
+    again = psi_diff.synthesize_chunks(code_sets, 250, seed=3, chunk_size=100)
+    pd.testing.assert_frame_equal(first, again)
+    assert first["EncounterID"].is_unique
+    assert not first.equals(psi_diff.synthesize_chunks(code_sets, 250, seed=4, chunk_size=100))
+
+def test_real_input_frames_are_compared(encounters, code_sets):
+    summary, mismatches, _ = psi_diff.run_diff(code_sets, source=encounters, psis=["PSI_09", "PSI_15"],
+                                               engines=CANDIDATES, workers=2, chunk_size=200)
+    assert summary["rows"] == len(encounters)
+    assert summary["psis"] == ["PSI_09", "PSI_15"]
+    assert summary["mismatched_results"] == 0, mismatches.head(20).to_string()
+
+def test_mismatches_are_reported_and_shrunk(code_sets, monkeypatch):
+    # A candidate that excludes every PSI 07 inclusion must be caught and reduced to a minimal row
+    score = psi_diff.score_for_comparison
+    def broken(df, psis, code_sets, validate_timing, engine):
+        results = score(df, psis, code_sets, validate_timing, psi_diff.REFERENCE)
+        if engine == "broken":
+            for frame in results.values():
+                frame["Status"] = frame["Status"].astype(object).replace("Inclusion", "Exclusion")
+        return results
+    monkeypatch.setattr(psi_diff, "score_for_comparison", broken)
+
+    df = psi_diff.synthesize(code_sets, 300, seed=5)
+    reference = broken(df, ["PSI_07"], code_sets, True, psi_diff.REFERENCE)["PSI_07"]
+    candidate = broken(df, ["PSI_07"], code_sets, True, "broken")["PSI_07"]
+    included = (reference["Status"] == "Inclusion").to_numpy()
+    assert included.any()
+    differences = psi_diff.compare_results(reference, candidate, "PSI_07")
+    assert {field for _, field, _, _ in differences} == {"Status"}
+    assert sorted(i for i, _, _, _ in differences) == list(included.nonzero()[0])
+
+    row = df.iloc[included.nonzero()[0][0]]
+    reduced = psi_diff.minimize_row(row, "PSI_07", code_sets, True, "broken", "Status")
+    assert psi_diff.reproduces(pd.DataFrame([reduced]), "PSI_07", code_sets, True, "broken", "Status")
+    slots = lambda r: [c for c in r.index if c.startswith(("DX", "Proc"))]
+    assert len(slots(reduced)) < len(slots(row.dropna()))
@@ -0,0 +1,36 @@
+"""Data-quality pre-pass: the common exclusions decided column by column for the whole input."""
+import pandas as pd
+
+import psi_engine
+from psi_engine import PSI_LIST, COMMON_EXCLUSION_CODES
+
+
+def test_prepass_agrees_with_the_engine(encounters, code_sets):
+    quality = psi_engine.data_quality_prepass(psi_engine.canonicalize_input(encounters), code_sets)
+    assert quality.reason.notna().any() and quality.valid.any()
+    results = psi_engine.score_dataframe(encounters, PSI_LIST, code_sets)
+    excluded = ~quality.valid
+    for psi in PSI_LIST:
+        statuses = pd.Series([r["Status"] for r in results[psi]])
+        assert (statuses[excluded] == "Exclusion").all()
+    # Each encounter is counted under its first failing check only
+    summary = quality.summary().set_index("Check")["Count"]
+    assert summary[COMMON_EXCLUSION_CODES].sum() + summary["PASSED"] == summary["ENCOUNTERS"] == len(encounters)
+    assert quality.reason.value_counts().to_dict() == {c: summary[c] for c in COMMON_EXCLUSION_CODES if summary[c]}
+
+def test_checks_run_in_the_engine_order(make_encounter, code_sets):
+    df = pd.concat([make_encounter(EncounterID="drg", **{"MS-DRG": 999}, Age=10), make_encounter(EncounterID="sex", SEX=" ", Age=10),
+                    make_encounter(EncounterID="mdc14", DX1=code_sets["MDC14PRINDX_CODES"][0], Age=10),
+                    make_encounter(EncounterID="minor", Age=10), make_encounter(EncounterID="text age", Age="40"),
+                    make_encounter(EncounterID="adult")], ignore_index=True)
+    quality = psi_engine.data_quality_prepass(psi_engine.canonicalize_input(df), code_sets)
+    assert quality.reason.tolist() == ["DQ_DRG_999", "DQ_MISSING_FIELDS", "POP_MDC14", "AGE_UNDER_18", None, None]
+    # A non-numeric age is left to the per-row check
+    assert quality.checked.tolist() == [True, True, True, True, False, True]
+    assert quality.column_failures == {("MISSING_FIELD", "SEX"): 1}
+
+def test_poa_values_are_normalized(make_encounter, code_sets):
+    df = make_encounter(DX2="I10", POA2=" y", DX3="E119", POA3="Z", DX4="J189", POA4=None)
+    quality = psi_engine.data_quality_prepass(psi_engine.canonicalize_input(df), code_sets)
+    assert quality.frame.loc[0, ["POA1", "POA2", "POA3", "POA4"]].tolist() == ["Y", "Y", "", ""]
+    assert quality.column_failures == {("INVALID_POA", "POA3"): 1}
@@ -0,0 +1,51 @@
+"""Reason codes and their parameters render back to the Rationale text the engines always showed."""
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_rules
+from psi_engine import PSI_LIST
+
+
+def rationale(df, code_sets, backend, psi):
+    results = psi_engine.score_with_backend(df, [psi], code_sets, backend=backend)[psi]
+    return results["Status"].iloc[0], results["Rationale"].iloc[0]
+
+@pytest.mark.parametrize("psi", PSI_LIST)
+def test_common_step_messages(make_encounter, code_sets, backend, psi):
+    assert rationale(make_encounter(**{"MS-DRG": 999}), code_sets, backend, psi) == (
+        "Exclusion", "Data Quality: Ungroupable DRG (999)")
+    assert rationale(make_encounter(SEX=None, YEAR=None), code_sets, backend, psi) == (
+        "Exclusion", "Data Quality: Missing required fields (SEX, YEAR)")
+    assert rationale(make_encounter(Age=12), code_sets, backend, psi) == (
+        "Exclusion", "Age Exclusion: Patient age 12 < 18 years")
+
+def test_psi_steps_fill_their_parameters(make_encounter, code_sets, backend):
+    bsi = code_sets["IDTMC3D_CODES"][1]
+    assert rationale(make_encounter(length_of_stay=1), code_sets, backend, "PSI_07") == (
+        "Exclusion", "Exclusion: Length of stay < 2 days (1 days)")
+    assert rationale(make_encounter(DX2=bsi, POA2="N"), code_sets, backend, "PSI_07") == (
+        "Inclusion", f"Numerator: CVC-related BSI found (DX: {bsi}, POA: N)")
+    assert rationale(make_encounter(), code_sets, backend, "PSI_07") == (
+        "Exclusion", "No qualifying CVC-related BSI diagnosis found for numerator")
+
+def test_fill_parameters():
+    template = "Exclusion: Length of stay < {MIN_LOS_DAYS} days ({LOS_STR} days)"
+    assert psi_rules.fill_parameters(template) == "Exclusion: Length of stay < 2 days ({LOS_STR} days)"
+    assert psi_rules.fill_parameters(template, {"MIN_LOS_DAYS": 3}) == "Exclusion: Length of stay < 3 days ({LOS_STR} days)"
+
+@pytest.mark.parametrize("psi", PSI_LIST)
+def test_compact_results_round_trip(pandas_codes, encounters, code_sets, backend, psi, tmp_path):
+    # Reason codes stored in Parquet and rendered later give the text every engine renders itself
+    pytest.importorskip("pyarrow")
+    compact = pandas_codes[psi]
+    assert set(compact["Reason"].dropna()) <= set(psi_rules.reason_layout(psi).templates)
+    path = str(tmp_path / f"{psi}.parquet")
+    psi_engine.write_results_parquet(compact, path, psi)
+    stored = psi_rules.apply_reason_dtypes(psi, pd.read_parquet(path))
+    rendered = psi_rules.render_rationale(psi, stored)
+
+    text = psi_engine.score_with_backend(encounters, [psi], code_sets, backend=backend, reasons="text")[psi]
+    assert rendered.tolist() == text["Rationale"].tolist()
+    assert not rendered.str.contains("{", regex=False).any()
+    assert not any(c.startswith("Param_") for c in text.columns)
@@ -0,0 +1,42 @@
+"""Input column aliases (InputSchema): resolved once per input, coalesced per row."""
+import pandas as pd
+
+import psi_engine
+from psi_engine import PSI_LIST
+
+
+def aliased(df):
+    """The encounters in the Pdx/Sdx layout with Encounter_ID and Admission_Date."""
+    renames = {"EncounterID": "Encounter_ID", "admission_date": "Admission_Date", "DX1": "Pdx"}
+    renames.update({f"DX{j}": f"Sdx{j - 1}" for j in range(2, 31)})
+    renames.update({f"POA{j}": f"POA_Sdx{j - 1}" for j in range(2, 31)})
+    return df.rename(columns=renames)
+
+def statuses(results):
+    return {psi: [r["Status"] for r in records] for psi, records in results.items()}
+
+
+def test_aliased_layout_scores_the_same(encounters, code_sets):
+    expected = psi_engine.score_dataframe(encounters, PSI_LIST, code_sets)
+    results = psi_engine.score_dataframe(aliased(encounters), PSI_LIST, code_sets)
+    assert statuses(results) == statuses(expected)
+    assert [r["EncounterID"] for r in results["PSI_05"]] == encounters["EncounterID"].tolist()
+
+def test_blank_diagnoses_fall_back_to_the_alias():
+    df = pd.DataFrame({"EncounterID": ["A", "B"], "DX1": ["I10", " "], "Pdx": ["E119", "E119"],
+                       "DX2": [None, "K720"], "POA2": ["Y", "N"], "Sdx1": ["J189", "R65"], "POA_Sdx1": ["N", "Y"]})
+    canonical = psi_engine.canonicalize_input(df)
+    assert canonical["DX1"].tolist() == ["I10", "E119"]
+    assert canonical["DX2"].tolist() == ["J189", "K720"] and canonical["POA2"].tolist() == ["N", "N"]
+    schema = psi_engine.resolve_schema(df.columns)
+    for i in range(len(df)):
+        row = schema.canonical_row(df.iloc[i])
+        assert [row["DX1"], row["DX2"], row["POA2"]] == canonical.loc[i, ["DX1", "DX2", "POA2"]].tolist()
+
+def test_validate_reports_layout_problems():
+    issues = psi_engine.resolve_schema(["EncounterID", "DX2", "POA7", "DX31", "Proc3_Date"]).validate()
+    assert [level for level, _ in issues].count("error") == 1 # No principal diagnosis column
+    messages = " ".join(message for _, message in issues)
+    assert "POA7" in messages and "DX31" in messages and "Proc3_Date" in messages
+    complete = aliased(pd.DataFrame(columns=["EncounterID", "DX1", "POA1", "SEX", "Age", "DQTR", "YEAR", "admission_date"]))
+    assert [level for level, _ in psi_engine.resolve_schema(complete.columns).validate()] == []
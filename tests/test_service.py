@@ -0,0 +1,76 @@
+"""HTTP scoring service (psi_service): endpoints, results against the engine, and backpressure."""
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_service
+
+PSIS = ["PSI_08", "PSI_12", "PSI_15"]
+
+
+@pytest.fixture(scope="module", params=[0, 1], ids=["in_process", "worker_pool"])
+def server(request, code_sets):
+    server = psi_service.create_server(code_sets, port=0, workers=request.param, max_in_flight=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.service.shutdown()
+    server.server_close()
+
+def call(server, path, payload=None):
+    """(HTTP status, headers, JSON body) of a GET (no payload) or POST to the service."""
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=60) as response:
+            return response.status, response.headers, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, json.loads(e.read())
+
+def as_json(row):
+    """An input row as the JSON object a client sends (dates as ISO strings, no blanks)."""
+    return {k: (v.isoformat() if isinstance(v, pd.Timestamp) else v.item() if hasattr(v, "item") else v)
+            for k, v in row.items() if v is not None and not (isinstance(v, float) and v != v)}
+
+
+def test_health(server, code_sets):
+    status, _, health = call(server, "/health")
+    assert status == 200 and health["status"] == "ok"
+    assert health["psis"] == psi_engine.PSI_LIST and health["code_sets"] == len(code_sets)
+
+def test_scores_match_the_engine(server, encounters, code_sets):
+    rows = encounters.head(40)
+    expected = psi_engine.score_dataframe(rows, PSIS, code_sets)
+    status, _, one = call(server, "/score?psis=" + ",".join(PSIS), as_json(rows.iloc[0]))
+    assert status == 200 and one["EncounterID"] == rows["EncounterID"].iloc[0]
+    assert {psi: r["status"] for psi, r in one["results"].items()} == {psi: expected[psi][0]["Status"] for psi in PSIS}
+    status, _, batch = call(server, "/score/batch?psis=" + ",".join(PSIS), {"encounters": [as_json(r) for _, r in rows.iterrows()]})
+    assert status == 200 and [r["EncounterID"] for r in batch["results"]] == rows["EncounterID"].tolist()
+    for psi in PSIS:
+        assert [r["results"][psi]["status"] for r in batch["results"]] == [r["Status"] for r in expected[psi]]
+
+def test_bad_requests(server):
+    assert call(server, "/score?psis=PSI_99", {"EncounterID": "X"})[0] == 400
+    assert call(server, "/score", [{"EncounterID": "X"}])[0] == 400
+    assert call(server, "/score/batch", {"encounters": "X"})[0] == 400
+    assert call(server, "/nowhere", {})[0] == 404
+    assert call(server, "/nowhere")[0] == 404
+
+def test_saturated_service_answers_503(server, encounters):
+    service = server.service
+    # Both in-flight slots are taken, so the next request is turned away rather than queued
+    assert service.try_acquire() and service.try_acquire()
+    try:
+        status, headers, body = call(server, "/score", as_json(encounters.iloc[0]))
+        assert status == 503 and headers["Retry-After"] == "1" and "error" in body
+        assert service.health()["requests_rejected"] >= 1
+    finally:
+        service.release()
+        service.release()
+    assert call(server, "/score", as_json(encounters.iloc[0]))[0] == 200
@@ -0,0 +1,52 @@
+"""Sharded scoring (psi_shard): merged shards equal one full run."""
+import pytest
+
+import psi_engine
+import psi_shard
+
+PSIS = ["PSI_08", "PSI_09", "PSI_12", "PSI_15"]
+SHARDS = 3
+
+
+@pytest.fixture(scope="module")
+def full_run(encounters, code_sets):
+    results = psi_engine.score_with_backend(encounters, PSIS, code_sets)
+    return results, psi_shard.partial_aggregates(encounters, results)
+
+@pytest.fixture
+def shard_dirs(tmp_path, encounters, code_sets):
+    return [psi_shard.score_shard(encounters, code_sets, i, SHARDS, str(tmp_path), psis=PSIS) for i in range(SHARDS)]
+
+
+def test_merged_shards_equal_a_full_run(shard_dirs, full_run, tmp_path):
+    expected, expected_aggregates = full_run
+    results, aggregates = psi_shard.merge_shards(shard_dirs, str(tmp_path / "merged"))
+    assert aggregates["complete"] and aggregates["shards"] == list(range(SHARDS))
+    for field in ("encounters", "counts", "rule_hits", "cube"):
+        if field == "rule_hits":
+            assert aggregates[field] == {psi: dict(sorted(hits.items())) for psi, hits in expected_aggregates[field].items()}
+        else:
+            assert aggregates[field] == expected_aggregates[field]
+    for psi in PSIS:
+        assert list(results[psi].columns) == list(expected[psi].columns)
+        for column in ("EncounterID", "Status", "Reason", "Rationale"):
+            assert results[psi][column].astype(str).tolist() == expected[psi][column].astype(str).tolist(), (psi, column)
+    rates = psi_shard.rates_table(aggregates).set_index("PSI")
+    assert rates.loc["PSI_08", "Numerator"] == (expected["PSI_08"]["Status"] == "Inclusion").sum()
+
+def test_partial_and_invalid_merges(shard_dirs, tmp_path, encounters, code_sets):
+    _, aggregates = psi_shard.merge_shards(shard_dirs[:2])
+    assert not aggregates["complete"] and aggregates["shards"] == [0, 1]
+    with pytest.raises(ValueError, match="more than once"):
+        psi_shard.merge_aggregates([psi_shard.load_shard_aggregates(d) for d in shard_dirs[:1] * 2])
+    other = psi_shard.score_shard(encounters, code_sets, 0, SHARDS, str(tmp_path / "other"), psis=PSIS, validate_timing=False)
+    with pytest.raises(ValueError, match="validate_timing"):
+        psi_shard.merge_aggregates([psi_shard.load_shard_aggregates(d) for d in (other, shard_dirs[1])])
+
+def test_facility_key_keeps_a_facility_on_one_shard(encounters):
+    shards = [psi_shard.select_shard(encounters, i, SHARDS, key="facility") for i in range(SHARDS)]
+    assert sum(len(s) for s in shards) == len(encounters)
+    facilities = [set(s["Facility"].fillna("")) for s in shards]
+    assert all(not (a & b) for i, a in enumerate(facilities) for b in facilities[i + 1:])
+    # CRC32, not hash(): the same key lands on the same shard in every process and on every node
+    assert psi_shard.shard_of("E0000001", 8) == 1
@@ -0,0 +1,76 @@
+"""Streaming JSON-lines scoring (psi_stream): results, counters and resuming from the checkpoint."""
+import json
+import signal
+
+import pandas as pd
+import pytest
+
+import psi_engine
+import psi_stream
+
+PSIS = ["PSI_08", "PSI_12"]
+
+
+@pytest.fixture
+def run(tmp_path, appendix_df):
+    """Runs the CLI over feed.jsonl with one checkpoint; returns the paths."""
+    appendix = str(tmp_path / "appendix.xlsx")
+    appendix_df.to_excel(appendix, index=False)
+    paths = {"feed": str(tmp_path / "feed.jsonl"), "output": str(tmp_path / "flags.jsonl"),
+             "checkpoint": str(tmp_path / "stream.ckpt")}
+    handler = signal.getsignal(signal.SIGTERM)
+    def main():
+        assert psi_stream.main(["--appendix", appendix, "--input", paths["feed"], "--output", paths["output"],
+                                "--checkpoint", paths["checkpoint"], "--psis", ",".join(PSIS),
+                                "--batch-size", "7", "--flush-interval", "0.05"]) == 0
+    yield main, paths
+    signal.signal(signal.SIGTERM, handler)
+
+def feed_lines(rows):
+    return "".join(json.dumps({k: (v.isoformat() if isinstance(v, pd.Timestamp) else v.item() if hasattr(v, "item") else v)
+                               for k, v in row.items() if not pd.isna(v)}) + "\n" for _, row in rows.iterrows())
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resumes_after_the_checkpoint(run, encounters, code_sets):
+    main, paths = run
+    first, second = encounters.iloc[:20], encounters.iloc[20:45]
+    with open(paths["feed"], "w") as f:
+        f.write(feed_lines(first) + "\n   \n" + "not json\n")
+    main()
+    checkpoint = psi_stream.load_checkpoint(paths["checkpoint"])
+    assert checkpoint["encounters_scored"] == 20 and checkpoint["errors"] == 1 # The blank lines are skipped
+    # More encounters arrive; the next run starts where the checkpoint left off
+    with open(paths["feed"], "a") as f:
+        f.write(feed_lines(second))
+    main()
+    checkpoint = psi_stream.load_checkpoint(paths["checkpoint"])
+    assert checkpoint["encounters_scored"] == 45 and checkpoint["errors"] == 1
+    with open(paths["feed"], "rb") as f:
+        assert checkpoint["position"] == len(f.read())
+
+    output = read_output(paths["output"])
+    results = [r for r in output if "results" in r]
+    assert len(output) == 46 and [r["EncounterID"] for r in results] == encounters["EncounterID"].iloc[:45].tolist()
+    expected = psi_engine.score_dataframe(encounters.iloc[:45], PSIS, code_sets)
+    for psi in PSIS:
+        statuses = [r["results"][psi]["status"] for r in results]
+        assert statuses == [r["Status"] for r in expected[psi]]
+        assert checkpoint["counters"][psi] == {s: statuses.count(s) for s in set(statuses)}
+        assert [psi in r["flagged"] for r in results] == [s == "Inclusion" for s in statuses]
+
+def test_incomplete_last_line_is_left_for_the_next_run(run, encounters):
+    main, paths = run
+    lines = feed_lines(encounters.iloc[:3])
+    with open(paths["feed"], "w") as f:
+        f.write(lines + lines.splitlines()[0][:25]) # A writer is still appending the fourth encounter
+    main()
+    assert psi_stream.load_checkpoint(paths["checkpoint"])["encounters_scored"] == 3
+    with open(paths["feed"], "a") as f:
+        f.write(lines.splitlines()[0][25:] + "\n")
+    main()
+    checkpoint = psi_stream.load_checkpoint(paths["checkpoint"])
+    assert checkpoint["encounters_scored"] == 4 and checkpoint["errors"] == 0
@@ -0,0 +1,59 @@
+"""Parameter sweeps (psi_sweep): every grid point counts what a full run with those parameters finds."""
+import pytest
+
+import psi_diff
+import psi_engine
+import psi_rules
+
+psi_sweep = pytest.importorskip("psi_sweep")
+pytest.importorskip("duckdb")
+
+GRIDS = [
+    ({"PSI15_WINDOW_MIN_DAYS": [0, 1], "PSI15_WINDOW_MAX_DAYS": [5, 30]}, ["PSI_15"]),
+    ({"MIN_LOS_DAYS": [1, 4], "FIRST_OR_EXCLUSION_DAY": [3, 10]}, ["PSI_07", "PSI_12", "PSI_13", "PSI_14"]),
+    ({"PSI11_VENT_OFFSET_DAYS": [0, 2], "PSI11_INTUBATION_OFFSET_DAYS": [1, 3]}, ["PSI_11"]),
+]
+
+
+@pytest.fixture(scope="module")
+def synthetic(code_sets):
+    """Encounters built to reach the numerators (psi_diff), so the thresholds change the counts."""
+    return psi_diff.synthesize(code_sets, 1500, seed=7)
+
+
+@pytest.mark.parametrize("grid, psis", GRIDS)
+def test_grid_points_equal_full_runs(synthetic, code_sets, grid, psis, monkeypatch):
+    rates = psi_sweep.sweep(synthetic, code_sets, grid, psis=psis)
+    names = list(grid)
+    assert len(rates) == len(psis) * len(psi_sweep.build_grid(grid))
+    for values, combo in rates.groupby(names):
+        for name, value in zip(names, values):
+            monkeypatch.setitem(psi_engine.RULE_PARAMETERS, name, int(value))
+        results = psi_engine.score_dataframe(synthetic, psis, code_sets)
+        for _, row in combo.iterrows():
+            expected = sum(r["Status"] == "Inclusion" for r in results[row["PSI"]])
+            assert row["Inclusions"] == expected, dict(zip(names, values), psi=row["PSI"])
+        monkeypatch.undo()
+    defaults = rates[rates["Is_Default"]]
+    assert (defaults["Rate_Change"] == 0).all() and len(defaults) == len(psis)
+
+def test_parse_grid():
+    assert psi_sweep.parse_grid("min_los_days=1, 3") == ("MIN_LOS_DAYS", [1, 3])
+    for spec in ("MIN_LOS_DAYS", "NOT_A_PARAMETER=1", "MIN_LOS_DAYS=1.5", "MIN_LOS_DAYS="):
+        with pytest.raises(ValueError):
+            psi_sweep.parse_grid(spec)
+    grid = psi_sweep.build_grid({"MIN_LOS_DAYS": [3, 1, 3]})
+    assert grid["P_MIN_LOS_DAYS"].tolist() == [1, 3, 2] and grid["Is_Default"].tolist() == [False, False, True]
+
+def test_thresholds_are_carried_in_the_param_columns(make_encounter, code_sets, backend):
+    # The reason codes do not name a threshold; its value is a Param_ column of the row
+    short_stay = psi_engine.score_with_backend(make_encounter(length_of_stay=1), ["PSI_07"], code_sets, backend=backend,
+                                               reasons="codes")["PSI_07"].iloc[0]
+    assert short_stay["Reason"] == "EXCL_LOS_SHORT"
+    assert (short_stay["Param_LOS"], short_stay["Param_Min_LOS"]) == ("1", 2)
+    late_or = make_encounter(DX2="DDEEP000", POA2="N", Proc1="PORPR000", Proc1_Date="2024-03-14")
+    results = psi_engine.score_with_backend(late_or, ["PSI_12"], code_sets, backend=backend, reasons="codes")["PSI_12"]
+    assert results["Reason"].iloc[0] == "EXCL_FIRST_OR_LATE"
+    assert (results["Param_First_OR_Day"].iloc[0], results["Param_First_OR_Exclusion_Day"].iloc[0]) == (13, 10)
+    assert psi_rules.decode_reasons("PSI_12", results)["Rationale"].iloc[0] == (
+        "Exclusion: First OR procedure on/after 10th day of admission (Day 13)")
@@ -0,0 +1,49 @@
+"""Per-encounter temporal features (first/last procedure minutes, counts) shared by the timing rules."""
+import pandas as pd
+import pytest
+
+import psi_engine
+from psi_engine import MISSING_MINUTE, MINUTES_PER_DAY
+
+OR_CODE = "PORPR000" # An ORPROC code of the synthetic appendix (conftest.make_sets)
+VENA_CAVA_CODE = "PVENA000" # VENACIP and ORPROC
+
+
+def test_features_of_one_encounter(code_sets):
+    temporal_code_sets = psi_engine.build_temporal_code_sets(code_sets)
+    admit = pd.Timestamp("2024-03-01")
+    proc_list = [(OR_CODE, pd.Timestamp("2024-03-04 08:30"), 1), (VENA_CAVA_CODE, pd.Timestamp("2024-03-02 23:15"), 2),
+                 (OR_CODE, None, 3), ("0000000", pd.Timestamp("2024-03-09"), 4)]
+    features = psi_engine.compute_temporal_features(proc_list, admit, temporal_code_sets)
+    assert features["ADMIT_MINUTE"] == psi_engine.to_epoch_minute(admit)
+    assert features["ORPROC_FIRST"] == psi_engine.to_epoch_minute(pd.Timestamp("2024-03-02 23:15"))
+    assert features["ORPROC_LAST"] == psi_engine.to_epoch_minute(pd.Timestamp("2024-03-04 08:30"))
+    assert features["ORPROC_COUNT"] == 3 # Undated procedures count, but have no minute
+    assert features["VENACIP_COUNT"] == 1 and features["THROMP_COUNT"] == 0
+    assert features["THROMP_FIRST"] == features["THROMP_LAST"] == MISSING_MINUTE
+    assert features["ADMIT_TO_FIRST_OR_DAYS"] == 1
+    assert psi_engine.minute_to_day(features["ORPROC_FIRST"]) * MINUTES_PER_DAY <= features["ORPROC_FIRST"]
+
+def test_no_admission_date_leaves_the_offset_missing(code_sets):
+    features = psi_engine.compute_temporal_features([(OR_CODE, pd.Timestamp("2024-03-04"), 1)], None,
+                                                    psi_engine.build_temporal_code_sets(code_sets))
+    assert features["ADMIT_MINUTE"] == MISSING_MINUTE and features["ADMIT_TO_FIRST_OR_DAYS"] == MISSING_MINUTE
+    assert not psi_engine.has_minute(features["ADMIT_TO_FIRST_OR_DAYS"])
+
+def test_feature_table_has_one_int64_row_per_encounter(encounters, code_sets):
+    table = psi_engine.build_temporal_feature_table(encounters, code_sets)
+    assert table.index.equals(encounters.index) and (table.dtypes == "int64").all()
+    temporal_code_sets = psi_engine.build_temporal_code_sets(code_sets)
+    for i in [0, 57, 399]:
+        row = encounters.iloc[i]
+        expected = psi_engine.compute_temporal_features(psi_engine.extract_proc_info_enhanced(row),
+                                                        psi_engine.parse_date_safe(row["admission_date"]), temporal_code_sets)
+        assert table.iloc[i].to_dict() == expected
+
+@pytest.mark.parametrize("psi, numerator_dx", [("PSI_12", "DDEEP000"), ("PSI_13", "DSEPT000")])
+@pytest.mark.parametrize("or_date, status", [("2024-03-10", "Inclusion"), ("2024-03-11", "Exclusion")])
+def test_first_or_day_cutoff(make_encounter, code_sets, psi, numerator_dx, or_date, status):
+    # Admitted 2024-03-01 with a numerator diagnosis: a first OR procedure on day 10 of the admission excludes, day 9 does not
+    df = make_encounter(DX2=numerator_dx, POA2="N", Proc1=OR_CODE, Proc1_Date=or_date)
+    assert psi_engine.score_dataframe(df, [psi], code_sets)[psi][0]["Status"] == status
+    assert psi_engine.score_dataframe(df, [psi], code_sets, validate_timing=False)[psi][0]["Status"] == "Inclusion"
@@ -0,0 +1,50 @@
+"""Multi-version scoring: one pass over the input equals a separate run per appendix version."""
+import pytest
+
+import psi_engine
+import psi_versions
+
+PSIS = ["PSI_08", "PSI_12", "PSI_13", "PSI_15"]
+
+
+@pytest.fixture(scope="module")
+def versions(appendix_df, code_sets):
+    """The synthetic appendix and a revision without the first code of several numerator and exclusion sets."""
+    revised = appendix_df.copy()
+    for name in ("DEEPVIB", "PULMOID", "SEPTI2D", "ORPROC", "ABDOMI15P"):
+        revised.loc[0, f"Codes ({name})"] = None
+    return {"v1": code_sets, "v2": psi_engine.build_code_sets(revised)}
+
+
+def test_one_pass_equals_separate_runs(encounters, versions, backend):
+    results = psi_engine.score_versions(encounters, PSIS, versions, backend=backend)
+    assert list(results) == ["v1", "v2"]
+    for label, code_sets in versions.items():
+        separate = psi_engine.score_with_backend(encounters, PSIS, code_sets, backend=backend)
+        for psi in PSIS:
+            assert list(results[label][psi].columns) == list(separate[psi].columns)
+            for column in ("EncounterID", "Status", "Reason", "Rationale"):
+                assert results[label][psi][column].astype(str).tolist() == separate[psi][column].astype(str).tolist()
+
+def test_side_by_side_and_rates(encounters, versions):
+    results = psi_engine.score_versions(encounters, PSIS, versions)
+    changed_any = False
+    rates = psi_versions.version_rates(results).set_index(["PSI", "Version"])
+    for psi in PSIS:
+        combined = psi_versions.side_by_side(results, psi)
+        assert combined["EncounterID"].tolist() == encounters["EncounterID"].tolist()
+        before, after = results["v1"][psi]["Status"], results["v2"][psi]["Status"]
+        assert combined["Status_v1"].tolist() == before.tolist() and combined["Status_v2"].tolist() == after.tolist()
+        assert combined["Status_Changed"].tolist() == (before != after).tolist()
+        changed_any |= combined["Status_Changed"].any()
+        moved_out = int(((before == "Inclusion") & (after != "Inclusion")).sum())
+        moved_in = int(((before != "Inclusion") & (after == "Inclusion")).sum())
+        assert rates.loc[(psi, "v2"), ["Became_Inclusion", "Became_Exclusion"]].tolist() == [moved_in, moved_out]
+        assert rates.loc[(psi, "v1"), "Rate_Change"] == 0
+    assert changed_any # The revision changes some results
+
+def test_version_specs():
+    assert psi_versions.parse_version("v2025=appendix/new.xlsx") == ("v2025", "appendix/new.xlsx")
+    assert psi_versions.parse_version("appendix/PSI_v2024.json") == ("PSI_v2024", "appendix/PSI_v2024.json")
+    with pytest.raises(ValueError):
+        psi_versions.parse_version("=x.xlsx")